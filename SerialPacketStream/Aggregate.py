@@ -0,0 +1,114 @@
+import time
+import struct
+
+import SerialPacketStream.FramePacket as FramePacket
+
+import logging
+logger = logging.getLogger('default')
+
+# Aggregate frames are DATA frames on the control channel with this packet id, the payload is a run of
+# service packets each behind a SUBHEADER of channel, packet id and payload length
+PACKET_ID = 11
+SUBHEADER = struct.Struct('<BBB')
+# largest service packet payload the one byte length can describe
+MAX_PAYLOAD = 255
+
+
+def pack(entries):
+    # entries are (channel, packet_id, payload)
+    data = bytearray()
+    for channel, packet_id, payload in entries:
+        data += SUBHEADER.pack(channel, packet_id, len(payload))
+        data += payload
+    return data
+
+
+def unpack(data):
+    # [(channel, packet_id, payload view)], the whole frame is checked before anything is returned
+    view = memoryview(data)
+    entries = []
+    offset = 0
+    while offset < len(view):
+        if offset + SUBHEADER.size > len(view):
+            raise ValueError("truncated aggregate subheader at offset {}".format(offset))
+        channel, packet_id, length = SUBHEADER.unpack_from(view, offset)
+        offset += SUBHEADER.size
+        if offset + length > len(view):
+            raise ValueError("aggregate entry at offset {} overruns the frame".format(offset))
+        entries.append((channel, packet_id, view[offset:offset + length]))
+        offset += length
+    return entries
+
+
+class Aggregator(object):
+    """Packs small service packets queued close together into one DATA frame, Nagle style.
+
+    Packets with a payload of at most `threshold` bytes are held back rather than each getting a frame
+    and ACK of their own. What is held is sent straight away while nothing is in flight, otherwise
+    once it fills a frame of max_block_size() or the oldest has waited `delay` seconds. A lone packet
+    goes out in a normal frame. Control channel and DATA_FAF packets are never aggregated.
+
+    Every packet sent in an aggregate frame shares its FramePacket.Data, so they all complete or
+    fail together.
+    """
+    def __init__(self, transport_layer, threshold = 64, delay = 0.002):
+        if not 0 < threshold <= MAX_PAYLOAD:
+            raise ValueError("threshold not in range (1..{})".format(MAX_PAYLOAD))
+        self.transport_layer = transport_layer
+        self.threshold = threshold
+        self.delay = delay
+        # (packet_type, channel, ServicePacket, payload)
+        self.pending = []
+        self.size = 0
+        self.deadline = None
+        # set by TransportLayer.stop_aggregation(), nothing more is held back and what is gets flushed
+        self.stopping = False
+
+    def accepts(self, packet_type, channel, payload):
+        return not self.stopping and channel != 0 and packet_type != FramePacket.Type.DATA_FAF and len(payload) <= self.threshold
+
+    def add(self, packet_type, channel, packet, payload):
+        if self.pending and self.size + SUBHEADER.size + len(payload) > self.transport_layer.max_block_size():
+            self.flush()
+        if not self.pending:
+            self.deadline = time.perf_counter() + self.delay
+        self.pending.append((packet_type, channel, packet, payload))
+        self.size += SUBHEADER.size + len(payload)
+
+    def blocked(self):
+        held = self.transport_layer.tx_stream.held
+        return bool(held) and (0 in held or any(channel in held for _, channel, _, _ in self.pending))
+
+    def due(self):
+        if not self.pending:
+            return False
+        transport_layer = self.transport_layer
+        return (self.stopping or not len(transport_layer.tx_stream.queue) or time.perf_counter() >= self.deadline
+            or self.size + SUBHEADER.size >= transport_layer.max_block_size())
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.size = 0
+        self.deadline = None
+        if not pending:
+            return
+        transport_layer = self.transport_layer
+        if len(pending) == 1:
+            packet_type, channel, packet, payload = pending[0]
+            packet.frame_packet = transport_layer.send_packet(packet_type, channel, packet.packet_id, payload, packet._queued_time, packet.payload_checksum)
+            return
+        # only answered at the end of the frame when none of the packets asked for it
+        packet_type = FramePacket.Type.DATA if any(x[0] == FramePacket.Type.DATA for x in pending) else FramePacket.Type.DATA_NACK
+        frame = transport_layer.send_packet(packet_type, 0, PACKET_ID, pack((channel, packet.packet_id, payload) for _, channel, packet, payload in pending), pending[0][2]._queued_time)
+        for _, _, packet, _ in pending:
+            packet.frame_packet = frame
+        transport_layer.metrics.aggregated_tx += len(pending)
+
+    def reset(self):
+        # held back packets were meant for the previous connection, fail them as Service.connection_reset does
+        for _, _, packet, _ in self.pending:
+            packet.frame_packet = FramePacket.Data()
+            packet.frame_packet.status = FramePacket.Status.FAILED
+        self.pending = []
+        self.size = 0
+        self.deadline = None
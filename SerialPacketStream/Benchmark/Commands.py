@@ -0,0 +1,124 @@
+import os
+import time
+
+from SerialPacketStream import TransportLayer, ServicePacket
+from SerialPacketStream.FileService import PacketCode, FileDataPacket, ActionResponsePacket
+from SerialPacketStream.Emulator import Emulator
+
+from .Common import Session, percentiles, thread_cpu_time
+
+
+def benchmark_batch(latency = 0.05, size = 4096, repeat = 5, baudrate = 1000000, seed = 0):
+    """seconds for mount, cd, open, write of size bytes and close called one after another against the
+    same commands in a FileService.batch(), on a link with latency seconds each way"""
+    data = os.urandom(size)
+    results = {'latency': latency, 'size': size, 'baudrate': baudrate}
+    with Session(baudrate = baudrate, seed = seed, latency = latency) as session:
+        file_service = session.file_service
+        os.mkdir(os.path.join(session.emulator.root, 'gcodes'))
+        def serial():
+            return [file_service.mount(), file_service.cd('/gcodes'), file_service.open('bench.g'), file_service.write(data), file_service.close()]
+        def batch():
+            return file_service.batch().mount().cd('/gcodes').open('bench.g').write(data).close().run()
+        for name, operation in (('serial', serial), ('batch', batch)):
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                outcome = operation()
+                seconds.append(time.perf_counter() - start)
+            results[name] = {
+                'seconds': min(seconds),
+                'round_trips': min(seconds) / (2 * latency) if latency else None,
+                'ok': outcome == [True, True, True, size, True],
+            }
+    return results
+
+
+def benchmark_connect(links = 16, baudrate = 115200, seed = 0):
+    """seconds to synchronise each of links emulated printers brought up together with TransportLayer.connect_all"""
+    emulators = [Emulator(baudrate = baudrate, seed = seed + x) for x in range(links)]
+    transport_layers = [TransportLayer(emulator.connection, 512) for emulator in emulators]
+    try:
+        start = time.perf_counter()
+        results = TransportLayer.connect_all(transport_layers, timeout = 30.0)
+        total = time.perf_counter() - start
+        times = [results[x] for x in transport_layers]
+        result = percentiles([x for x in times if x is not None])
+        result.update({'links': links, 'baudrate': baudrate, 'connected': len([x for x in times if x is not None]), 'total_seconds': total, 'per_link_seconds': times})
+        return result
+    finally:
+        for transport_layer in transport_layers:
+            transport_layer.shutdown()
+        for emulator in emulators:
+            emulator.shutdown()
+
+
+def benchmark_aggregation(entries = 200, commands = 200, baudrate = 250000, seed = 0):
+    """frames and responses on the wire for an ls of a large directory and a burst of commands, with and without aggregation"""
+    results = {'entries': entries, 'commands': commands, 'baudrate': baudrate}
+    for name, aggregate in (('plain', False), ('aggregate', True)):
+        with Session(baudrate = baudrate, seed = seed, aggregate = aggregate) as session:
+            for index in range(entries):
+                open(os.path.join(session.emulator.root, 'file{:04d}.gcode'.format(index)), 'wb').close()
+            transport_layer = session.transport_layer
+            result = {}
+
+            def measure(operation):
+                metrics = transport_layer.metrics
+                before = (sum(metrics.frames_tx.values()), sum(metrics.frames_rx.values()))
+                start = time.perf_counter()
+                operation()
+                seconds = time.perf_counter() - start
+                return {
+                    'seconds': seconds,
+                    'frames_tx': sum(metrics.frames_tx.values()) - before[0],
+                    'frames_rx': sum(metrics.frames_rx.values()) - before[1],
+                }
+
+            def ls():
+                listed = session.file_service.ls()
+                assert len(listed) == entries
+            result['ls'] = measure(ls)
+
+            def burst():
+                # MOUNT is answered straight away by the emulated remote
+                with session.file_service.listen_for(ActionResponsePacket) as responses:
+                    for _ in range(commands):
+                        session.file_service.send_packet(ServicePacket(packet_id = PacketCode.MOUNT))
+                    for _ in range(commands):
+                        while not responses.ready():
+                            session.file_service.idle(0.0001)
+                        responses.next()
+            result['commands'] = measure(burst)
+
+            result['aggregated_tx'] = transport_layer.metrics.aggregated_tx
+            result['aggregated_rx'] = transport_layer.metrics.aggregated_rx
+            results[name] = result
+    return results
+
+
+def benchmark_ack_latency(count = 500, payload_size = 64, baudrate = None, seed = 0):
+    """seconds from Service.send_packet to the remote ACK for blocking DATA packets sent one at a time"""
+    payload = bytearray(os.urandom(payload_size))
+    latencies = []
+    with Session(baudrate = baudrate, seed = seed) as session:
+        # WRITE with no file open is accepted and acknowledged by the remote without touching the disk
+        for _ in range(count):
+            start = time.perf_counter()
+            session.file_service.send_packet(FileDataPacket(packet_id = PacketCode.WRITE, data = payload), block = True)
+            latencies.append(time.perf_counter() - start)
+    result = percentiles(latencies)
+    result.update({'payload_size': payload_size, 'baudrate': baudrate})
+    return result
+
+
+def benchmark_idle(duration = 2.0, seed = 0):
+    """cpu used by the host TransportLayer thread while connected with nothing to send"""
+    with Session(seed = seed) as session:
+        thread = session.transport_layer.worker_thread
+        start_wall = time.perf_counter()
+        start_cpu = thread_cpu_time(thread)
+        time.sleep(duration)
+        cpu = thread_cpu_time(thread) - start_cpu
+        wall = time.perf_counter() - start_wall
+    return {'seconds': wall, 'cpu_seconds': cpu, 'cpu_percent': cpu / wall * 100.0}
@@ -0,0 +1,63 @@
+import time
+import platform
+from statistics import quantiles
+
+from SerialPacketStream import TransportLayer, FileService
+from SerialPacketStream.Emulator import Emulator
+
+
+def percentiles(values):
+    if len(values) < 2:
+        value = values[0] if len(values) else None
+        return {'count': len(values), 'min': value, 'p50': value, 'p90': value, 'p99': value, 'max': value}
+    cuts = quantiles(values, n = 100, method = 'inclusive')
+    return {'count': len(values), 'min': min(values), 'p50': cuts[49], 'p90': cuts[89], 'p99': cuts[98], 'max': max(values)}
+
+
+def thread_cpu_time(thread):
+    # cpu seconds used by one thread, falls back to the whole process where per thread clocks are missing
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError):
+        return time.process_time()
+
+
+class Session(object):
+    """A connected TransportLayer and FileService talking to a fresh Emulator"""
+    def __init__(self, block_size = 512, window_size = 255, baudrate = None, bit_error_rate = 0.0, drop_rate = 0.0, seed = 0, adaptive = False, aggregate = False, latency = 0.0, fec = False):
+        self.emulator = Emulator(baudrate = baudrate, latency = latency, bit_error_rate = bit_error_rate, drop_rate = drop_rate,
+                                 payload_buffer_size = max(block_size, 512), seed = seed, aggregate = aggregate, fec = fec)
+        self.transport_layer = TransportLayer(self.emulator.connection, block_size)
+        self.transport_layer.window_size = window_size
+        self.transport_layer.fec = fec
+        if adaptive:
+            self.transport_layer.start_adaptive_block_size()
+        if aggregate:
+            self.transport_layer.start_aggregation()
+        self.file_service = FileService()
+        self.transport_layer.connect()
+        self.transport_layer.attach(1, self.file_service)
+        self.file_service.query_remote()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.transport_layer.disconnect()
+        self.transport_layer.shutdown()
+        self.emulator.shutdown()
+
+
+def environment():
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'transport_version': '.'.join(str(x) for x in TransportLayer.VERSION),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+    }
@@ -0,0 +1,86 @@
+import os
+import timeit
+
+import SerialPacketStream.FramePacket as FramePacket
+import SerialPacketStream.Codec as Codec
+import SerialPacketStream.Checksum as Checksum
+from SerialPacketStream import ServicePacket
+from SerialPacketStream.FileService import PacketCode, FileDataPacket
+
+
+def benchmark_codec(payload_sizes = (0, 64, 512), number = 2000):
+    """per frame cpu cost in microseconds of building, parsing and checksumming DATA frames"""
+    results = []
+    for size in payload_sizes:
+        payload = os.urandom(size)
+        service_packet = FileDataPacket(packet_id = PacketCode.WRITE, data = bytearray(payload))
+        frame = bytes(FramePacket.Data.create(FramePacket.Type.DATA, 1, PacketCode.WRITE, payload))
+        header = bytearray(frame[:FramePacket.Data.Header.SIZE])
+        sent = FramePacket.Data.create(FramePacket.Type.DATA, 1, PacketCode.WRITE, payload)
+        sent.encode()
+
+        def retransmit():
+            # go back N resends with a new sync number
+            sent.header.sync = (sent.header.sync + 1) & 0xFF
+            return sent.encode()
+
+        def run(statement):
+            return min(timeit.repeat(statement, number = number, repeat = 3)) / number * 1e6
+
+        results.append({
+            'payload_size': size,
+            'service_encode_us': run(lambda: bytes(service_packet)),
+            'service_decode_us': run(lambda: FileDataPacket.from_bytes(payload)),
+            'frame_encode_us': run(lambda: bytes(FramePacket.Data.create(FramePacket.Type.DATA, 1, PacketCode.WRITE, payload))),
+            'frame_reencode_us': run(lambda: bytes(sent)),
+            'frame_retransmit_us': run(retransmit),
+            'frame_decode_us': run(lambda: FramePacket.Data.from_bytearray(bytearray(frame))),
+            'header_crc8_us': run(lambda: Checksum.crc8(0, header[:-1])),
+            'payload_crc16_us': run(lambda: Checksum.crc16(0, payload)),
+        })
+    return results
+
+
+class SamplePacket(ServicePacket):
+    # telemetry style record, fixed size so batches of them decode as a NumPy structured array
+    time : Codec.uint32_t
+    temperatures : Codec.basic_array(Codec.float_t, 4)
+    target : Codec.int16_t
+
+
+def benchmark_array_codec(lengths = (16, 256, 1024), records = 1000, number = 200):
+    """per packet cpu cost in microseconds of basic_array payloads of lengths floats, and of decoding
+    records SamplePacket payloads one by one against Serializable.decode_batch"""
+    class ArrayPacket(ServicePacket):
+        count : Codec.uint16_t
+        values : Codec.basic_array(Codec.float_t, 'count')
+
+    class NumpyArrayPacket(ServicePacket):
+        count : Codec.uint16_t
+        values : Codec.basic_array(Codec.float_t, 'count', numpy = True)
+
+    def run(statement, number = number):
+        return min(timeit.repeat(statement, number = number, repeat = 3)) / number * 1e6
+
+    results = {'arrays': [], 'numpy': Codec.numpy is not None}
+    for length in lengths:
+        # values set as a list, and as the array.array a decode produces
+        packet = ArrayPacket(values = [float(x) for x in range(length)])
+        payload = bytes(packet)
+        decoded = ArrayPacket.from_bytes(payload)
+        result = {
+            'length': length,
+            'encode_list_us': run(lambda: bytes(packet)),
+            'encode_array_us': run(lambda: bytes(decoded)),
+            'decode_us': run(lambda: ArrayPacket.from_bytes(payload)),
+        }
+        if Codec.numpy is not None:
+            result['decode_numpy_us'] = run(lambda: NumpyArrayPacket.from_bytes(payload))
+        results['arrays'].append(result)
+
+    payloads = [bytes(SamplePacket(x, [20.0 + x, 60.0, 200.0, 210.5], 210)) for x in range(records)]
+    results['records'] = records
+    results['decode_each_us'] = run(lambda: [SamplePacket.from_bytes(x) for x in payloads], number = 5)
+    if Codec.numpy is not None:
+        results['decode_batch_us'] = run(lambda: SamplePacket.decode_batch(payloads), number = 5)
+    return results
@@ -0,0 +1,73 @@
+import os
+import time
+import tempfile
+
+import SerialPacketStream.FramePacket as FramePacket
+
+from .Common import Session
+
+
+def benchmark_block_size(size, error_rates = (0.0, 1e-5, 5e-5), block_size = 512, window_size = 32, baudrate = 250000, seed = 0):
+    """put throughput with the block size fixed at block_size against the adaptive controller, per bit error rate.
+    The window is kept short so the file is many windows long, with the 255 frame default a 256KB file is
+    queued whole at the starting block size before the controller's first update"""
+    data = os.urandom(size)
+    results = []
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        for bit_error_rate in error_rates:
+            result = {'size': size, 'block_size': block_size, 'window_size': window_size, 'baudrate': baudrate, 'bit_error_rate': bit_error_rate}
+            for name, adaptive in (('fixed', False), ('adaptive', True)):
+                with Session(block_size, window_size, baudrate, bit_error_rate, seed = seed, adaptive = adaptive) as session:
+                    start = time.perf_counter()
+                    session.file_service.put(src, 'bench.bin')
+                    seconds = time.perf_counter() - start
+                    with open(os.path.join(session.emulator.root, 'bench.bin'), 'rb') as f:
+                        ok = f.read() == data
+                    metrics = session.transport_layer.metrics
+                    result[name] = {
+                        'put_seconds': seconds,
+                        'put_KiBps': size / seconds / 1024,
+                        'put_ok': ok,
+                        'final_block_size': session.transport_layer.max_block_size(),
+                        'retransmits': metrics.retransmits,
+                        'nacks': metrics.responses_rx[FramePacket.Response.Type.NACK],
+                    }
+            results.append(result)
+    return results
+
+
+def benchmark_fec(size, error_rates = (0.0, 1e-5, 1e-4), block_size = 512, baudrate = 1000000, seed = 0):
+    """put throughput with plain go-back-N retransmission against Reed-Solomon parity on every frame, per bit error rate"""
+    data = os.urandom(size)
+    results = []
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        for bit_error_rate in error_rates:
+            result = {'size': size, 'block_size': block_size, 'baudrate': baudrate, 'bit_error_rate': bit_error_rate}
+            for name, fec in (('retransmit', False), ('fec', True)):
+                with Session(block_size, baudrate = baudrate, bit_error_rate = bit_error_rate, seed = seed, fec = fec) as session:
+                    start = time.perf_counter()
+                    session.file_service.put(src, 'bench.bin')
+                    seconds = time.perf_counter() - start
+                    with open(os.path.join(session.emulator.root, 'bench.bin'), 'rb') as f:
+                        ok = f.read() == data
+                    # the remote is the end receiving the file and repairing its frames
+                    remote = session.emulator.remote.metrics
+                    result[name] = {
+                        'put_seconds': seconds,
+                        'put_KiBps': size / seconds / 1024,
+                        'put_ok': ok,
+                        'retransmits': session.transport_layer.metrics.retransmits,
+                        'payload_crc_errors': remote.payload_crc_errors,
+                        'fec_corrected': remote.fec_corrected,
+                        'fec_uncorrectable': remote.fec_uncorrectable,
+                    }
+            results.append(result)
+    return results
@@ -0,0 +1,131 @@
+import os
+import sys
+import gc
+import time
+import tracemalloc
+
+import SerialPacketStream.FramePacket as FramePacket
+from SerialPacketStream import TransportLayer, Service, RawDataPacket
+
+
+class ReplayConnection(object):
+    """Connection whose reads replay a fixed byte stream and whose writes are discarded"""
+    baudrate = None
+
+    def __init__(self, data = b''):
+        self.load(data)
+
+    def load(self, data):
+        self.data = data
+        self.offset = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.offset
+
+    def read(self, size = 1):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.data) - self.offset)
+        buffer[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def write(self, data):
+        return len(data)
+
+
+def frame_stream(frames, payload_size):
+    # consecutive DATA_NACK frames on channel 1 as the remote would send them during a get
+    payload = os.urandom(payload_size)
+    stream = bytearray()
+    for sync in range(frames):
+        packet = FramePacket.Data.create(FramePacket.Type.DATA_NACK, 1, 1, payload)
+        packet.header.sync = sync & 0xFF
+        stream += bytes(packet)
+    return bytes(stream)
+
+
+def receive_transport_layer(connection, callback):
+    # process_receive is driven directly from the calling thread
+    transport_layer = TransportLayer(connection, 512)
+    transport_layer.shutdown()
+    service = Service()
+    service.register_packet(RawDataPacket, 1)
+    transport_layer.attach(1, service)
+    service.subscribe(RawDataPacket, callback)
+    return transport_layer
+
+
+def benchmark_receive(frames = 2000, payload_size = 64, iterations = 20000):
+    """cpu cost in microseconds of TransportLayer.process_receive per idle call and per received frame"""
+    connection = ReplayConnection()
+    received = []
+    transport_layer = receive_transport_layer(connection, received.append)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        transport_layer.process_receive()
+    idle = (time.perf_counter() - start) / iterations * 1e6
+
+    connection.load(frame_stream(frames, payload_size))
+    transport_layer.rx_stream.reset_connection()
+
+    calls = 0
+    start = time.perf_counter()
+    while connection.in_waiting or transport_layer.rx_stream.packet is not None:
+        transport_layer.process_receive()
+        calls += 1
+    per_frame = (time.perf_counter() - start) / frames * 1e6
+
+    return {'payload_size': payload_size, 'idle_call_us': idle, 'frame_us': per_frame, 'calls_per_frame': calls / frames, 'frames_received': len(received)}
+
+
+def benchmark_receive_memory(frames = 5000, payload_size = 512):
+    """memory churn of the receive path over a long stream of frames whose service packets are dropped
+    after dispatch, as a get does once the payload is written out. frame_blocks and frame_peak_bytes
+    are the memory blocks and bytes a frame has allocated by the time its packet is delivered, the
+    decoded service packet included, averaged over the delivered frames"""
+    connection = ReplayConnection(frame_stream(frames, payload_size))
+    received = [0]
+    # blocks and traced bytes after the previous delivery, and the totals over all deliveries
+    base = [0, 0]
+    totals = [0, 0]
+    def callback(packet):
+        blocks = sys.getallocatedblocks() - base[0]
+        _, peak = tracemalloc.get_traced_memory()
+        totals[0] += blocks
+        totals[1] += peak - base[1]
+        received[0] += 1
+    transport_layer = receive_transport_layer(connection, callback)
+
+    gc.collect()
+    collections = gc.get_stats()[0]['collections']
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    delivered = -1
+    while connection.in_waiting or transport_layer.rx_stream.packet is not None:
+        if delivered != received[0]:
+            # the previous packet is gone, the next frame is measured from here
+            delivered = received[0]
+            base[0] = sys.getallocatedblocks()
+            base[1], _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        transport_layer.process_receive()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'frames': frames,
+        'payload_size': payload_size,
+        'frames_received': received[0],
+        'frame_blocks': totals[0] / max(received[0], 1),
+        'frame_peak_bytes': totals[1] / max(received[0], 1),
+        # generation 0 collections are triggered by container objects left alive, cycles included
+        'gc_collections': gc.get_stats()[0]['collections'] - collections,
+        'traced_peak_bytes': peak - start,
+        'traced_retained_bytes': current - start,
+    }
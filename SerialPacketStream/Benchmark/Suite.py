@@ -0,0 +1,78 @@
+from .Common import environment
+from .Transfer import benchmark_transfer, benchmark_window, benchmark_fan_out, benchmark_delta, benchmark_stream, benchmark_baudrate
+from .Faults import benchmark_block_size, benchmark_fec
+from .Commands import benchmark_batch, benchmark_connect, benchmark_aggregation, benchmark_ack_latency, benchmark_idle
+from .Encoding import benchmark_codec, benchmark_array_codec
+from .Receive import benchmark_receive, benchmark_receive_memory
+
+import logging
+logger = logging.getLogger('default')
+
+
+def run(size = 256 * 1024, block_sizes = (64, 128, 256, 512), window_sizes = (8, 32, 255), error_rates = (0.0, 1e-6, 1e-5),
+        baudrate = None, latency_count = 500, idle_duration = 2.0, seed = 0, adaptive_error_rates = (0.0, 1e-5, 5e-5),
+        baudrate_targets = (250000, 1000000, 2000000), large_windows = (64, 255, 1024, 4096), fan_out_printers = 4,
+        fec_error_rates = (0.0, 1e-5, 1e-4), delta_block_size = 512):
+    """Run the whole suite, returns a json serialisable report. size is the file size of the transfers, the window and
+    block size sweeps raise it to what they need to measure anything"""
+    report = {'environment': environment(), 'transfer': []}
+
+    # every sweep varies one parameter from the default 512B blocks, 255 frame window on a clean link
+    configurations = [dict(block_size = x) for x in block_sizes]
+    configurations += [dict(window_size = x) for x in window_sizes if x != 255]
+    configurations += [dict(bit_error_rate = x, drop_rate = x / 10) for x in error_rates if x]
+    for options in configurations:
+        logger.info("Benchmarking transfer {}".format(options))
+        report['transfer'].append(benchmark_transfer(size, baudrate = baudrate, seed = seed, **options))
+
+    if large_windows:
+        logger.info("Benchmarking large windows")
+        # several of the largest windows long, or the put is over before the window is what limits it
+        block_size = 128
+        report['window'] = benchmark_window(max(size, 4 * max(large_windows) * block_size), large_windows, block_size, seed = seed)
+
+    if fan_out_printers:
+        logger.info("Benchmarking fan out upload")
+        report['fan_out'] = benchmark_fan_out(size, fan_out_printers, seed = seed)
+
+    if delta_block_size:
+        logger.info("Benchmarking delta upload")
+        report['delta'] = benchmark_delta(size, delta_block_size, baudrate = baudrate or 1000000, seed = seed)
+
+    logger.info("Benchmarking stream")
+    report['stream'] = benchmark_stream(size, baudrate = baudrate or 1000000, seed = seed)
+
+    if adaptive_error_rates:
+        logger.info("Benchmarking adaptive block size")
+        # long enough for the controller to settle and still send most of the file at the size it picked
+        window_size = 32
+        report['block_size'] = benchmark_block_size(max(size, 16 * window_size * 512), adaptive_error_rates, 512, window_size, baudrate or 250000, seed)
+
+    if fec_error_rates:
+        logger.info("Benchmarking forward error correction")
+        report['fec'] = benchmark_fec(size, fec_error_rates, baudrate = baudrate or 1000000, seed = seed)
+
+    if baudrate_targets:
+        logger.info("Benchmarking baud rate upgrades")
+        report['baudrate'] = benchmark_baudrate(size, baudrate or 115200, baudrate_targets, seed = seed)
+
+    logger.info("Benchmarking aggregation")
+    report['aggregation'] = benchmark_aggregation(baudrate = baudrate or 250000, seed = seed)
+
+    logger.info("Benchmarking command batches")
+    report['batch'] = benchmark_batch(baudrate = baudrate or 1000000, seed = seed)
+
+    logger.info("Benchmarking connect")
+    report['connect'] = benchmark_connect(baudrate = baudrate or 115200, seed = seed)
+
+    logger.info("Benchmarking codec")
+    report['codec'] = benchmark_codec()
+    report['array_codec'] = benchmark_array_codec()
+    logger.info("Benchmarking receive path")
+    report['receive'] = [benchmark_receive(payload_size = x) for x in (0, 64, 512)]
+    report['receive_memory'] = [benchmark_receive_memory(payload_size = x) for x in (64, 512)]
+    logger.info("Benchmarking ACK latency")
+    report['ack_latency'] = benchmark_ack_latency(latency_count, baudrate = baudrate, seed = seed)
+    logger.info("Benchmarking idle cpu")
+    report['idle'] = benchmark_idle(idle_duration, seed = seed)
+    return report
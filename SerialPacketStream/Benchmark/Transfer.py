@@ -0,0 +1,261 @@
+import os
+import time
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import SerialPacketStream.FramePacket as FramePacket
+import SerialPacketStream.FanOut as FanOut
+import SerialPacketStream.Delta as Delta
+from SerialPacketStream import StreamService
+
+from .Common import Session, thread_cpu_time
+
+
+def benchmark_transfer(size, block_size = 512, window_size = 255, baudrate = None, bit_error_rate = 0.0, drop_rate = 0.0, seed = 0):
+    """put then get one file of size random bytes, returns throughput and integrity of both directions"""
+    data = os.urandom(size)
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.bin')
+        dst = os.path.join(directory, 'dst.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        with Session(block_size, window_size, baudrate, bit_error_rate, drop_rate, seed) as session:
+            start = time.perf_counter()
+            session.file_service.put(src, 'bench.bin')
+            put_time = time.perf_counter() - start
+            with open(os.path.join(session.emulator.root, 'bench.bin'), 'rb') as f:
+                put_ok = f.read() == data
+
+            start = time.perf_counter()
+            session.file_service.get('bench.bin', dst)
+            get_time = time.perf_counter() - start
+            with open(dst, 'rb') as f:
+                get_ok = f.read() == data
+
+            links = (session.emulator.host_to_remote, session.emulator.remote_to_host)
+            return {
+                'size': size,
+                'block_size': block_size,
+                'window_size': window_size,
+                'baudrate': baudrate,
+                'bit_error_rate': bit_error_rate,
+                'drop_rate': drop_rate,
+                'put_seconds': put_time,
+                'put_KiBps': size / put_time / 1024,
+                'put_ok': put_ok,
+                'get_seconds': get_time,
+                'get_KiBps': size / get_time / 1024,
+                'get_ok': get_ok,
+                'bytes_on_wire': sum(link.bytes_written for link in links),
+                'bytes_corrupted': sum(link.bytes_corrupted for link in links),
+                'bytes_dropped': sum(link.bytes_dropped for link in links),
+                'metrics': session.transport_layer.metrics.snapshot(),
+            }
+
+
+def benchmark_window(size, window_sizes = (64, 255, 1024, 4096), block_size = 128, latency = 0.05, baudrate = 2000000, seed = 0):
+    """put throughput per window size on a link with latency seconds each way, windows over 255 frames
+    rely on the extended sync numbers negotiated with the emulated remote"""
+    data = os.urandom(size)
+    results = []
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        for window_size in window_sizes:
+            with Session(block_size, window_size, baudrate, seed = seed, latency = latency) as session:
+                start = time.perf_counter()
+                session.file_service.put(src, 'bench.bin')
+                seconds = time.perf_counter() - start
+                with open(os.path.join(session.emulator.root, 'bench.bin'), 'rb') as f:
+                    ok = f.read() == data
+                results.append({
+                    'size': size,
+                    'block_size': block_size,
+                    'latency': latency,
+                    'baudrate': baudrate,
+                    'window_size': window_size,
+                    'effective_window': session.transport_layer.max_window(),
+                    'put_seconds': seconds,
+                    'put_KiBps': size / seconds / 1024,
+                    'put_ok': ok,
+                })
+    return results
+
+
+def benchmark_fan_out(size, printers = 4, baudrate = 1000000, seed = 0):
+    """one file put to printers emulated printers at once, each printer a FileService.put of its own on a
+    thread against FanOut.put sharing the file's blocks, host cpu is that of the host TransportLayer threads"""
+    data = os.urandom(size)
+    results = {'size': size, 'printers': printers, 'baudrate': baudrate}
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        for name in ('separate', 'fan_out'):
+            sessions = [Session(baudrate = baudrate, seed = seed + x) for x in range(printers)]
+            try:
+                services = [session.file_service for session in sessions]
+                threads = [session.transport_layer.worker_thread for session in sessions]
+                start_cpu = sum(thread_cpu_time(thread) for thread in threads)
+                start = time.perf_counter()
+                if name == 'separate':
+                    with ThreadPoolExecutor(max_workers = printers) as executor:
+                        list(executor.map(lambda service: service.put(src, 'bench.bin'), services))
+                else:
+                    FanOut.put(services, src, 'bench.bin')
+                seconds = time.perf_counter() - start
+                cpu = sum(thread_cpu_time(thread) for thread in threads) - start_cpu
+                ok = True
+                for session in sessions:
+                    with open(os.path.join(session.emulator.root, 'bench.bin'), 'rb') as f:
+                        ok = ok and f.read() == data
+            finally:
+                for session in sessions:
+                    session.close()
+            results[name] = {
+                'seconds': seconds,
+                'host_cpu_seconds': cpu,
+                'ok': ok,
+            }
+    return results
+
+
+def gcode(size, seed = 0):
+    # G-code like text of about size bytes, the sort of file delta uploads are for
+    rand = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        lines.append('G1 X{:.3f} Y{:.3f} E{:.5f}\n'.format(rand.uniform(0, 220), rand.uniform(0, 220), rand.uniform(0, 0.1)))
+        length += len(lines[-1])
+    return ''.join(lines).encode()[:size]
+
+
+def benchmark_delta(size, block_size = 512, baudrate = 1000000, seed = 0):
+    """bytes on the wire, both directions, and seconds of a full put against FileService.put_delta of a re-sliced
+    file, a changed header comment, a few hundred bytes rewritten and some lines inserted, over the remote's old copy"""
+    old = gcode(size, seed)
+    rand = random.Random(seed)
+    new = bytearray(old)
+    new[0:0] = b'; layer_height = 0.16\n'
+    for _ in range(4):
+        offset = rand.randrange(len(new) - 512)
+        new[offset:offset + 400] = gcode(400, rand.randrange(2**32))
+    offset = rand.randrange(len(new))
+    new[offset:offset] = gcode(2000, rand.randrange(2**32))
+    new = bytes(new)
+
+    results = {'size': len(new), 'block_size': block_size, 'baudrate': baudrate}
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.gcode')
+        with Session(baudrate = baudrate, seed = seed) as session:
+            emulator = session.emulator
+            def wire_bytes():
+                return emulator.host_to_remote.bytes_written + emulator.remote_to_host.bytes_written
+            with open(src, 'wb') as f:
+                f.write(old)
+            session.file_service.put(src, 'bench.gcode')
+            with open(src, 'wb') as f:
+                f.write(new)
+
+            for name in ('put', 'delta'):
+                start_bytes = wire_bytes()
+                start = time.perf_counter()
+                if name == 'put':
+                    session.file_service.put(src, 'full.gcode')
+                    used = False
+                else:
+                    used = session.file_service.put_delta(src, 'bench.gcode', block_size)
+                seconds = time.perf_counter() - start
+                with open(os.path.join(emulator.root, 'full.gcode' if name == 'put' else 'bench.gcode'), 'rb') as f:
+                    ok = f.read() == new
+                results[name] = {
+                    'seconds': seconds,
+                    'wire_bytes': wire_bytes() - start_bytes,
+                    'ok': ok,
+                }
+            results['delta']['delta_used'] = used
+            start = time.perf_counter()
+            weak, strong = Delta.signature(old, block_size)
+            ops = Delta.delta(new, weak, strong, block_size)
+            results['delta']['compute_seconds'] = time.perf_counter() - start
+            results['delta']['literal_bytes'] = sum(length for _, length, basis in ops if basis is None)
+    return results
+
+
+def benchmark_stream(size, baudrate = 1000000, seed = 0):
+    """G-code lines written one by one to a StreamService and read back from the remote's echo on another
+    thread, throughput each way against the line rate"""
+    data = gcode(size, seed)
+    lines = data.splitlines(keepends = True)
+    with Session(baudrate = baudrate, seed = seed) as session:
+        stream = StreamService(timeout = 10.0)
+        session.transport_layer.attach(2, stream)
+        echo = bytearray()
+        def reader():
+            buffer = bytearray(4096)
+            while len(echo) < len(data):
+                length = stream.readinto(buffer)
+                if length == 0:
+                    break
+                echo.extend(buffer[:length])
+        thread = threading.Thread(target = reader)
+        start = time.perf_counter()
+        thread.start()
+        for line in lines:
+            stream.write(line)
+        stream.flush()
+        thread.join()
+        seconds = time.perf_counter() - start
+        stream.close()
+        metrics = session.transport_layer.metrics
+        return {
+            'size': len(data),
+            'writes': len(lines),
+            'baudrate': baudrate,
+            'seconds': seconds,
+            'KiBps': len(data) / seconds / 1024,
+            # 10 bits a byte on the line
+            'line_KiBps': baudrate / 10 / 1024 if baudrate else None,
+            'ok': echo == data,
+            'frames_tx': sum(metrics.frames_tx[(2, x)] for x in FramePacket.Type),
+            'nyets_tx': metrics.responses_tx[FramePacket.Response.Type.NYET],
+        }
+
+
+def benchmark_baudrate(size, baudrate = 115200, targets = (250000, 1000000, 2000000), seed = 0):
+    """put throughput after negotiating each target baud rate up from baudrate, the first result stays at baudrate"""
+    data = os.urandom(size)
+    results = []
+    with tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') as directory:
+        src = os.path.join(directory, 'src.bin')
+        with open(src, 'wb') as f:
+            f.write(data)
+
+        for target in (baudrate,) + tuple(targets):
+            with Session(baudrate = baudrate, seed = seed) as session:
+                start = time.perf_counter()
+                changed = session.transport_layer.change_baudrate(target)
+                change_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                session.file_service.put(src, 'bench.bin')
+                seconds = time.perf_counter() - start
+                with open(os.path.join(session.emulator.root, 'bench.bin'), 'rb') as f:
+                    ok = f.read() == data
+                results.append({
+                    'size': size,
+                    'baudrate': session.transport_layer.connection.baudrate,
+                    'changed': changed,
+                    'change_seconds': change_time,
+                    'put_seconds': seconds,
+                    'put_KiBps': size / seconds / 1024,
+                    'put_ok': ok,
+                })
+    return results
@@ -0,0 +1,16 @@
+# Every benchmark runs against SerialPacketStream.Emulator so results only depend on the host, an
+# unpaced link (baudrate None) measures how fast the Python side can go, a paced one how close the
+# transport gets to the line rate.
+#
+# Transfer has the put/get throughput benchmarks, Faults the ones comparing how noisy links are dealt
+# with, Commands the latency of commands and connecting, Encoding and Receive the host cpu and memory
+# cost of building and parsing frames. Suite.run() runs them all, python -m SerialPacketStream.Benchmark
+# from the command line.
+
+from .Common import Session, percentiles, thread_cpu_time, environment
+from .Transfer import benchmark_transfer, benchmark_window, benchmark_fan_out, gcode, benchmark_delta, benchmark_stream, benchmark_baudrate
+from .Faults import benchmark_block_size, benchmark_fec
+from .Commands import benchmark_batch, benchmark_connect, benchmark_aggregation, benchmark_ack_latency, benchmark_idle
+from .Encoding import benchmark_codec, SamplePacket, benchmark_array_codec
+from .Receive import ReplayConnection, frame_stream, receive_transport_layer, benchmark_receive, benchmark_receive_memory
+from .Suite import run
@@ -0,0 +1,41 @@
+import sys
+import json
+import argparse
+
+from .Suite import run
+
+import logging
+logger = logging.getLogger('default')
+
+parser = argparse.ArgumentParser(description='Benchmark SerialPacketStream against an emulated Marlin')
+parser.add_argument("-o", "--output", default=None, help="write the JSON report to this file instead of stdout")
+parser.add_argument("-s", "--size", type=int, default=256 * 1024, help="bytes per put/get transfer, the large window and adaptive block size sweeps use more where this is too few")
+parser.add_argument("-b", "--baud", type=int, default=None, help="pace the emulated link at this baud rate, unpaced by default")
+parser.add_argument("--block-sizes", type=int, nargs='+', default=[64, 128, 256, 512], help="block sizes to sweep")
+parser.add_argument("--window-sizes", type=int, nargs='+', default=[8, 32, 255], help="window depths to sweep")
+parser.add_argument("--error-rates", type=float, nargs='+', default=[0.0, 1e-6, 1e-5], help="bit error rates to sweep, byte drops at a tenth of it")
+parser.add_argument("--adaptive-error-rates", type=float, nargs='*', default=[0.0, 1e-5, 5e-5], help="bit error rates to compare fixed and adaptive block sizes at, paced at 250000 baud unless --baud is given")
+parser.add_argument("--fec-error-rates", type=float, nargs='*', default=[0.0, 1e-5, 1e-4], help="bit error rates to compare retransmission and FEC at, paced at 1000000 baud unless --baud is given")
+parser.add_argument("--baud-targets", type=int, nargs='*', default=[250000, 1000000, 2000000], help="baud rates to negotiate up to from --baud, or 115200, before a put")
+parser.add_argument("--large-windows", type=int, nargs='*', default=[64, 255, 1024, 4096], help="window depths to compare on a 50ms latency 2M baud link, above 255 needs extended sync numbers")
+parser.add_argument("--fan-out", type=int, default=4, help="printers to upload one file to at once, 0 to skip")
+parser.add_argument("--delta-block-size", type=int, default=512, help="block size of the re-sliced file delta upload compared with a full put, 0 to skip")
+parser.add_argument("--latency-count", type=int, default=500, help="blocking packets sent for the ACK latency percentiles")
+parser.add_argument("--idle", type=float, default=2.0, help="seconds to measure idle cpu over")
+parser.add_argument("--seed", type=int, default=0, help="seed for the emulated line faults")
+parser.add_argument("--log-level", default='ERROR', choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'], help="Log Level")
+args = parser.parse_args()
+
+console_log = logging.StreamHandler()
+console_log.setFormatter(logging.Formatter('[%(threadName)-10s] %(msecs)03d: %(levelname)-5s - %(message)s'))
+logger.addHandler(console_log)
+logger.setLevel(getattr(logging, args.log_level, None))
+
+report = run(args.size, args.block_sizes, args.window_sizes, args.error_rates, args.baud, args.latency_count, args.idle, args.seed, args.adaptive_error_rates, args.baud_targets, args.large_windows, args.fan_out,
+             args.fec_error_rates, args.delta_block_size)
+if args.output is None:
+    json.dump(report, sys.stdout, indent = 2)
+    print()
+else:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 2)
@@ -0,0 +1,112 @@
+import time
+
+import SerialPacketStream.FramePacket as FramePacket
+
+import logging
+logger = logging.getLogger('default')
+
+
+class BlockSizeController(object):
+    """Picks the payload size of outgoing DATA frames from the error rate seen on the link.
+
+    Every `interval` seconds the NACKs and response timeouts since the last update are compared with
+    the frames sent to estimate the chance of a single byte being corrupted, and the retransmits per
+    failure give the frames a go-back-N failure costs, which depends on the window in flight rather
+    than on the frame size so smaller frames make every failure cheaper. With those the expected goodput of every
+    candidate size is worked out and the best one used, a change is only made when it is expected to
+    be at least `hysteresis` better than the current size. Counts decay by `decay` every update so
+    the estimate follows a cable that gets better or worse.
+
+    Sizes are multiples of `step` from `minimum` up to the maximum negotiated with the remote.
+    """
+    def __init__(self, transport_layer, minimum = 64, step = 16, interval = 0.25, min_samples = 32, decay = 0.5, hysteresis = 0.05):
+        self.transport_layer = transport_layer
+        self.minimum = minimum
+        self.step = step
+        self.interval = interval
+        self.min_samples = min_samples
+        self.decay = decay
+        self.hysteresis = hysteresis
+        self.block_size = None
+        self.byte_error_rate = 0.0
+        self.reset()
+
+    def reset(self):
+        self.frames = 0.0
+        self.failures = 0.0
+        self.bytes = 0.0
+        self.retransmits = 0.0
+        self.acknowledged = 0.0
+        self.last = self.counters()
+        self.next_update = time.perf_counter() + self.interval
+
+    def counters(self):
+        metrics = self.transport_layer.metrics
+        frames = 0
+        nbytes = 0
+        for (channel, packet_type), count in list(metrics.frames_tx.items()):
+            if channel is not None:
+                frames += count
+                nbytes += metrics.bytes_tx[(channel, packet_type)]
+        failures = metrics.responses_rx[FramePacket.Response.Type.NACK] + metrics.response_timeouts
+        # every acknowledged frame has its ACK latency recorded
+        return (frames, nbytes, failures, metrics.retransmits, metrics.ack_latency.count)
+
+    def maximum(self):
+        return self.transport_layer.sync_max_block_size
+
+    def candidates(self):
+        maximum = self.maximum()
+        sizes = list(range(min(self.minimum, maximum), maximum, self.step))
+        sizes.append(maximum)
+        return sizes
+
+    def overhead(self, size):
+        # frame bytes that are not payload, the header grows with Feature.EXTENDED_SYNC and FEC adds
+        # parity that grows with the payload
+        return self.transport_layer.frame_size(size) - size
+
+    def goodput(self, size, failure_cost):
+        # payload bytes delivered per byte put on the wire
+        frame = size + self.overhead(size)
+        failure = 1.0 - (1.0 - self.byte_error_rate) ** frame
+        return size / frame / (1.0 + failure * failure_cost)
+
+    def update(self):
+        now = time.perf_counter()
+        if now < self.next_update:
+            return
+        self.next_update = now + self.interval
+
+        counts = self.counters()
+        frames, nbytes, failures, retransmits, acknowledged = (x - y for x, y in zip(counts, self.last))
+        if frames < self.min_samples:
+            return
+        self.last = counts
+        self.frames = self.frames * self.decay + frames
+        self.bytes = self.bytes * self.decay + nbytes
+        self.failures = self.failures * self.decay + failures
+        self.retransmits = self.retransmits * self.decay + retransmits
+        self.acknowledged = self.acknowledged * self.decay + acknowledged
+
+        # estimate the per byte error rate from the frame failure rate at the average frame size sent,
+        # the frames in flight behind a failed one are dropped unchecked by the remote so only the
+        # acknowledged and failed ones count
+        frame = self.bytes / self.frames
+        failure = min(self.failures / (self.failures + self.acknowledged), 0.99) if self.failures else 0.0
+        self.byte_error_rate = 1.0 - (1.0 - failure) ** (1.0 / frame)
+        # frames resent for every failure, roughly what was in flight at the time
+        failure_cost = max(1.0, self.retransmits / self.failures) if self.failures else 1.0
+
+        current_size = self.max_block_size()
+        best = max(self.candidates(), key = lambda size: (self.goodput(size, failure_cost), -size))
+        if best != current_size and self.goodput(best, failure_cost) > self.goodput(current_size, failure_cost) * (1.0 + self.hysteresis):
+            logger.info("block size {}B -> {}B (byte error rate {:.2e}, {:.1f} frames resent per failure)".format(current_size, best, self.byte_error_rate, failure_cost))
+            self.block_size = best
+
+    def max_block_size(self):
+        maximum = self.maximum()
+        return maximum if self.block_size is None else min(self.block_size, maximum)
+
+    def as_dict(self):
+        return {'block_size': self.max_block_size(), 'maximum': self.maximum(), 'byte_error_rate': self.byte_error_rate}
@@ -0,0 +1,130 @@
+import os
+import re
+import time
+import struct
+from enum import IntEnum
+from collections import deque
+from threading import Thread, Event
+
+import logging
+logger = logging.getLogger('default')
+
+Direction = IntEnum('Direction', ['IN', 'OUT'], start = 0)
+
+# File layout
+#   header : magic (8 bytes), format version (uint16), capture start time (double, unix epoch)
+#   records: timestamp (double, unix epoch), direction (uint8), length (uint32), <length> bytes of data
+MAGIC = b'SPSCAP\r\n'
+VERSION = 1
+HEADER = struct.Struct('<8sHd')
+RECORD = struct.Struct('<dBI')
+
+
+def connection_name(connection):
+    # pyserial exposes the device as port, fall back to whatever the connection calls itself
+    name = getattr(connection, 'port', None) or getattr(connection, 'name', None) or type(connection).__name__
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(name)).strip('_.') or 'connection'
+
+
+class CaptureLog(object):
+    """Binary capture of the raw bytes read from and written to a connection.
+
+    record() is called from the TransportLayer IO thread and only appends to a queue, a background
+    thread does the file IO in batches. Files are rotated once they reach max_bytes, keeping
+    `backups` older files as <name>.1.spcap, <name>.2.spcap ...
+    """
+    def __init__(self, filename, max_bytes = 64 * 1024 * 1024, backups = 3, flush_interval = 0.1):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+
+        self.queue = deque()
+        self.file = None
+        self.file_size = 0
+        self.epoch = time.time() - time.perf_counter()
+
+        self.active = True
+        self.wakeup = Event()
+        self.worker_thread = Thread(target=CaptureLog.process, args=(self,), daemon=True)
+        self.worker_thread.start()
+
+    @classmethod
+    def for_connection(cls, connection, directory = '.', **options):
+        # one file per connection and process so several TransportLayers never share a capture
+        filename = os.path.join(directory, 'capture_{}_{}.spcap'.format(connection_name(connection), os.getpid()))
+        return cls(filename, **options)
+
+    def record(self, direction, data):
+        self.queue.append((time.perf_counter(), direction, bytes(data)))
+
+    def rotated_name(self, index):
+        root, ext = os.path.splitext(self.filename)
+        return '{}.{}{}'.format(root, index, ext)
+
+    def open(self):
+        self.file = open(self.filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.file_size = HEADER.size
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(self.rotated_name(index)):
+                    os.replace(self.rotated_name(index), self.rotated_name(index + 1))
+            os.replace(self.filename, self.rotated_name(1))
+        self.open()
+
+    def write_pending(self):
+        if not len(self.queue):
+            return
+        if self.file is None:
+            self.open()
+
+        chunk = bytearray()
+        while len(self.queue):
+            timestamp, direction, data = self.queue.popleft()
+            size = RECORD.size + len(data)
+            if self.max_bytes and self.file_size + size > self.max_bytes and self.file_size > HEADER.size:
+                self.file.write(chunk)
+                chunk = bytearray()
+                self.rotate()
+            chunk += RECORD.pack(self.epoch + timestamp, direction, len(data))
+            chunk += data
+            self.file_size += size
+        self.file.write(chunk)
+        self.file.flush()
+
+    def process(self):
+        while self.active:
+            self.wakeup.wait(self.flush_interval)
+            try:
+                self.write_pending()
+            except OSError as e:
+                logger.error("capture {} failed: {}".format(self.filename, e))
+                self.queue.clear()
+        self.write_pending()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.active = False
+        self.wakeup.set()
+        self.worker_thread.join()
+
+
+def read_records(filename):
+    # generator over (timestamp, direction, data) for a capture file written by CaptureLog
+    with open(filename, 'rb') as f:
+        magic, version, start = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a SerialPacketStream capture".format(filename))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, length = RECORD.unpack(header)
+            yield (timestamp, Direction(direction), f.read(length))
@@ -0,0 +1,337 @@
+import re
+import sys
+import mmap
+import json
+import argparse
+from array import array
+from bisect import bisect_right
+from operator import sub
+from itertools import accumulate
+from collections import namedtuple, Counter
+
+import SerialPacketStream.FramePacket as FramePacket
+import SerialPacketStream.Checksum as Checksum
+import SerialPacketStream.Capture as Capture
+import SerialPacketStream.ReedSolomon as ReedSolomon
+from SerialPacketStream.TransportLayer import TransportLayerControl
+from SerialPacketStream.FileService import FileService, PacketCode
+
+# The frame start is 0xB5 (0xB6 with extended sync numbers, 0xBD / 0xBE for the same with FEC parity)
+# followed by 0xAC with the packet type in its 2 lsb, the regex engine does the scanning for candidate
+# frames so Python only touches bytes that could start a frame
+FRAME_TOKEN = re.compile(b'[\xb5\xb6\xbd\xbe][\xac-\xaf]')
+EXTENDED_TOKENS = {FramePacket.extended_frame_token_t.TOKEN & 0xFF, FramePacket.extended_fec_frame_token_t.TOKEN & 0xFF}
+FEC_TOKENS = {FramePacket.fec_frame_token_t.TOKEN & 0xFF, FramePacket.extended_fec_frame_token_t.TOKEN & 0xFF}
+
+# struct layouts of the frame headers, responses and footer for bulk decoding
+DATA_HEADER = FramePacket.Data.Header.FORMAT
+EXTENDED_DATA_HEADER = FramePacket.Data.ExtendedHeader.FORMAT
+RESPONSE = FramePacket.Response.FORMAT
+EXTENDED_RESPONSE = FramePacket.ExtendedResponse.FORMAT
+FOOTER = FramePacket.Data.Footer.FORMAT
+
+Frame = namedtuple('Frame', 'offset, timestamp, packet_type, sync, channel, packet_id, payload_size, header_valid, payload_valid, response, extended, fec, corrected')
+
+
+def default_channels():
+    # channel -> (service name, {packet_id: packet name}) for the services example.py attaches
+    control = TransportLayerControl()
+    files = FileService()
+    file_packets = {code.value: code.name for code in PacketCode}
+    file_packets.update({k: v.__name__ for k, v in files.packets.items()})
+    return {
+        0: ('TransportLayerControl', {k: v.__name__ for k, v in control.packets.items()}),
+        1: ('FileService', file_packets),
+    }
+
+
+def decode_frames(stream, timestamps = None):
+    """Generator rebuilding the frame sequence of one direction of a serial stream.
+
+    stream is any buffer (bytes, mmap), timestamps an optional (offsets, times) pair of arrays
+    giving the capture time of the record each stream offset came from.
+    Invalid headers are reported and skipped byte by byte as the receiver would, a frame with a
+    corrupt payload is reported and scanning resumes after its header in case bytes were lost.
+    """
+    view = memoryview(stream)
+    end = len(stream)
+    crc8 = Checksum.crc8
+    crc16 = Checksum.crc16
+    position = 0
+
+    def timestamp(offset):
+        if timestamps is None:
+            return None
+        index = bisect_right(timestamps[0], offset) - 1
+        return timestamps[1][index] if index >= 0 else None
+
+    while True:
+        match = FRAME_TOKEN.search(stream, position)
+        if match is None:
+            return
+        offset = match.start()
+        packet_type = stream[offset + 1] & 0x03
+        extended = stream[offset] in EXTENDED_TOKENS
+        fec = stream[offset] in FEC_TOKENS
+
+        if packet_type == FramePacket.Type.RESPONSE:
+            if fec:
+                # responses never carry parity
+                position = offset + 1
+                continue
+            layout = EXTENDED_RESPONSE if extended else RESPONSE
+            if offset + layout.size > end:
+                return
+            _, response, sync_id, checksum = layout.unpack_from(stream, offset)
+            valid = checksum == crc8(0, view[offset:offset + layout.size - 1])
+            yield Frame(offset, timestamp(offset), packet_type, sync_id, None, None, 0, valid, valid, response, extended, False, 0)
+            position = offset + (layout.size if valid else 1)
+            continue
+
+        layout = EXTENDED_DATA_HEADER if extended else DATA_HEADER
+        if offset + layout.size > end:
+            return
+        _, sync, channel, packet_id, payload_size, checksum = layout.unpack_from(stream, offset)
+        if checksum != crc8(0, view[offset:offset + layout.size - 1]):
+            yield Frame(offset, timestamp(offset), packet_type, sync, channel, packet_id, payload_size, False, False, None, extended, fec, 0)
+            position = offset + 1
+            continue
+
+        payload_valid = True
+        corrected = 0
+        frame_end = offset + layout.size
+        if payload_size:
+            payload_end = frame_end + payload_size
+            parity_size = ReedSolomon.parity_size(payload_size + FOOTER.size) if fec else 0
+            if payload_end + FOOTER.size + parity_size > end:
+                return
+            payload_valid = crc16(0, view[frame_end:payload_end]) == FOOTER.unpack_from(stream, payload_end)[0]
+            if not payload_valid and fec:
+                # repaired on a copy as the receiver would, the capture itself is left as recorded
+                payload = bytearray(view[frame_end:payload_end + FOOTER.size])
+                try:
+                    corrected = ReedSolomon.correct(payload, view[payload_end + FOOTER.size:payload_end + FOOTER.size + parity_size])
+                    payload_valid = crc16(0, payload[:payload_size]) == FOOTER.unpack_from(payload, payload_size)[0]
+                except ValueError:
+                    pass
+            if payload_valid:
+                frame_end = payload_end + FOOTER.size + parity_size
+        yield Frame(offset, timestamp(offset), packet_type, sync, channel, packet_id, payload_size, True, payload_valid, None, extended, fec, corrected)
+        position = frame_end
+
+
+class StreamStatistics(object):
+    def __init__(self, direction, channels = None):
+        self.direction = direction
+        self.channels = default_channels() if channels is None else channels
+        # (channel, packet_id) -> packet_name()
+        self.names = {}
+        self.bytes = 0
+        self.frames = Counter()
+        self.responses = Counter()
+        self.packets = Counter()
+        self.payload_bytes = 0
+        self.header_crc_failures = 0
+        self.payload_crc_failures = 0
+        # frames whose payload crc failed but were repaired from their FEC parity
+        self.fec_corrected = 0
+        self.retransmits = 0
+        self.resyncs = 0
+        self.noise_bytes = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # which sequence numbers have been seen since the last stream synchronisation, sized for
+        # extended sync numbers, frames with 8 bit ones only use the first 256
+        self.seen = bytearray(65536)
+
+    def packet_name(self, channel, packet_id):
+        name = self.names.get((channel, packet_id))
+        if name is None:
+            service, packets = self.channels.get(channel, ('channel {}'.format(channel), {}))
+            name = self.names[(channel, packet_id)] = '{}.{}'.format(service, packets.get(packet_id, 'packet {}'.format(packet_id)))
+        return name
+
+    def add(self, frame, frame_size):
+        if frame.timestamp is not None:
+            self.first_timestamp = frame.timestamp if self.first_timestamp is None else self.first_timestamp
+            self.last_timestamp = frame.timestamp
+
+        if frame.packet_type == FramePacket.Type.RESPONSE:
+            if frame.header_valid:
+                self.frames[FramePacket.Type.RESPONSE.name] += 1
+                self.responses[FramePacket.Response.Type(frame.response).name if frame.response < len(FramePacket.Response.Type) else str(frame.response)] += 1
+            else:
+                self.header_crc_failures += 1
+            return frame.header_valid
+
+        if not frame.header_valid:
+            self.header_crc_failures += 1
+            return False
+        if not frame.payload_valid:
+            self.payload_crc_failures += 1
+            return False
+        if frame.corrected:
+            self.fec_corrected += 1
+
+        self.frames[FramePacket.Type(frame.packet_type).name] += 1
+        self.packets[self.packet_name(frame.channel, frame.packet_id)] += 1
+        self.payload_bytes += frame.payload_size
+
+        if frame.packet_type == FramePacket.Type.DATA_FAF:
+            if frame.channel == 0 and frame.packet_id == 5:
+                # SyncPacket request, both stream states restart from 0
+                self.seen = bytearray(65536)
+        elif self.seen[frame.sync]:
+            self.retransmits += 1
+        else:
+            self.seen[frame.sync] = 1
+            if frame.extended:
+                self.seen[(frame.sync + 32768) & 0xFFFF] = 0
+            else:
+                self.seen[(frame.sync + 128) & 0xFF] = 0
+        return True
+
+    def scan(self, stream, timestamps = None):
+        self.bytes += len(stream)
+        valid_end = 0
+        for frame in decode_frames(stream, timestamps):
+            if frame.packet_type == FramePacket.Type.RESPONSE:
+                size = EXTENDED_RESPONSE.size if frame.extended else RESPONSE.size
+            else:
+                size = (EXTENDED_DATA_HEADER.size if frame.extended else DATA_HEADER.size) + (frame.payload_size + FOOTER.size if frame.payload_size else 0)
+                if frame.fec and frame.payload_size:
+                    size += ReedSolomon.parity_size(frame.payload_size + FOOTER.size)
+            if self.add(frame, size):
+                if frame.offset > valid_end:
+                    self.resyncs += 1
+                    self.noise_bytes += frame.offset - valid_end
+                valid_end = frame.offset + size
+        if len(stream) > valid_end:
+            self.noise_bytes += len(stream) - valid_end
+        return self
+
+    def duration(self):
+        if self.first_timestamp is None or self.last_timestamp is None:
+            return None
+        return self.last_timestamp - self.first_timestamp
+
+    def as_dict(self):
+        duration = self.duration()
+        return {
+            'direction': self.direction,
+            'bytes': self.bytes,
+            'frames': dict(self.frames),
+            'responses': dict(self.responses),
+            'packets': dict(self.packets),
+            'payload_bytes': self.payload_bytes,
+            'header_crc_failures': self.header_crc_failures,
+            'payload_crc_failures': self.payload_crc_failures,
+            'fec_corrected': self.fec_corrected,
+            'retransmits': self.retransmits,
+            'resyncs': self.resyncs,
+            'noise_bytes': self.noise_bytes,
+            'duration': duration,
+            'payload_throughput': self.payload_bytes / duration if duration else None,
+            'line_throughput': self.bytes / duration if duration else None,
+        }
+
+
+def demultiplex(filename):
+    # split a CaptureLog file into one contiguous stream per direction, with the record offsets
+    # and timestamps kept aside so frames can be placed in time. Only the record headers are read
+    # one by one, each direction's data is then copied out of the file in a single join
+    records = {d: (array('Q'), array('Q'), array('d')) for d in Capture.Direction}
+    streams = {}
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as memory:
+        magic, version, start = Capture.HEADER.unpack_from(memory, 0)
+        if magic != Capture.MAGIC:
+            raise ValueError("{} is not a SerialPacketStream capture".format(filename))
+        offset = Capture.HEADER.size
+        end = len(memory)
+        unpack_from = Capture.RECORD.unpack_from
+        while offset + Capture.RECORD.size <= end:
+            timestamp, direction, length = unpack_from(memory, offset)
+            offset += Capture.RECORD.size
+            starts, ends, times = records[direction]
+            starts.append(offset)
+            offset += length
+            ends.append(min(offset, end))
+            times.append(timestamp)
+        with memoryview(memory) as view:
+            for d, (starts, ends, times) in records.items():
+                stream = b''.join(map(view.__getitem__, map(slice, starts, ends)))
+                # stream offset of each record, the running total of the lengths before it
+                offsets = array('Q', accumulate(map(sub, ends, starts), initial = 0))
+                offsets.pop()
+                streams[d] = [stream, offsets, times]
+    return streams
+
+
+def is_capture(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(Capture.MAGIC)) == Capture.MAGIC
+
+
+def analyze(filename, direction = Capture.Direction.IN, channels = None):
+    """Statistics for a capture file, a CaptureLog file gives both directions, anything else is
+    treated as a raw single direction byte log (like the old serial_in.log) and scanned in place"""
+    if is_capture(filename):
+        results = []
+        for d, (stream, offsets, times) in demultiplex(filename).items():
+            results.append(StreamStatistics(d.name, channels).scan(stream, (offsets, times)))
+        return results
+
+    with open(filename, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return [StreamStatistics(direction.name, channels)]
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as memory:
+            return [StreamStatistics(direction.name, channels).scan(memory)]
+
+
+def format_report(filename, statistics):
+    lines = [filename]
+    for s in statistics:
+        d = s.as_dict()
+        lines.append("  {}: {} bytes, {} payload bytes".format(d['direction'], d['bytes'], d['payload_bytes']))
+        if d['duration']:
+            lines.append("    {:.3f}s, {:.1f} KiB/s payload, {:.1f} KiB/s on the line".format(d['duration'], d['payload_throughput'] / 1024, d['line_throughput'] / 1024))
+        lines.append("    frames: {}".format(', '.join('{} {}'.format(k, v) for k, v in sorted(d['frames'].items())) or 'none'))
+        if d['responses']:
+            lines.append("    responses: {}".format(', '.join('{} {}'.format(k, v) for k, v in sorted(d['responses'].items()))))
+        lines.append("    header crc failures {}, payload crc failures {}, fec corrected {}, retransmits {}, resyncs {} ({} noise bytes)".format(
+            d['header_crc_failures'], d['payload_crc_failures'], d['fec_corrected'], d['retransmits'], d['resyncs'], d['noise_bytes']))
+        for name, count in s.packets.most_common():
+            lines.append("      {:>8} {}".format(count, name))
+    return '\n'.join(lines)
+
+
+def dump_frames(filename, out):
+    if is_capture(filename):
+        streams = demultiplex(filename).items()
+    else:
+        with open(filename, 'rb') as f:
+            streams = [(None, (f.read(), None, None))]
+    for d, (stream, offsets, times) in streams:
+        for frame in decode_frames(stream, (offsets, times) if offsets is not None else None):
+            out.write("{} {}\n".format(d.name if d is not None else '', frame))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode and summarise recorded SerialPacketStream captures')
+    parser.add_argument("files", nargs='+', help="CaptureLog files (.spcap) or raw single direction byte logs")
+    parser.add_argument("--direction", default='IN', choices=['IN', 'OUT'], help="direction of raw byte logs")
+    parser.add_argument("--json", action='store_true', help="print machine readable statistics")
+    parser.add_argument("--frames", action='store_true', help="print every decoded frame")
+    args = parser.parse_args()
+
+    report = {}
+    for filename in args.files:
+        if args.frames:
+            dump_frames(filename, sys.stdout)
+        statistics = analyze(filename, Capture.Direction[args.direction])
+        if args.json:
+            report[filename] = [s.as_dict() for s in statistics]
+        else:
+            print(format_report(filename, statistics))
+    if args.json:
+        print(json.dumps(report, indent = 2))
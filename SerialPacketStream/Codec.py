@@ -1,18 +1,63 @@
+import sys
 import struct
+from array import array
 from collections import namedtuple
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import SerialPacketStream.Checksum as Checksum
 
 class basic_type(object):
     pass
 
 class basic_array(object):
-    def __init__(self, datatype, length, default=None):
+    """Array field of a Serializable, length is either constant or the name of the field holding it.
+
+    Arrays of basic_type elements are packed and unpacked in one go rather than element by element and
+    decode to an array.array, or a numpy.ndarray with numpy = True. Any sequence of numbers encodes.
+    """
+    def __init__(self, datatype, length, default=None, numpy=False):
         self.datatype = datatype
         self.length = length
+        self.numpy = numpy
         length = length if isinstance(length, int) else 0
         self.default = [datatype()]*length if default is None else [default]*length
 
+    def primitive(self):
+        return isinstance(self.datatype, type) and issubclass(self.datatype, basic_type)
+
+    def encode(self, value):
+        token = self.datatype.token
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            return numpy.ascontiguousarray(value, dtype = '<' + token).tobytes()
+        if not (isinstance(value, array) and value.typecode == token):
+            value = array(token, value)
+        if sys.byteorder == 'big':
+            value = array(token, value)
+            value.byteswap()
+        return value.tobytes()
+
+    def decode(self, buffer, length):
+        token = self.datatype.token
+        size = self.datatype.size * length
+        if buffer.offset + size > len(buffer.memory):
+            raise struct.error("unpack_from requires a buffer of at least {} bytes for {} {}".format(buffer.offset + size, length, self.datatype.__name__))
+        if self.numpy:
+            if numpy is None:
+                raise ImportError("basic_array(numpy = True) needs numpy installed")
+            # copied out so the array doesn't pin or alias the buffer it was received in
+            value = numpy.frombuffer(buffer.memory, dtype = '<' + token, count = length, offset = buffer.offset).copy()
+        else:
+            value = array(token)
+            value.frombytes(buffer.memory[buffer.offset:buffer.offset + size])
+            if sys.byteorder == 'big':
+                value.byteswap()
+        buffer.offset += size
+        return value
+
 class codec_type(object):
     size = -1
     datatype = None
@@ -147,6 +192,13 @@ class OffsetBuffer(object):
             index += 1
         return -1
 
+def inherited_annotations(cls):
+    # since python 3.10 a class without annotations of its own no longer inherits them, merge them along the mro
+    annotations = {}
+    for base in reversed(cls.__mro__):
+        annotations.update(base.__dict__.get('__annotations__', {}))
+    return annotations
+
 def build_struct_format(cls):
     cls.fmt_list = cls.build_fmt()
     return cls
@@ -155,7 +207,7 @@ class Serializable(object):
     __fullqualname__ = '{}.{}'.format(__module__, __qualname__)
     fmt_list = None
     def __init__(self, *args, **options):
-        type(self).__annotations__ = getattr(type(self), '__annotations__', {})
+        type(self).__annotations__ = inherited_annotations(type(self))
         for i,(k,v) in enumerate(type(self).__annotations__.items()):
             v_type = v if isinstance(v, type) else type(v)
             default_val = getattr(type(self), k, None)
@@ -175,13 +227,14 @@ class Serializable(object):
 
     @classmethod
     def build_fmt(cls):
+        cls.__annotations__ = inherited_annotations(cls)
         def value_to_tokens(key, value):
             v_type = value if isinstance(value, type) else type(value)
             if issubclass(v_type, basic_type):
                 return (value.token)
             elif v_type is basic_array:
                 constant = True if isinstance(value.length, int) else False
-                token = value.datatype.token if issubclass(v_type, basic_type) else ''
+                token = value.datatype.token if value.primitive() else ''
                 return fmt_block(value, struct.calcsize(token), value.length, constant)
             elif issubclass(v_type, Serializable) or issubclass(v_type, codec_type):
                 return (cls.__annotations__.get(key))
@@ -214,6 +267,8 @@ class Serializable(object):
         def pack_value(datatype, value):
             if isinstance(value, Serializable):
                 return bytes(value)
+            elif isinstance(datatype, basic_array) and datatype.primitive():
+                return datatype.encode(value)
             elif isinstance(datatype, basic_array):
                 buf = bytearray()
                 for v in value:
@@ -233,35 +288,72 @@ class Serializable(object):
     @classmethod
     def from_offsetbuffer(cls, buffer):
         #todo: format list can be compressed for all constant groups, posibly recursivly
-        cls.fmt_list = cls.build_fmt() if cls.fmt_list == None else cls.fmt_list
+        # the format list is cached per class, a subclass must not pick up its parents
+        cls.fmt_list = cls.build_fmt() if cls.__dict__.get('fmt_list') is None else cls.fmt_list
         args = []
-
-        def unpack_value(value):
-            if isinstance(value, type) and issubclass(value, Serializable):
-                return (value.from_offsetbuffer(buffer),)
-            elif isinstance(value, fmt_block) and isinstance(value.datatype, struct.Struct):
-                ret = value.datatype.unpack_from(buffer.memory, buffer.offset)
-                buffer.offset += value.size
-                return ret
-            elif isinstance(value, fmt_block) and isinstance(value.datatype, basic_array):
-                length = value.length
-                if isinstance(length, str):
-                    length = args[list(cls.__annotations__.keys()).index(length)]
-                return ([unpack_value(value.datatype.datatype)[0] for _ in range(length)],)
-            elif isinstance(value, type) and issubclass(value, codec_type):
-                return (value.decode(buffer),)
-            elif isinstance(value, type) and issubclass(value, basic_type):
-                ret = struct.unpack_from('<' + value.token, buffer.memory, buffer.offset)
-                buffer.offset += value.size
-                return ret
-            else:
-                raise(RuntimeError("unpack_value", value))
-
         for l in cls.fmt_list:
-            args.extend(unpack_value(l))
+            args.extend(cls.unpack_value(l, buffer, args))
 
         return cls(*args)
 
+    # not a closure inside from_offsetbuffer, a recursive closure is a reference cycle and every
+    # decoded packet would leave one behind for the garbage collector
+    @classmethod
+    def unpack_value(cls, value, buffer, args):
+        if isinstance(value, type) and issubclass(value, Serializable):
+            return (value.from_offsetbuffer(buffer),)
+        elif isinstance(value, fmt_block) and isinstance(value.datatype, struct.Struct):
+            ret = value.datatype.unpack_from(buffer.memory, buffer.offset)
+            buffer.offset += value.size
+            return ret
+        elif isinstance(value, fmt_block) and isinstance(value.datatype, basic_array):
+            length = value.length
+            if isinstance(length, str):
+                length = args[list(cls.__annotations__.keys()).index(length)]
+            if value.datatype.primitive():
+                return (value.datatype.decode(buffer, length),)
+            return ([cls.unpack_value(value.datatype.datatype, buffer, args)[0] for _ in range(length)],)
+        elif isinstance(value, type) and issubclass(value, codec_type):
+            return (value.decode(buffer),)
+        elif isinstance(value, type) and issubclass(value, basic_type):
+            ret = struct.unpack_from('<' + value.token, buffer.memory, buffer.offset)
+            buffer.offset += value.size
+            return ret
+        else:
+            raise(RuntimeError("unpack_value", value))
+
+    @classmethod
+    def numpy_dtype(cls):
+        """NumPy structured dtype laid out as the encoded class, only for classes of fixed size fields"""
+        if numpy is None:
+            raise ImportError("Serializable.numpy_dtype needs numpy installed")
+        fields = []
+        for k, v in inherited_annotations(cls).items():
+            v_type = v if isinstance(v, type) else type(v)
+            if issubclass(v_type, basic_type):
+                fields.append((k, '<' + v.token))
+            elif v_type is basic_array and v.primitive() and isinstance(v.length, int):
+                fields.append((k, '<' + v.datatype.token, (v.length,)))
+            elif issubclass(v_type, Serializable):
+                fields.append((k, v.numpy_dtype()))
+            elif issubclass(v_type, codec_type) and getattr(v, 'fmt', None) is not None:
+                fields.append((k, v.fmt.format))
+            else:
+                raise TypeError("{}.{} has no fixed size, the class can't be decoded as a NumPy record".format(cls.__name__, k))
+        return numpy.dtype(fields)
+
+    @classmethod
+    def decode_batch(cls, payloads):
+        """Decode a sequence of encoded payloads of this class in one go into a NumPy structured array
+        of numpy_dtype(), one record per payload"""
+        dtype = cls.numpy_dtype()
+        data = bytearray()
+        for index, payload in enumerate(payloads):
+            if len(payload) != dtype.itemsize:
+                raise ValueError("payload {} is {} bytes, {} encodes to {}".format(index, len(payload), cls.__name__, dtype.itemsize))
+            data += payload
+        return numpy.frombuffer(data, dtype = dtype)
+
     def make_tuple(self):
         self.update_auto_variables()
         name = type(self).__name__
@@ -0,0 +1,70 @@
+import SerialPacketStream.Checksum as Checksum
+
+import logging
+logger = logging.getLogger('default')
+
+# rsync style delta of a new file against the copy the remote already has. The remote sends a signature
+# of its copy, a weak rolling checksum and a crc32 of every block_size block, the host slides a block
+# sized window over the new file a byte at a time looking the weak checksum up and confirming a hit with
+# the crc32, everything between matched blocks is sent as literal data
+
+def weak(data):
+    """rsync rolling checksum, low 16 bits the sum of the bytes and high 16 bits the sum of the running sums"""
+    a = b = 0
+    for x in data:
+        a += x
+        b += a
+    return (a & 0xFFFF) | (b & 0xFFFF) << 16
+
+def strong(data):
+    return Checksum.crc32(0, data)
+
+def signature(data, block_size):
+    """([weak], [strong]) per block_size block of data, the last block may be short"""
+    blocks = [data[x:x + block_size] for x in range(0, len(data), block_size)]
+    return [weak(x) for x in blocks], [strong(x) for x in blocks]
+
+def delta(data, weaks, strongs, block_size):
+    """Instructions rebuilding data from the file the signature was taken of, [(offset, length, basis)] in
+    order, length bytes of data from offset are copied from basis in the old file, or sent as they are
+    when basis is None. Only whole blocks are matched, a short last block of the old file never is"""
+    table = {}
+    for index, (w, s) in enumerate(zip(weaks, strongs)):
+        table.setdefault(w, {}).setdefault(s, index)
+
+    ops = []
+    def copy(offset, basis):
+        # runs of consecutive blocks become one copy
+        if ops and ops[-1][2] is not None and ops[-1][0] + ops[-1][1] == offset and ops[-1][2] + ops[-1][1] == basis:
+            ops[-1] = (ops[-1][0], ops[-1][1] + block_size, ops[-1][2])
+        else:
+            ops.append((offset, block_size, basis))
+
+    length = len(data)
+    literal = 0
+    i = 0
+    checksum = weak(data[0:block_size]) if length >= block_size else 0
+    a, b = checksum & 0xFFFF, checksum >> 16
+    while i + block_size <= length:
+        candidates = table.get(a | b << 16)
+        if candidates is not None:
+            index = candidates.get(strong(data[i:i + block_size]))
+            if index is not None:
+                if literal < i:
+                    ops.append((literal, i - literal, None))
+                copy(i, index * block_size)
+                i += block_size
+                literal = i
+                if i + block_size <= length:
+                    checksum = weak(data[i:i + block_size])
+                    a, b = checksum & 0xFFFF, checksum >> 16
+                continue
+        if i + block_size < length:
+            # roll the window on a byte
+            out = data[i]
+            a = (a - out + data[i + block_size]) & 0xFFFF
+            b = (b - block_size * out + a) & 0xFFFF
+        i += 1
+    if literal < length:
+        ops.append((literal, length - literal, None))
+    return ops
@@ -0,0 +1,509 @@
+import os
+import math
+import time
+import random
+import tempfile
+from collections import deque
+from threading import Lock
+
+from SerialPacketStream import TransportLayer, Service, ServicePacket, FramePacket
+from SerialPacketStream.FileService import PacketCode, QueryPacket, ActionResponsePacket, FileOpenPacket, FileResumePacket, FileInfoPacket, FileActionPacket, FileDataPacket
+from SerialPacketStream.FileService import FileSignatureRequestPacket, FileSignaturePacket, FileDeltaPacket, FileCopyPacket
+from SerialPacketStream.StreamService import StreamService, StreamDataPacket
+import SerialPacketStream.Checksum as Checksum
+import SerialPacketStream.Delta as Delta
+
+import logging
+logger = logging.getLogger('default')
+
+
+class EmulatedLink(object):
+    """One direction of an emulated serial line.
+
+    Bytes written are paced at 10 bits per byte for the baud rate of the writing end, delayed by a
+    fixed latency and optionally corrupted or dropped before becoming readable on the other end.
+    Bytes read at a different baud rate than they were written at, or written faster than
+    max_baudrate, arrive as garbage the same as on a real UART.
+    When buffer_size is set bytes that arrive while the receive buffer is full are lost, the same
+    as a microcontroller ring buffer overflowing while the firmware is busy.
+    """
+    def __init__(self, latency = 0.0, bit_error_rate = 0.0, drop_rate = 0.0, buffer_size = None, max_baudrate = None, seed = None):
+        self.lock = Lock()
+        self.latency = latency
+        self.max_baudrate = max_baudrate
+        self.buffer_size = buffer_size
+        self.random = random.Random(seed)
+        self.set_error_rates(bit_error_rate, drop_rate)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.in_flight = deque()   # (ready_time, bytes, baudrate)
+            self.buffer = bytearray()
+            self.wire_free = 0.0
+            self.bytes_written = 0
+            self.bytes_corrupted = 0
+            self.bytes_dropped = 0
+            self.bytes_overflowed = 0
+            self.bytes_garbled = 0
+
+    def set_error_rates(self, bit_error_rate = 0.0, drop_rate = 0.0):
+        self.bit_error_rate = bit_error_rate
+        self.drop_rate = drop_rate
+        # probability of a byte having at least one flipped bit
+        self.byte_error_rate = 1.0 - (1.0 - bit_error_rate) ** 8
+        self.next_error = self.next_event(self.byte_error_rate)
+        self.next_drop = self.next_event(self.drop_rate)
+
+    def next_event(self, probability):
+        # geometric distribution, number of clean bytes until the next fault
+        if probability <= 0.0:
+            return math.inf
+        if probability >= 1.0:
+            return 0
+        return int(math.log(1.0 - self.random.random()) / math.log(1.0 - probability))
+
+    def inject_faults(self, data):
+        if self.next_error >= len(data) and self.next_drop >= len(data):
+            self.next_error -= len(data)
+            self.next_drop -= len(data)
+            return data
+
+        data = bytearray(data)
+        index = self.next_error
+        while index < len(data):
+            data[index] ^= 1 << self.random.randrange(8)
+            self.bytes_corrupted += 1
+            index += 1 + self.next_event(self.byte_error_rate)
+        self.next_error = index - len(data)
+
+        dropped = []
+        index = self.next_drop
+        while index < len(data):
+            dropped.append(index)
+            self.bytes_dropped += 1
+            index += 1 + self.next_event(self.drop_rate)
+        self.next_drop = index - len(data)
+        for index in reversed(dropped):
+            del data[index]
+        return bytes(data)
+
+    def write(self, data, baudrate = None):
+        now = time.perf_counter()
+        with self.lock:
+            self.bytes_written += len(data)
+            if baudrate:
+                start = max(now, self.wire_free)
+                self.wire_free = start + len(data) * 10.0 / baudrate
+                ready = self.wire_free + self.latency
+            else:
+                ready = now + self.latency
+            data = self.inject_faults(bytes(data))
+            if len(data):
+                if self.max_baudrate is not None and baudrate is not None and baudrate > self.max_baudrate:
+                    # the line can't carry it, the receiver sees noise whatever its rate
+                    baudrate = -1
+                self.in_flight.append((ready, data, baudrate))
+        return len(data)
+
+    def garble(self, data):
+        self.bytes_garbled += len(data)
+        return bytes(self.random.randrange(256) for _ in range(len(data)))
+
+    def settle(self, baudrate = None):
+        # move everything that has finished arriving into the receive buffer
+        now = time.perf_counter()
+        while len(self.in_flight) and self.in_flight[0][0] <= now:
+            _, data, written_baudrate = self.in_flight.popleft()
+            if written_baudrate != baudrate:
+                data = self.garble(data)
+            if self.buffer_size is not None:
+                space = self.buffer_size - len(self.buffer)
+                if len(data) > space:
+                    self.bytes_overflowed += len(data) - max(space, 0)
+                    data = data[:max(space, 0)]
+            self.buffer += data
+
+    def in_waiting(self, baudrate = None):
+        with self.lock:
+            self.settle(baudrate)
+            return len(self.buffer)
+
+    def read(self, size, baudrate = None):
+        with self.lock:
+            self.settle(baudrate)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+    def readinto(self, buffer, baudrate = None):
+        with self.lock:
+            self.settle(baudrate)
+            size = min(len(buffer), len(self.buffer))
+            with memoryview(self.buffer) as view:
+                buffer[:size] = view[:size]
+            del self.buffer[:size]
+            return size
+
+
+class EmulatedConnection(object):
+    """A pyserial like endpoint over a pair of EmulatedLinks, usable as the TransportLayer connection.
+
+    Each end has its own baud rate, None leaves the link unpaced, and both have to agree for data to
+    get through.
+    """
+    def __init__(self, rx_link, tx_link, name = 'emulated', baudrate = None):
+        self.rx_link = rx_link
+        self.tx_link = tx_link
+        self.name = name
+        self.baudrate = baudrate
+        self.is_open = True
+        self.dropped = False
+        self.on_open = None
+
+    def __str__(self):
+        return "EmulatedConnection({})".format(self.name)
+
+    def check(self):
+        if self.dropped or not self.is_open:
+            raise OSError("{} is not connected".format(self))
+
+    @property
+    def in_waiting(self):
+        self.check()
+        return self.rx_link.in_waiting(self.baudrate)
+
+    def read(self, size = 1):
+        self.check()
+        return self.rx_link.read(size, self.baudrate)
+
+    def readinto(self, buffer):
+        self.check()
+        return self.rx_link.readinto(buffer, self.baudrate)
+
+    def write(self, data):
+        self.check()
+        return self.tx_link.write(data, self.baudrate)
+
+    def drop(self):
+        # emulate the device disappearing (USB glitch), IO fails until the port is reopened
+        self.dropped = True
+
+    def open(self):
+        if self.dropped:
+            self.rx_link.reset()
+            self.tx_link.reset()
+            self.dropped = False
+            if self.on_open is not None:
+                self.on_open()
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def flush(self):
+        pass
+
+
+class EmulatedFileService(Service):
+    """Remote side of the FileService protocol backed by a local directory"""
+    def __init__(self, root, write_latency = 0.0):
+        super().__init__()
+        self.root = root
+        self.cwd = '/'
+        self.file = None
+        self.request = None
+        # FileSignaturePackets still to send
+        self.signature = deque()
+        # (old file, path, size, checksum) while a file is being rebuilt from a delta, self.file is then
+        # the new one written next to it
+        self.delta = None
+        self.write_latency = write_latency
+        self.block_size = 64
+
+        self.register_packet(QueryPacket)
+        self.register_packet(FileOpenPacket, PacketCode.OPEN)
+        self.register_packet(FileOpenPacket, PacketCode.REQUEST)
+        self.register_packet(FileResumePacket, PacketCode.RESUME)
+        self.register_packet(FileResumePacket, PacketCode.REQUEST_RESUME)
+        self.register_packet(FileDataPacket)
+        self.register_packet(FileActionPacket, PacketCode.CD)
+        self.register_packet(FileSignatureRequestPacket)
+        self.register_packet(FileDeltaPacket)
+        self.register_packet(FileCopyPacket)
+        for code in (PacketCode.CLOSE, PacketCode.ABORT, PacketCode.LIST, PacketCode.PWD, PacketCode.MOUNT, PacketCode.UNMOUNT):
+            self.register_packet(ServicePacket, code)
+
+        self.handlers = {
+            PacketCode.QUERY : self.handle_query,
+            PacketCode.OPEN : self.handle_open,
+            PacketCode.REQUEST : self.handle_request,
+            PacketCode.RESUME : self.handle_resume,
+            PacketCode.REQUEST_RESUME : self.handle_request,
+            PacketCode.WRITE : self.handle_write,
+            PacketCode.CLOSE : self.handle_close,
+            PacketCode.ABORT : self.handle_abort,
+            PacketCode.LIST : self.handle_list,
+            PacketCode.CD : self.handle_cd,
+            PacketCode.PWD : self.handle_pwd,
+            PacketCode.MOUNT : self.handle_action,
+            PacketCode.UNMOUNT : self.handle_action,
+            PacketCode.SIGNATURE : self.handle_signature,
+            PacketCode.DELTA : self.handle_delta,
+            PacketCode.COPY : self.handle_copy,
+        }
+
+    def path(self, filename):
+        path = os.path.normpath(os.path.join(self.cwd, filename))
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def respond(self, code):
+        self.send_packet(ActionResponsePacket(code = code))
+
+    def dispatch(self, packet):
+        # the remote handles packets immediately on the IO thread the same way the firmware does
+        self.handlers[packet._frame_packet.header.packet_id](packet)
+
+    def update(self):
+        # stream the requested file or signature out a few blocks at a time
+        if len(self.tx_queue) > 4:
+            return
+        if len(self.signature):
+            self.send_packet(self.signature.popleft())
+            return
+        if self.request is None:
+            return
+        data = self.request.read(self.block_size)
+        self.send_packet(FileDataPacket(data = bytearray(data)))
+        if len(data) < self.block_size:
+            self.request.close()
+            self.request = None
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.delta is not None:
+            # an unfinished delta leaves the old file as it was
+            self.delta[0].close()
+            os.remove(self.delta[1] + '.delta')
+            self.delta = None
+
+    def finish_delta(self):
+        basis, path, size, checksum = self.delta
+        self.file.close()
+        self.file = None
+        with open(path + '.delta', 'rb') as f:
+            data = f.read()
+        if len(data) != size or Checksum.crc32(0, data) != checksum:
+            logger.warning("EmulatedFileService delta of \'{}\' doesn't match, keeping the old file".format(path))
+            return False
+        basis.close()
+        self.delta = None
+        os.replace(path + '.delta', path)
+        return True
+
+    def handle_query(self, packet):
+        self.send_packet(QueryPacket(version_major = 0, version_minor = 1, version_patch = 0))
+
+    def handle_action(self, packet):
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_open(self, packet):
+        self.close_file()
+        try:
+            self.file = open(os.devnull if packet.dummy else self.path(packet.filename), 'wb')
+        except OSError:
+            return self.respond(ActionResponsePacket.Code.IOERROR)
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_resume(self, packet):
+        self.close_file()
+        try:
+            if packet.dummy:
+                # a dummy upload has nothing to go back to, the null device can't be truncated
+                self.file = open(os.devnull, 'wb')
+            else:
+                path = self.path(packet.filename)
+                self.file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+                self.file.seek(packet.offset)
+                self.file.truncate()
+        except OSError:
+            return self.respond(ActionResponsePacket.Code.IOERROR)
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_request(self, packet):
+        if self.request is not None:
+            self.request.close()
+            self.request = None
+        try:
+            request = open(self.path(packet.filename), 'rb')
+            request.seek(getattr(packet, 'offset', 0))
+        except OSError:
+            return self.respond(ActionResponsePacket.Code.IOERROR)
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+        self.request = request
+
+    def handle_write(self, packet):
+        if self.file is None:
+            return
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        self.file.write(packet.data)
+
+    def handle_close(self, packet):
+        if self.file is None:
+            return self.respond(ActionResponsePacket.Code.FAIL)
+        if self.delta is not None and not self.finish_delta():
+            self.close_file()
+            return self.respond(ActionResponsePacket.Code.FAIL)
+        self.close_file()
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_abort(self, packet):
+        if self.delta is not None:
+            self.close_file()
+        if self.file is not None:
+            name = self.file.name
+            self.close_file()
+            if name != os.devnull:
+                os.remove(name)
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_signature(self, packet):
+        try:
+            with open(self.path(packet.filename), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return self.respond(ActionResponsePacket.Code.IOERROR)
+        if packet.block_size == 0:
+            return self.respond(ActionResponsePacket.Code.INVALID)
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+        weak, strong = Delta.signature(data, packet.block_size)
+        # as many blocks to a packet as fit the block size, the fixed fields take 10 bytes
+        count = max(1, (self.max_block_size() - 10) // 8)
+        self.signature.clear()
+        for index in range(0, len(weak), count):
+            self.signature.append(FileSignaturePacket(index = index, size = len(data), weak = weak[index:index + count], strong = strong[index:index + count]))
+        self.signature.append(FileSignaturePacket(index = len(weak), size = len(data), weak = [], strong = []))
+
+    def handle_delta(self, packet):
+        self.close_file()
+        path = self.path(packet.filename)
+        try:
+            basis = open(path, 'rb')
+        except OSError:
+            return self.respond(ActionResponsePacket.Code.IOERROR)
+        try:
+            self.file = open(path + '.delta', 'wb')
+        except OSError:
+            basis.close()
+            return self.respond(ActionResponsePacket.Code.IOERROR)
+        self.delta = (basis, path, packet.size, packet.checksum)
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_copy(self, packet):
+        if self.delta is None or self.file is None:
+            return
+        basis = self.delta[0]
+        basis.seek(packet.offset)
+        self.file.write(basis.read(packet.length))
+
+    def handle_list(self, packet):
+        path = self.path('')
+        for index, name in enumerate(sorted(os.listdir(path))):
+            full = os.path.join(path, name)
+            folder = os.path.isdir(full)
+            self.send_packet(FileInfoPacket(index = index, meta = FileInfoPacket.Meta.FOLDER if folder else FileInfoPacket.Meta.FILE,
+                size = 0 if folder else os.path.getsize(full), filename = name))
+        self.send_packet(FileInfoPacket(meta = FileInfoPacket.Meta.EOL))
+
+    def handle_cd(self, packet):
+        cwd = os.path.normpath(os.path.join(self.cwd, packet.filename))
+        if not os.path.isdir(os.path.join(self.root, cwd.lstrip('/'))):
+            return self.respond(ActionResponsePacket.Code.FAIL)
+        self.cwd = cwd
+        self.respond(ActionResponsePacket.Code.SUCCESS)
+
+    def handle_pwd(self, packet):
+        self.send_packet(FileInfoPacket(meta = FileInfoPacket.Meta.FOLDER, filename = self.cwd))
+
+
+class EmulatedStreamService(StreamService):
+    """Remote end of a StreamService that echoes everything it receives back"""
+    def update(self):
+        # a packet at a time while the queue is short, a host not reading the echo fills this end up
+        # and has its frames refused in turn
+        if len(self.tx_queue) > 4:
+            return
+        packet = self.promise.next()
+        if packet is not None:
+            self.send_packet(StreamDataPacket(data = packet.data))
+
+
+class EmulatedRemote(TransportLayer):
+    """The device end of the link, a TransportLayer answering as Marlin would with a FileService on channel 1
+    and an echoing StreamService on channel 2"""
+    def __init__(self, connection, root, serial_buffer_size = 512, payload_buffer_size = 512, write_latency = 0.0, baudrates = ()):
+        self.serial_buffer_size = serial_buffer_size
+        self.payload_buffer_size = payload_buffer_size
+        self.baudrates = baudrates
+        self.file_service = EmulatedFileService(root, write_latency)
+        self.stream_service = EmulatedStreamService()
+        super().__init__(connection, payload_buffer_size)
+        self.attach(1, self.file_service)
+        self.attach(2, self.stream_service)
+
+    def process_transmit(self):
+        self.file_service.update()
+        self.stream_service.update()
+        super().process_transmit()
+        # real hardware runs in parallel with the host, yield the GIL every iteration so a busy
+        # remote doesn't hold up the host threads for a whole interpreter switch interval
+        time.sleep(0)
+
+
+class Emulator(object):
+    """In process stand in for a Marlin board running the binary protocol.
+
+    emulator = Emulator(baudrate = 250000, bit_error_rate = 1e-5)
+    transport_layer = TransportLayer(emulator.connection, 512)
+
+    The remote agrees to switch to any of `baudrates`, max_baudrate is the fastest the emulated
+    line actually carries so a failed upgrade can be tried out. With aggregate the remote packs its
+    small replies into shared frames once the host advertises support for it, with fec it sends its
+    frames with Reed-Solomon parity the same way.
+    """
+    BAUDRATES = (115200, 250000, 500000, 1000000, 2000000)
+
+    def __init__(self, baudrate = None, latency = 0.0, bit_error_rate = 0.0, drop_rate = 0.0,
+                 serial_buffer_size = 512, payload_buffer_size = 512, write_latency = 0.0, rx_buffer_size = None, root = None, seed = None,
+                 baudrates = BAUDRATES, max_baudrate = None, aggregate = False, fec = False):
+        self.tempdir = tempfile.TemporaryDirectory(prefix = 'SerialPacketStream') if root is None else None
+        self.root = self.tempdir.name if root is None else root
+
+        seed = random.randrange(2**32) if seed is None else seed
+        self.host_to_remote = EmulatedLink(latency, bit_error_rate, drop_rate, rx_buffer_size, max_baudrate, seed = seed)
+        self.remote_to_host = EmulatedLink(latency, bit_error_rate, drop_rate, max_baudrate = max_baudrate, seed = seed + 1)
+
+        self.connection = EmulatedConnection(self.remote_to_host, self.host_to_remote, 'host', baudrate)
+        self.remote_connection = EmulatedConnection(self.host_to_remote, self.remote_to_host, 'remote', baudrate)
+        self.connection.on_open = self.remote_reset
+
+        self.remote = EmulatedRemote(self.remote_connection, self.root, serial_buffer_size, payload_buffer_size, write_latency, baudrates)
+        if aggregate:
+            self.remote.start_aggregation()
+        self.remote.fec = fec
+
+    def remote_reset(self):
+        # the firmware drops any partially received frame when the host reopens the port
+        self.remote.rx_stream.reset_packet()
+
+    def set_error_rates(self, bit_error_rate = 0.0, drop_rate = 0.0):
+        self.host_to_remote.set_error_rates(bit_error_rate, drop_rate)
+        self.remote_to_host.set_error_rates(bit_error_rate, drop_rate)
+
+    def shutdown(self):
+        self.remote.shutdown()
+        if self.tempdir is not None:
+            self.tempdir.cleanup()
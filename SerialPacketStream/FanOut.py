@@ -0,0 +1,124 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import SerialPacketStream.Checksum as Checksum
+
+import logging
+logger = logging.getLogger('default')
+
+# outcome of one printer's upload, written is the offset up to which the remote acknowledged every
+# block and error the exception that ended it, if any
+Result = namedtuple('Result', 'service, ok, written, error')
+
+
+class SharedUpload(object):
+    """A file's contents cut into payload blocks once for any number of FileService.write calls.
+
+    Each printer writes through its own reader(). write() asks it for the block at each offset with
+    its current max_block_size(), the first call for an (offset, size) slices and crc16s it and every
+    later one gets the same immutable bytes and checksum back, so printers with the same block size
+    share them all. A resume after a reconnect only goes back to the reader's checkpoint, write()
+    releases up to there as the remote acknowledges it and a block is evicted once every open reader
+    has released past its offset, only the blocks between the slowest and the fastest printer are held.
+    """
+    class Reader(object):
+        def __init__(self, upload):
+            self.upload = upload
+            self.checkpoint = 0
+
+        def __len__(self):
+            return len(self.upload)
+
+        def block(self, offset, size):
+            return self.upload.block(offset, size)
+
+        def release(self, offset):
+            # nothing before offset is asked for again
+            self.checkpoint = offset
+            self.upload.evict()
+
+        def close(self):
+            self.upload.close(self)
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        # (offset, size) -> (bytes, crc16)
+        self.blocks = {}
+        self.readers = []
+        self.lock = Lock()
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls(f.read())
+
+    def __len__(self):
+        return len(self.data)
+
+    def reader(self):
+        reader = SharedUpload.Reader(self)
+        with self.lock:
+            self.readers.append(reader)
+        return reader
+
+    def close(self, reader):
+        with self.lock:
+            self.readers.remove(reader)
+        self.evict()
+
+    def block(self, offset, size):
+        key = (offset, size)
+        block = self.blocks.get(key)
+        if block is None:
+            data = self.data[offset:offset + size]
+            checksum = Checksum.crc16(0, data)
+            # two workers may cut the same block at once, setdefault keeps whichever was first
+            with self.lock:
+                block = self.blocks.setdefault(key, (data, checksum))
+        return block
+
+    def evict(self):
+        with self.lock:
+            released = min((x.checkpoint for x in self.readers), default = len(self))
+            for key in [x for x in self.blocks if x[0] < released]:
+                del self.blocks[key]
+
+
+def put(services, src, dst = None, compression = False, dummy = False, progress = None, executor = None):
+    """FileService.put of one file to every FileService in services at the same time.
+
+    The file is read once into a SharedUpload and each service uploads it from its own worker thread,
+    a service that fails or raises doesn't affect the others. progress, if given, is a sequence of
+    FileService.put progress generators in the same order as services. Returns a Result per service
+    in that order.
+    """
+    if dst is None:
+        dst = src
+    upload = SharedUpload.from_file(src)
+    services = list(services)
+    progress = [None] * len(services) if progress is None else list(progress)
+
+    def put_one(service, reader, service_progress):
+        try:
+            if not service.open(dst, compression = compression, dummy = dummy):
+                return Result(service, False, 0, None)
+            written = service.write(reader, progress = service_progress)
+            closed = service.close()
+            return Result(service, closed and written == len(upload), written, None)
+        except Exception as e:
+            logger.error("FanOut.put '{}' to {} failed: {}".format(dst, service, e))
+            return Result(service, False, 0, e)
+        finally:
+            reader.close()
+
+    owned = executor is None
+    executor = ThreadPoolExecutor(max_workers = max(len(services), 1), thread_name_prefix = 'fanout') if owned else executor
+    try:
+        # every reader is opened before any upload starts so none of the blocks are evicted early
+        readers = [upload.reader() for _ in services]
+        futures = [executor.submit(put_one, service, reader, p) for service, reader, p in zip(services, readers, progress)]
+        return [future.result() for future in futures]
+    finally:
+        if owned:
+            executor.shutdown()
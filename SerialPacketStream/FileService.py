@@ -4,6 +4,8 @@ import time
 
 from SerialPacketStream import Service, ServicePacket, ServicePacketListener, RawDataPacket, FramePacket
 import SerialPacketStream.Codec as Codec
+import SerialPacketStream.Checksum as Checksum
+import SerialPacketStream.Delta as Delta
 
 import logging
 logger = logging.getLogger('default')
@@ -22,7 +24,12 @@ PacketCode = IntEnum('ActionCode',
      'PWD',
      'FILE',
      'MOUNT',
-     'UNMOUNT'], start = 0)
+     'UNMOUNT',
+     'RESUME',
+     'REQUEST_RESUME',
+     'SIGNATURE',
+     'DELTA',
+     'COPY'], start = 0)
 
 
 class QueryPacket(ServicePacket):
@@ -56,6 +63,15 @@ class FileOpenPacket(ServicePacket):
     filename : Codec.cstring
 
 
+class FileResumePacket(ServicePacket):
+    packet_id = PacketCode.RESUME
+
+    dummy : Codec.uint8_t
+    compression : Codec.uint8_t
+    offset : Codec.uint32_t
+    filename : Codec.cstring
+
+
 class FileInfoPacket(ServicePacket):
     Meta = IntEnum( 'Meta',
         ['FOLDER',
@@ -78,6 +94,157 @@ class FileDataPacket(RawDataPacket):
     packet_id = PacketCode.WRITE
 
 
+class FileSignatureRequestPacket(ServicePacket):
+    packet_id = PacketCode.SIGNATURE
+
+    block_size : Codec.uint16_t
+    filename : Codec.cstring
+
+
+class FileSignaturePacket(ServicePacket):
+    # Delta checksums of count blocks of the remote file from block index on, the remote sends as many
+    # of these as its blocks need followed by one with count 0
+    packet_id = PacketCode.SIGNATURE
+
+    index : Codec.uint32_t
+    size : Codec.uint32_t
+    count : Codec.uint16_t
+    weak : Codec.basic_array(Codec.uint32_t, 'count')
+    strong : Codec.basic_array(Codec.uint32_t, 'count')
+
+
+class FileDeltaPacket(ServicePacket):
+    # opens filename to be rebuilt from its current content by COPY and WRITE packets, the remote only
+    # replaces the file on CLOSE once the result matches size and crc32 checksum
+    packet_id = PacketCode.DELTA
+
+    size : Codec.uint32_t
+    checksum : Codec.uint32_t
+    filename : Codec.cstring
+
+
+class FileCopyPacket(ServicePacket):
+    # append length bytes from offset of the file being rebuilt
+    packet_id = PacketCode.COPY
+
+    offset : Codec.uint32_t
+    length : Codec.uint32_t
+
+
+class FileBatch(object):
+    """FileService commands sent back to back, the remote works through a channel's packets in order and
+    answers each in turn so the n-th response of a kind belongs to the n-th command expecting one.
+
+    results = file_service.batch().mount().cd('gcodes').open('part.g').write(data).close().run()
+
+    Every command is sent whatever the ones before it return, run() gives back one result per command as
+    the blocking FileService methods would, True / False for actions, the directory for pwd() and the
+    bytes queued for write(). Commands left unanswered when the link drops or timeout passes are None.
+    """
+    def __init__(self, service):
+        self.service = service
+        # [(packets, response class or None, result(response))]
+        self.commands = []
+        # the transport layer's reconnect count when run() started sending
+        self.reconnects = None
+
+    def add(self, packets, response_cls, result):
+        self.commands.append((packets, response_cls, result))
+        return self
+
+    def action(self, packet, name):
+        def result(response):
+            if response.code != ActionResponsePacket.Code.SUCCESS:
+                logger.warning("FileBatch.{} returned error code: {}".format(name, response.code))
+                return False
+            return True
+        return self.add([packet], ActionResponsePacket, result)
+
+    def mount(self):
+        return self.action(ServicePacket(packet_id = PacketCode.MOUNT), 'mount')
+
+    def unmount(self):
+        return self.action(ServicePacket(packet_id = PacketCode.UNMOUNT), 'unmount')
+
+    def cd(self, filename):
+        return self.action(FileActionPacket(packet_id = PacketCode.CD, filename = filename), 'cd({})'.format(filename))
+
+    def open(self, filename, compression = False, dummy = False):
+        return self.action(FileOpenPacket(filename = filename, compression = compression, dummy = dummy), 'open({})'.format(filename))
+
+    def close(self):
+        return self.action(ServicePacket(packet_id = PacketCode.CLOSE), 'close')
+
+    def abort(self):
+        return self.action(ServicePacket(packet_id = PacketCode.ABORT), 'abort')
+
+    def pwd(self):
+        return self.add([ServicePacket(packet_id = PacketCode.PWD)], FileInfoPacket, lambda response: response.filename)
+
+    def write(self, data):
+        # cut when run() sends it, the block size may change before then
+        return self.add(data, None, None)
+
+    def send(self, packets):
+        service = self.service
+        if isinstance(packets, list):
+            for packet in packets:
+                service.send_packet(packet)
+            return None
+        # write data is queued the way FileService.write queues it, without its resume, a lost link
+        # or a rejected block fails the write and the rest of the batch instead
+        block_size = service.max_block_size()
+        for offset in range(0, len(packets), block_size):
+            if self.reconnects != service._transport_layer.reconnects:
+                return None
+            # the last block is sent as DATA so the write only succeeds once all of it is acknowledged
+            last = offset + block_size >= len(packets)
+            packet_type = FramePacket.Type.DATA_NACK if not last and len(service.tx_queue) < service._transport_layer.max_window() else FramePacket.Type.DATA
+            packet = service.send_packet(RawDataPacket(packet_id = PacketCode.WRITE, data = packets[offset:offset + block_size]), packet_type = packet_type, block = True)
+            if packet_type == FramePacket.Type.DATA and packet.status() != FramePacket.Status.COMPLETE:
+                return None
+        return len(packets)
+
+    def run(self, timeout = None):
+        """Send every command then collect the responses, returns the list of results"""
+        service = self.service
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        reconnects = self.reconnects = service._transport_layer.reconnects
+        # listening before anything is sent so no response can arrive unseen
+        promises = {cls: service.start_listening(cls) for cls in set(x[1] for x in self.commands if x[1] is not None)}
+        try:
+            queued = [self.send(packets) for packets, _, _ in self.commands]
+            results = []
+            for (packets, response_cls, result), sent in zip(self.commands, queued):
+                if response_cls is None:
+                    results.append(sent if sent is not None and reconnects == service._transport_layer.reconnects else None)
+                    continue
+                response = None
+                promise = promises[response_cls]
+                while reconnects == service._transport_layer.reconnects and (deadline is None or time.perf_counter() < deadline):
+                    response = promise.next()
+                    if response is not None:
+                        break
+                    service.idle(0.0001)
+                results.append(None if response is None else result(response))
+        finally:
+            for cls, promise in promises.items():
+                service.finish_listening(cls, promise)
+
+        # keep the service's view of the open file the same as the blocking calls would, a failed write
+        # leaves the remote file short of data FileService.write would resume it from
+        for (packets, _, _), ok in zip(self.commands, results):
+            if not isinstance(packets, list):
+                if ok is None:
+                    service.open_file = None
+            elif ok is True and packets[0].packet_id == PacketCode.OPEN:
+                service.open_file = (packets[0].filename, packets[0].compression, packets[0].dummy)
+            elif packets[0].packet_id == PacketCode.CLOSE:
+                service.open_file = None
+        self.commands = []
+        return results
+
+
 class FileService(Service):
     def __init__(self):
         super().__init__()
@@ -85,6 +252,10 @@ class FileService(Service):
         self.register_packet(ActionResponsePacket)
         self.register_packet(FileInfoPacket)
         self.register_packet(FileDataPacket)
+        self.register_packet(FileSignaturePacket)
+        self.open_file = None
+        self.resume_timeout = 10.0
+        self.resume_attempts = 5
 
     def query_remote(self):
         self.send_packet(QueryPacket(version_major = 0, version_minor = 1, version_patch = 0,
@@ -92,13 +263,17 @@ class FileService(Service):
         response = self.wait_packet(QueryPacket)
         logger.info("Remote FileService Version: {}.{}.{}".format(response.version_major, response.version_minor, response.version_patch))
 
+    def batch(self):
+        """A FileBatch of commands for this service, sent together and answered in one round trip"""
+        return FileBatch(self)
+
     def mount(self):
         self.send_packet(ServicePacket(packet_id = PacketCode.MOUNT))
         response = self.wait_packet(ActionResponsePacket)
         if response.code == ActionResponsePacket.Code.SUCCESS:
             return True
         else:
-            logger.warn("FileService.mount return error code {}".format(response.code))
+            logger.warning("FileService.mount return error code {}".format(response.code))
             return False
 
     def unmount(self):
@@ -107,7 +282,7 @@ class FileService(Service):
         if response.code == ActionResponsePacket.Code.SUCCESS:
             return True
         else:
-            logger.warn("FileService.unmount return error code {}".format(response.code))
+            logger.warning("FileService.unmount return error code {}".format(response.code))
             return False
 
     def open(self, filename, compression = False, dummy = False):
@@ -115,18 +290,20 @@ class FileService(Service):
         response = self.wait_packet(ActionResponsePacket)
         if response.code == ActionResponsePacket.Code.SUCCESS:
             logger.info("File \'{}\' opened successfuly".format(filename))
+            self.open_file = (filename, compression, dummy)
             return True
         else:
-            logger.warn("FileService.open \'{}\' returned error code: {}".format(filename, response.code))
+            logger.warning("FileService.open \'{}\' returned error code: {}".format(filename, response.code))
             return False
 
     def close(self):
+        self.open_file = None
         self.send_packet(ServicePacket(packet_id = PacketCode.CLOSE))
         response = self.wait_packet(ActionResponsePacket)
         if response.code == ActionResponsePacket.Code.SUCCESS:
             return True
         else:
-            logger.warn("FileService.close return error code {}".format(response.code))
+            logger.warning("FileService.close return error code {}".format(response.code))
             return False
 
     def abort(self):
@@ -135,25 +312,82 @@ class FileService(Service):
         if response.code == ActionResponsePacket.Code.SUCCESS:
             return True
         else:
-            logger.warn("FileService.abort return error code {}".format(response.code))
+            logger.warning("FileService.abort return error code {}".format(response.code))
             return False
 
+    def resume(self, offset, request = False):
+        # Reopen the current file on the remote after the link was lost, positioned at offset.
+        # The remote truncates anything past offset when writing so the transfer continues
+        # from the last byte it acknowledged
+        filename, compression, dummy = self.open_file
+        packet_id = PacketCode.REQUEST_RESUME if request else PacketCode.RESUME
+        for _ in range(self.resume_attempts):
+            if not self.wait_synchronised(self.resume_timeout):
+                continue
+            reconnects = self._transport_layer.reconnects
+            self.send_packet(FileResumePacket(packet_id = packet_id, filename = filename, compression = compression, dummy = dummy, offset = offset))
+            response = self.wait_packet(ActionResponsePacket, timeout = self.resume_timeout)
+            if response is None or reconnects != self._transport_layer.reconnects:
+                continue
+            if response.code == ActionResponsePacket.Code.SUCCESS:
+                logger.info("File \'{}\' resumed at offset {}".format(filename, offset))
+                return True
+            logger.warning("FileService.resume \'{}\' returned error code: {}".format(filename, response.code))
+            return False
+        logger.error("FileService.resume \'{}\' failed, giving up".format(filename))
+        return False
+
     def write(self, buffer, progress = None):
         if progress is not None:
             next(progress)
-        byte_count = 0
 
-        for x in (buffer[i:i + self.max_block_size()] for i in range(0, len(buffer), self.max_block_size())):
-            # make sure the last packet needed for this buffer is sent as a DATA packet not DATA_NACK
-            packet_type = FramePacket.Type.DATA_NACK if len(x) == self.max_block_size() and len(self.tx_queue) < 64 else FramePacket.Type.DATA
-            self.send_packet(RawDataPacket(packet_id = PacketCode.WRITE, data = x), packet_type = packet_type, block = True) # todo: timeout and error
-
-            byte_count += len(x)
-            if progress is not None and packet_type == FramePacket.Type.DATA:
+        # checkpoint is the offset up to which the remote has acknowledged every block,
+        # a DATA packet being acked implies all DATA_NACK packets before it were received
+        checkpoint = 0
+        offset = 0
+        reconnects = self._transport_layer.reconnects
+        # a FanOut.SharedUpload reader hands out blocks cut and checksummed once for every printer and
+        # is told how far the remote has acknowledged so blocks no printer can resume from are freed
+        shared_block = getattr(buffer, 'block', None)
+        release = getattr(buffer, 'release', None)
+
+        while offset < len(buffer):
+            if shared_block is not None:
+                x, checksum = shared_block(offset, self.max_block_size())
+            else:
+                x, checksum = buffer[offset:offset + self.max_block_size()], None
+            # make sure the last packet needed for this buffer is sent as a DATA packet not DATA_NACK,
+            # one is also waited on every window of packets queued so no more than that is buffered ahead
+            packet_type = FramePacket.Type.DATA_NACK if offset + len(x) < len(buffer) and len(self.tx_queue) < self._transport_layer.max_window() else FramePacket.Type.DATA
+            packet = RawDataPacket(packet_id = PacketCode.WRITE, data = x)
+            packet.payload_checksum = checksum
+            packet = self.send_packet(packet, packet_type = packet_type, block = True) # todo: timeout
+            offset += len(x)
+
+            if packet_type == FramePacket.Type.DATA_NACK and reconnects == self._transport_layer.reconnects:
+                continue
+
+            if reconnects != self._transport_layer.reconnects or packet.status() != FramePacket.Status.COMPLETE:
+                # a packet failed by Service.connection_reset() may not have been given a frame yet
+                if packet.frame_packet is not None and packet.frame_packet.response == FramePacket.Response.Type.REJECT:
+                    logger.error("FileService.write data rejected by remote at offset {}".format(checkpoint))
+                    return checkpoint
+                # the link was lost somewhere after the last checkpoint, everything after it is resent
+                logger.warning("FileService.write link lost, resuming from offset {}".format(checkpoint))
+                if self.open_file is None or not self.resume(checkpoint):
+                    return checkpoint
+                reconnects = self._transport_layer.reconnects
+                offset = checkpoint
+                continue
+
+            checkpoint = offset
+            if release is not None:
+                release(checkpoint)
+            if progress is not None:
                 #only update progress after a packet was confirmed delivered (only DATA types can be blocked until acked)
-                progress.send(byte_count)
+                progress.send(checkpoint)
 
-        return byte_count
+        return checkpoint
 
     def ls(self):
         listing = []
@@ -175,7 +409,7 @@ class FileService(Service):
         response = self.wait_packet(ActionResponsePacket) # todo: timeout
         if response.code == ActionResponsePacket.Code.SUCCESS:
             return True
-        logger.warn("FileService.cd({}) return error code {}".format(filename, response.code))
+        logger.warning("FileService.cd({}) return error code {}".format(filename, response.code))
         return False
 
     def pwd(self):
@@ -192,6 +426,80 @@ class FileService(Service):
             self.write(f.read(), progress=progress)
         self.close()
 
+    def signature(self, filename, block_size = 512, timeout = 10.0):
+        """(size, [weak], [strong]) Delta signature of the remote's filename, None when it can't be read,
+        the link drops or the remote goes timeout seconds without sending the next part of it"""
+        weak, strong = [], []
+        reconnects = self._transport_layer.reconnects
+        with self.listen_for(FileSignaturePacket) as packet_queue:
+            self.send_packet(FileSignatureRequestPacket(filename = filename, block_size = block_size))
+            response = self.wait_packet(ActionResponsePacket, timeout = timeout)
+            if response is None or response.code != ActionResponsePacket.Code.SUCCESS:
+                logger.info("FileService.signature \'{}\' returned error code: {}".format(filename, None if response is None else response.code))
+                return None
+            deadline = time.perf_counter() + timeout
+            while reconnects == self._transport_layer.reconnects and time.perf_counter() < deadline:
+                if packet_queue.ready():
+                    packet = packet_queue.next()
+                    if packet.count == 0:
+                        return packet.size, weak, strong
+                    weak.extend(packet.weak)
+                    strong.extend(packet.strong)
+                    deadline = time.perf_counter() + timeout
+                else:
+                    self.idle()
+        logger.warning("FileService.signature \'{}\' {}".format(filename, 'link lost' if reconnects != self._transport_layer.reconnects else 'timed out'))
+        return None
+
+    def put_delta(self, src, dst = None, block_size = 512):
+        """put src only sending what differs from the remote's current dst, rsync style. Falls back to a
+        full put when the remote has no dst or the delta doesn't go through. Returns True when the delta
+        was used"""
+        if dst is None:
+            dst = src
+
+        with open(src, "rb") as f:
+            data = f.read()
+        remote = self.signature(dst, block_size)
+        if remote is not None and self.write_delta(dst, data, Delta.delta(data, remote[1], remote[2], block_size)):
+            return True
+
+        logger.info("FileService.put_delta \'{}\' sending the whole file".format(dst))
+        self.open(dst)
+        self.write(data)
+        self.close()
+        return False
+
+    def write_delta(self, filename, data, ops):
+        # ops as from Delta.delta(), copies and literal data are queued the same as write() queues blocks
+        # and the remote's answer to CLOSE confirms the file was rebuilt
+        reconnects = self._transport_layer.reconnects
+        self.send_packet(FileDeltaPacket(filename = filename, size = len(data), checksum = Checksum.crc32(0, data)))
+        response = self.wait_packet(ActionResponsePacket)
+        if response.code != ActionResponsePacket.Code.SUCCESS:
+            logger.warning("FileService.write_delta \'{}\' returned error code: {}".format(filename, response.code))
+            return False
+
+        for offset, length, basis in ops:
+            if basis is not None:
+                packets = [FileCopyPacket(offset = basis, length = length)]
+            else:
+                packets = [RawDataPacket(packet_id = PacketCode.WRITE, data = data[x:min(x + self.max_block_size(), offset + length)])
+                           for x in range(offset, offset + length, self.max_block_size())]
+            for packet in packets:
+                packet_type = FramePacket.Type.DATA_NACK if len(self.tx_queue) < self._transport_layer.max_window() else FramePacket.Type.DATA
+                self.send_packet(packet, packet_type = packet_type, block = True)
+            if reconnects != self._transport_layer.reconnects:
+                logger.warning("FileService.write_delta \'{}\' link lost".format(filename))
+                return False
+
+        self.send_packet(ServicePacket(packet_id = PacketCode.CLOSE))
+        response = self.wait_packet(ActionResponsePacket)
+        if response.code != ActionResponsePacket.Code.SUCCESS or reconnects != self._transport_layer.reconnects:
+            logger.warning("FileService.write_delta \'{}\' close returned error code: {}".format(filename, response.code))
+            return False
+        return True
+
     # implement read api, this uses temporary request api
     # todo: loads of error checking and timeouts
     def get(self, src, dst=None, compression=False, dummy=False, progress=None):
@@ -203,20 +511,56 @@ class FileService(Service):
 
         bytes_read = 0
 
-        self.send_packet(FileOpenPacket(packet_id = PacketCode.REQUEST, filename=src, compression=compression, dummy=dummy))
-        response = self.wait_packet(ActionResponsePacket)
-        if response.code == ActionResponsePacket.Code.SUCCESS:
+        reconnects = self._transport_layer.reconnects
+        # After a reconnect whatever the remote still sent of the old request arrives ahead of its answer
+        # to REQUEST_RESUME, the dispatching thread drops file data from the reconnect until that answer
+        stream = {'reconnects': reconnects, 'live': True}
+        received = deque()
+        def data_received(packet):
+            if stream['reconnects'] != self._transport_layer.reconnects:
+                stream['live'] = False
+            if stream['live']:
+                received.append(packet)
+        def response_received(packet):
+            stream['reconnects'] = self._transport_layer.reconnects
+            stream['live'] = True
+
+        data_listener = self.subscribe(FileDataPacket, data_received)
+        response_listener = self.subscribe(ActionResponsePacket, response_received)
+        try:
+            self.send_packet(FileOpenPacket(packet_id = PacketCode.REQUEST, filename=src, compression=compression, dummy=dummy))
+            response = self.wait_packet(ActionResponsePacket)
+            if response.code != ActionResponsePacket.Code.SUCCESS:
+                logger.warning("Request return error code {}".format(response.code))
+                return False
+
+            self.open_file = (src, compression, dummy)
             with open(dst, 'wb') as f:
-                packet = self.wait_packet(FileDataPacket)
-                while len(packet.data) == 64: #todo: 64 is the clients max packet payload size, needs added to transport layer query? ..
-                    f.write(packet.data)
-                    bytes_read += len(packet.data)
-                    if progress is not None:
-                        progress.send(bytes_read)
-                    packet = self.wait_packet(FileDataPacket)
-                bytes_read += len(packet.data)
-                if progress is not None:
-                    progress.send(bytes_read)
-                f.write(packet.data)
-        else:
-            logger.warn("Request return error code {}".format(response.code))
+                while True: #todo timeout
+                    if reconnects != self._transport_layer.reconnects:
+                        # data queued before the link dropped is dropped too and asked for again, the
+                        # request continues from the last byte written
+                        logger.warning("FileService.get link lost, resuming from offset {}".format(bytes_read))
+                        received.clear()
+                        f.seek(bytes_read)
+                        f.truncate()
+                        reconnects = self._transport_layer.reconnects
+                        if not self.resume(bytes_read, request = True):
+                            self.open_file = None
+                            return False
+                    elif len(received):
+                        packet = received.popleft()
+                        f.write(packet.data)
+                        bytes_read += len(packet.data)
+                        if progress is not None:
+                            progress.send(bytes_read)
+                        if len(packet.data) != 64: #todo: 64 is the clients max packet payload size, needs added to transport layer query? ..
+                            break
+                    else:
+                        self.idle()
+            self.open_file = None
+        finally:
+            self.unsubscribe(FileDataPacket, data_listener)
+            self.unsubscribe(ActionResponsePacket, response_listener)
+
+        return True
@@ -1,8 +1,10 @@
 from enum import IntEnum
+from copy import copy
 import struct
 
 import SerialPacketStream.Codec as Codec
 import SerialPacketStream.Checksum as Checksum
+import SerialPacketStream.ReedSolomon as ReedSolomon
 
 Status = IntEnum( 'Status',
     ['NONE',
@@ -21,10 +23,11 @@ Type = IntEnum('Type', ['RESPONSE', 'DATA', 'DATA_NACK', 'DATA_FAF'], start = 0)
 class frame_token_t(Codec.codec_type):
     datatype = int
     fmt = struct.Struct('<H')
+    TOKEN = 0xACB5
 
     @classmethod
     def encode(cls, value, buffer):
-        return cls.fmt.pack(0xACB5 | int(value) << 8)
+        return cls.fmt.pack(cls.TOKEN | int(value) << 8)
 
     @classmethod
     def decode(cls, buffer):
@@ -32,11 +35,28 @@ class frame_token_t(Codec.codec_type):
         buffer.offset += cls.fmt.size
         return (value[0] >> 8) & 0x03
 
+class extended_frame_token_t(frame_token_t):
+    # frame start of frames and responses carrying 16 bit sync numbers
+    TOKEN = 0xACB6
+
+class fec_frame_token_t(frame_token_t):
+    # frame start of DATA frames with Reed-Solomon parity after the footer, 0x08 marks the parity
+    TOKEN = 0xACBD
+
+class extended_fec_frame_token_t(frame_token_t):
+    TOKEN = 0xACBE
+
 class Data(object):
 
     class Header(Codec.Serializable):
         SIZE  = 8
         HEADER_TOKEN = 0xACB5
+        # wire layout for unpacking in place: token, sync, channel, packet_id, payload_size, checksum
+        FORMAT = struct.Struct('<HBBBHB')
+        SYNC = struct.Struct('<B')
+        SYNC_MASK = 0xFF
+        # ReedSolomon parity over payload and footer follows the footer
+        FEC = False
         packet_type : frame_token_t
         sync : Codec.uint8_t
         channel : Codec.uint8_t
@@ -44,53 +64,141 @@ class Data(object):
         payload_size : Codec.uint16_t
         checksum : Codec.crc8_t
 
+    class ExtendedHeader(Header):
+        # 16 bit sync numbers, only sent once both ends advertise Feature.EXTENDED_SYNC
+        SIZE = 9
+        HEADER_TOKEN = 0xACB6
+        FORMAT = struct.Struct('<HHBBHB')
+        SYNC = struct.Struct('<H')
+        SYNC_MASK = 0xFFFF
+        packet_type : extended_frame_token_t
+        sync : Codec.uint16_t
+
+    # frames with parity, only sent once both ends advertise Feature.FEC
+    class FecHeader(Header):
+        HEADER_TOKEN = 0xACBD
+        FEC = True
+        packet_type : fec_frame_token_t
+
+    class ExtendedFecHeader(ExtendedHeader):
+        HEADER_TOKEN = 0xACBE
+        FEC = True
+        packet_type : extended_fec_frame_token_t
+
     class Footer(Codec.Serializable):
         SIZE = 2
+        FORMAT = struct.Struct('<H')
         checksum : Codec.uint16_t
 
     def __bytes__(self):
         data = bytearray()
         data += bytes(self.header)
-        data += self.data
-        self.footer = Data.Footer(Checksum.crc16(0, self.data))
-        data += bytes(self.footer)
+        if len(self.data):
+            # the payload checksum footer is only present when there is a payload, create() may
+            # have been given the checksum already
+            data += self.data
+            if self.footer is None:
+                self.footer = Data.Footer(Checksum.crc16(0, self.data))
+            data += bytes(self.footer)
+            if self.header.FEC:
+                data += ReedSolomon.encode(memoryview(data)[self.header.SIZE:])
         return bytes(data)
 
+    def parity_size(self):
+        return ReedSolomon.parity_size(len(self.data) + Data.Footer.SIZE) if self.header.FEC and len(self.data) else 0
+
+    def encode(self):
+        # The wire bytes are built once and kept, only the packet type and sync number change between
+        # transmissions so a retransmit patches those and the header checksum in place
+        wire = self.wire
+        header = self.header
+        if wire is None:
+            wire = self.wire = bytearray(bytes(self))
+        elif header.SYNC.unpack_from(wire, 2)[0] != header.sync or wire[1] & 0x03 != header.packet_type:
+            wire[1] = (header.HEADER_TOKEN >> 8) | header.packet_type
+            header.SYNC.pack_into(wire, 2, header.sync)
+            wire[header.SIZE - 1] = Checksum.crc8(0, wire[:header.SIZE - 1])
+        return wire
+
     @classmethod
     def from_bytearray(cls, data):
         packet = cls()
-        packet.header = Data.Header.from_bytes(data[0:8])
+        header_cls = Data.HEADERS[data[0]]
+        packet.header = header_cls.from_bytes(data[0:header_cls.SIZE])
+
+        if len(data) > header_cls.SIZE:
+            end = header_cls.SIZE + packet.header.payload_size
+            packet.data = data[header_cls.SIZE:end]
+            packet.footer = Data.Footer.from_bytes(data[end:end + Data.Footer.SIZE])
 
-        if len(data) > Data.Header.SIZE:
-            packet.data = data[8:-2]
-            packet.footer = Data.Footer.from_bytes(data[-2:])
+        return packet
 
+    def retain(self, payload = True):
+        # The receive path reuses one frame and its buffer for every packet, a frame that is kept
+        # beyond dispatch is copied so it isn't overwritten by the next one, the payload only when
+        # it is still to be decoded
+        packet = Data()
+        packet.header = copy(self.header)
+        if payload:
+            packet.data = bytearray(self.data)
+        packet.footer = self.footer
+        packet.status = self.status
         return packet
 
     @classmethod
-    def create(cls, packet_type, channel, packet_id, payload):
+    def create(cls, packet_type, channel, packet_id, payload, extended = False, checksum = None, fec = False):
         packet = cls()
-        packet.header = Data.Header(packet_type, 0, channel, packet_id, len(payload))
+        if fec:
+            header_cls = Data.ExtendedFecHeader if extended else Data.FecHeader
+        else:
+            header_cls = Data.ExtendedHeader if extended else Data.Header
+        packet.header = header_cls(packet_type, 0, channel, packet_id, len(payload))
         packet.data = payload
+        if checksum is not None:
+            packet.footer = Data.Footer(checksum)
         return packet
 
     def __init__(self):
         self.header = None
         self.data = bytearray()
         self.footer = None
+        # encoded frame kept by encode() for retransmits
+        self.wire = None
         self.status = Status.NONE
         self.response = None
+        # perf_counter time of the last write to the connection
+        self.transmit_time = None
+        # [(Trace.Event, perf_counter time)] while a tracer is installed on the TransportLayer, and the
+        # frame's number in the trace
+        self.trace = None
+        self.trace_id = None
 
     def __str__(self):
         payload_string = ", {}, {}".format([hex(x) if i < 9 else "..." for i, x in enumerate(self.data) if i < 10], self.footer) if self.header.payload_size else ""
         return "BasePacket(Status: {}, {}{})".format(Status(self.status)._name_, self.header, payload_string)
 
 
+# header class by the low byte of its frame start token
+Data.HEADERS = {x.HEADER_TOKEN & 0xFF: x for x in (Data.Header, Data.ExtendedHeader, Data.FecHeader, Data.ExtendedFecHeader)}
+
+
 class Response(Codec.Serializable):
     SIZE = 5
+    # wire layout for unpacking in place: token, response, sync_id, checksum
+    FORMAT = struct.Struct('<HBBB')
+    SYNC_MASK = 0xFF
     Type = IntEnum('Type', ['ACK', 'NACK', 'NYET', 'REJECT'], start = 0)
 
     packet_type : frame_token_t
     response : Codec.uint8_t
     sync_id : Codec.uint8_t
     checksum : Codec.crc8_t
+
+
+class ExtendedResponse(Response):
+    SIZE = 6
+    FORMAT = struct.Struct('<HBHB')
+    SYNC_MASK = 0xFFFF
+
+    packet_type : extended_frame_token_t
+    sync_id : Codec.uint16_t
@@ -0,0 +1,202 @@
+import time
+from bisect import bisect_left
+from collections import Counter
+
+import SerialPacketStream.FramePacket as FramePacket
+
+import logging
+logger = logging.getLogger('default')
+
+
+class Histogram(object):
+    """Fixed bucket histogram, bounds are the inclusive upper edges of each bucket with one overflow bucket after them"""
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        # upper edge of the bucket holding the percentile, the overflow bucket reports the largest value seen
+        if self.count == 0:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'bounds': self.bounds,
+            'counts': list(self.counts),
+        }
+
+
+class TransportMetrics(object):
+    """Counters, gauges and ACK latency histogram of one TransportLayer.
+
+    Counters are plain integer increments done on the TransportLayer IO thread so they can stay on
+    permanently, everything derived (names, gauges, percentiles) is only worked out in snapshot().
+    Callbacks added with add_callback() are called from the IO thread with a fresh snapshot every
+    `interval` seconds.
+    """
+    # 50us doubling up to ~13s
+    ACK_LATENCY_BOUNDS = [50e-6 * 2 ** x for x in range(19)]
+
+    def __init__(self, transport_layer):
+        self.transport_layer = transport_layer
+        self.callbacks = []
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+
+        # (channel, FramePacket.Type) -> count, responses are keyed (None, Type.RESPONSE)
+        self.frames_tx = Counter()
+        self.bytes_tx = Counter()
+        self.frames_rx = Counter()
+        self.bytes_rx = Counter()
+        # FramePacket.Response.Type -> count
+        self.responses_tx = Counter()
+        self.responses_rx = Counter()
+
+        self.header_crc_errors = 0
+        self.payload_crc_errors = 0
+        self.response_crc_errors = 0
+        self.invalid_responses = 0
+        self.retransmits = 0
+        self.response_timeouts = 0
+        self.resyncs = 0
+        self.noise_bytes = 0
+        # service packets sent and received inside aggregate frames
+        self.aggregated_tx = 0
+        self.aggregated_rx = 0
+        # frames whose payload failed its crc16 and was repaired from the Feature.FEC parity, and those it couldn't
+        self.fec_corrected = 0
+        self.fec_corrected_bytes = 0
+        self.fec_uncorrectable = 0
+
+        self.ack_latency = Histogram(self.ACK_LATENCY_BOUNDS)
+
+    def add_callback(self, callback, interval = 1.0):
+        self.callbacks.append([callback, interval, time.perf_counter() + interval])
+
+    def remove_callback(self, callback):
+        self.callbacks = [x for x in self.callbacks if x[0] != callback]
+
+    def poll(self):
+        # called every IO thread iteration, does nothing unless a callback is due
+        if not self.callbacks:
+            return
+        now = time.perf_counter()
+        snapshot = None
+        for entry in self.callbacks:
+            if now >= entry[2]:
+                entry[2] = now + entry[1]
+                snapshot = self.snapshot() if snapshot is None else snapshot
+                try:
+                    entry[0](snapshot)
+                except Exception as e:
+                    logger.error("metrics callback {} failed: {}".format(entry[0], e))
+
+    # hooks used by the TransportLayer
+
+    def frame_sent(self, packet, size):
+        key = (packet.header.channel, packet.header.packet_type)
+        self.frames_tx[key] += 1
+        self.bytes_tx[key] += size
+
+    def frame_received(self, packet, size):
+        key = (packet.header.channel, packet.header.packet_type)
+        self.frames_rx[key] += 1
+        self.bytes_rx[key] += size
+
+    def response_sent(self, packet):
+        self.responses_tx[packet.response] += 1
+        self.frames_tx[(None, FramePacket.Type.RESPONSE)] += 1
+        self.bytes_tx[(None, FramePacket.Type.RESPONSE)] += packet.SIZE
+
+    def response_received(self, packet):
+        self.responses_rx[packet.response] += 1
+        self.frames_rx[(None, FramePacket.Type.RESPONSE)] += 1
+        self.bytes_rx[(None, FramePacket.Type.RESPONSE)] += packet.SIZE
+
+    # reporting
+
+    @staticmethod
+    def by_channel(counter):
+        result = {}
+        for (channel, packet_type), value in counter.items():
+            name = 'response' if channel is None else str(channel)
+            result.setdefault(name, {})[FramePacket.Type(packet_type).name] = value
+        return result
+
+    @staticmethod
+    def by_response(counter):
+        return {FramePacket.Response.Type(k).name: v for k, v in counter.items()}
+
+    def gauges(self):
+        tl = self.transport_layer
+        return {
+            'tx_queue': len(tl.tx_queue),
+            'in_flight': len(tl.tx_stream.queue),
+            'in_flight_bytes': tl.tx_stream.queue_bytes,
+            'held': {str(channel): len(frames) for channel, frames in tl.tx_stream.held.items()},
+            'dispatch_pending': tl.dispatch_pending,
+            'service_tx_queue': {str(channel): len(service.tx_queue) for channel, service in tl.services.items()},
+            'synchronised': tl.synchronised,
+            'block_size': tl.max_block_size(),
+            'reconnects': tl.reconnects,
+            'connect_seconds': tl.connect_time,
+        }
+
+    def snapshot(self):
+        """Point in time copy of every metric as plain json serialisable data"""
+        return {
+            'uptime': time.perf_counter() - self.start_time,
+            'frames_tx': self.by_channel(self.frames_tx.copy()),
+            'bytes_tx': self.by_channel(self.bytes_tx.copy()),
+            'frames_rx': self.by_channel(self.frames_rx.copy()),
+            'bytes_rx': self.by_channel(self.bytes_rx.copy()),
+            'responses_tx': self.by_response(self.responses_tx.copy()),
+            'responses_rx': self.by_response(self.responses_rx.copy()),
+            'header_crc_errors': self.header_crc_errors,
+            'payload_crc_errors': self.payload_crc_errors,
+            'response_crc_errors': self.response_crc_errors,
+            'invalid_responses': self.invalid_responses,
+            'retransmits': self.retransmits,
+            'response_timeouts': self.response_timeouts,
+            'resyncs': self.resyncs,
+            'noise_bytes': self.noise_bytes,
+            'aggregated_tx': self.aggregated_tx,
+            'aggregated_rx': self.aggregated_rx,
+            'fec_corrected': self.fec_corrected,
+            'fec_corrected_bytes': self.fec_corrected_bytes,
+            'fec_uncorrectable': self.fec_uncorrectable,
+            'gauges': self.gauges(),
+            'ack_latency': self.ack_latency.as_dict(),
+        }
@@ -0,0 +1,133 @@
+import time
+import threading
+
+import SerialPacketStream.Checksum as Checksum
+import SerialPacketStream.Codec as Codec
+
+import logging
+logger = logging.getLogger('default')
+
+
+class Section(object):
+    __slots__ = ('name', 'calls', 'wall', 'cpu', 'depth')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.depth = 0
+
+
+class Profiler(object):
+    """Accumulated wall time, cpu time and call counts of named sections of one TransportLayer thread.
+
+    Sections are prefixed by the part of the pipeline they belong to:
+      rx.<state>      : one call of a receive state machine state
+      tx.<stage>      : a stage of process_transmit (poll, retry, encode, write)
+      io.<operation>  : connection reads and writes
+      checksum.<crc>, codec.<encode|decode> : library calls made on the profiled thread, these
+                        overlap the rx and tx sections they are called from
+    """
+    def __init__(self, thread_ident = None):
+        self.thread_ident = thread_ident
+        self.sections = {}
+        self.start_time = time.perf_counter()
+
+    def section(self, name):
+        section = self.sections.get(name)
+        if section is None:
+            section = self.sections[name] = Section(name)
+        return section
+
+    @staticmethod
+    def begin():
+        return (time.perf_counter(), time.thread_time())
+
+    def end(self, name, start):
+        section = self.section(name) if isinstance(name, str) else name
+        section.calls += 1
+        section.wall += time.perf_counter() - start[0]
+        section.cpu += time.thread_time() - start[1]
+
+    def lap(self, name, start):
+        # end the current section and start the next one from the same point
+        self.end(name, start)
+        return self.begin()
+
+    def as_dict(self):
+        return {
+            'seconds': time.perf_counter() - self.start_time,
+            'sections': {s.name: {'calls': s.calls, 'wall': s.wall, 'cpu': s.cpu} for s in self.sections.values()},
+        }
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        lines = ["Profile over {:.3f}s".format(elapsed),
+                 "{:<24} {:>10} {:>12} {:>12} {:>10} {:>7}".format('section', 'calls', 'wall ms', 'cpu ms', 'us/call', 'wall %')]
+        for s in sorted(self.sections.values(), key = lambda s: (s.name.split('.')[0], -s.wall)):
+            lines.append("{:<24} {:>10} {:>12.3f} {:>12.3f} {:>10.2f} {:>7.2f}".format(
+                s.name, s.calls, s.wall * 1e3, s.cpu * 1e3, s.wall / s.calls * 1e6 if s.calls else 0.0, s.wall / elapsed * 100.0 if elapsed else 0.0))
+        return '\n'.join(lines)
+
+
+# Checksum and Codec are module level code shared by every TransportLayer, while any profiler is
+# installed they are replaced by wrappers that charge the time to the profiler of the calling thread
+
+_profilers = {}
+_originals = []
+
+
+def _timed(name, function):
+    def wrapper(*args, **kwargs):
+        profiler = _profilers.get(threading.get_ident())
+        if profiler is None:
+            return function(*args, **kwargs)
+        section = profiler.section(name)
+        if section.depth:
+            # nested Serializables, only the outermost call is counted
+            return function(*args, **kwargs)
+        section.depth += 1
+        start = Profiler.begin()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            section.depth -= 1
+            profiler.end(section, start)
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def _patch():
+    targets = [
+        (Checksum, 'crc8', 'checksum.crc8'),
+        (Checksum, 'crc16', 'checksum.crc16'),
+        (Codec.Serializable, '__bytes__', 'codec.encode'),
+        (Codec.Serializable, 'from_offsetbuffer', 'codec.decode'),
+    ]
+    for owner, attribute, name in targets:
+        original = owner.__dict__[attribute]
+        _originals.append((owner, attribute, original))
+        if isinstance(original, classmethod):
+            setattr(owner, attribute, classmethod(_timed(name, original.__func__)))
+        else:
+            setattr(owner, attribute, _timed(name, original))
+
+
+def _unpatch():
+    while _originals:
+        owner, attribute, original = _originals.pop()
+        setattr(owner, attribute, original)
+
+
+def install(profiler):
+    if not _profilers:
+        _patch()
+    _profilers[profiler.thread_ident] = profiler
+
+
+def uninstall(profiler):
+    if _profilers.get(profiler.thread_ident) is profiler:
+        del _profilers[profiler.thread_ident]
+    if not _profilers:
+        _unpatch()
@@ -0,0 +1,189 @@
+# Reed-Solomon forward error correction of frame payloads, GF(2^8) with primitive polynomial 0x11D
+# and generator 2. A message is split across interleaved codewords, byte i of the message belongs to
+# codeword i % codewords, so a burst of corrupt bytes is spread over all of them. Each codeword carries
+# NSYM parity bytes and can have up to NSYM / 2 corrupt bytes corrected.
+
+NSYM = 8
+# message bytes per codeword at most, a codeword is at most 255 bytes long
+CODEWORD_DATA = 255 - NSYM
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+
+def gf_mul(x, y):
+    if x == 0 or y == 0:
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+def gf_div(x, y):
+    if x == 0:
+        return 0
+    return GF_EXP[(GF_LOG[x] + 255 - GF_LOG[y]) % 255]
+
+def gf_pow(x, power):
+    return GF_EXP[(GF_LOG[x] * power) % 255]
+
+def gf_inverse(x):
+    return GF_EXP[255 - GF_LOG[x]]
+
+def gf_poly_scale(p, x):
+    return [gf_mul(c, x) for c in p]
+
+def gf_poly_add(p, q):
+    r = [0] * max(len(p), len(q))
+    for i in range(len(p)):
+        r[i + len(r) - len(p)] = p[i]
+    for i in range(len(q)):
+        r[i + len(r) - len(q)] ^= q[i]
+    return r
+
+def gf_poly_mul(p, q):
+    r = [0] * (len(p) + len(q) - 1)
+    for j in range(len(q)):
+        for i in range(len(p)):
+            r[i + j] ^= gf_mul(p[i], q[j])
+    return r
+
+def gf_poly_eval(p, x):
+    y = p[0]
+    for c in p[1:]:
+        y = gf_mul(y, x) ^ c
+    return y
+
+def gf_poly_div(dividend, divisor):
+    out = list(dividend)
+    for i in range(len(dividend) - len(divisor) + 1):
+        coef = out[i]
+        if coef != 0:
+            for j in range(1, len(divisor)):
+                if divisor[j] != 0:
+                    out[i + j] ^= gf_mul(divisor[j], coef)
+    separator = -(len(divisor) - 1)
+    return out[:separator], out[separator:]
+
+
+def generator_poly(nsym):
+    g = [1]
+    for i in range(nsym):
+        g = gf_poly_mul(g, [1, gf_pow(2, i)])
+    return g
+
+GENERATOR = generator_poly(NSYM)
+
+# The encoder is an LFSR dividing by the generator with the register held in one int, FEEDBACK[f] is
+# the generator times the feedback symbol f packed big endian so each message byte costs one lookup
+_SHIFT = 8 * (NSYM - 1)
+_MASK = (1 << 8 * NSYM) - 1
+FEEDBACK = [int.from_bytes(bytes(gf_mul(f, g) for g in GENERATOR[1:]), 'big') for f in range(256)]
+
+
+def codewords(length):
+    return (length + CODEWORD_DATA - 1) // CODEWORD_DATA
+
+def parity_size(length):
+    """parity bytes protecting a message of length bytes"""
+    return codewords(length) * NSYM
+
+def _parity(data):
+    register = 0
+    for byte in data:
+        register = ((register << 8) & _MASK) ^ FEEDBACK[(register >> _SHIFT) ^ byte]
+    return register.to_bytes(NSYM, 'big')
+
+def encode(message):
+    """parity bytes for message, parity_size(len(message)) long"""
+    count = codewords(len(message))
+    message = bytes(message)
+    return b''.join(_parity(message[i::count]) for i in range(count))
+
+
+def _syndromes(codeword):
+    # with a leading 0 as the error locator search expects
+    return [0] + [gf_poly_eval(codeword, GF_EXP[i]) for i in range(NSYM)]
+
+def _error_locator(syndromes):
+    # Berlekamp-Massey
+    error_loc = [1]
+    old_loc = [1]
+    for i in range(NSYM):
+        k = i + 1
+        delta = syndromes[k]
+        for j in range(1, len(error_loc)):
+            delta ^= gf_mul(error_loc[-(j + 1)], syndromes[k - j])
+        old_loc = old_loc + [0]
+        if delta != 0:
+            if len(old_loc) > len(error_loc):
+                new_loc = gf_poly_scale(old_loc, delta)
+                old_loc = gf_poly_scale(error_loc, gf_inverse(delta))
+                error_loc = new_loc
+            error_loc = gf_poly_add(error_loc, gf_poly_scale(old_loc, delta))
+    while len(error_loc) and error_loc[0] == 0:
+        del error_loc[0]
+    if (len(error_loc) - 1) * 2 > NSYM:
+        raise ValueError("too many errors to correct")
+    return error_loc
+
+def _error_positions(error_loc, length):
+    # Chien search, positions are indexes into the codeword
+    reversed_loc = error_loc[::-1]
+    positions = [length - 1 - i for i in range(length) if gf_poly_eval(reversed_loc, gf_pow(2, i)) == 0]
+    if len(positions) != len(error_loc) - 1:
+        raise ValueError("could not locate the errors")
+    return positions
+
+def _correct_codeword(codeword):
+    # codeword is a list of symbols, corrected in place, returns how many were wrong
+    syndromes = _syndromes(codeword)
+    if not any(syndromes):
+        return 0
+    positions = _error_positions(_error_locator(syndromes), len(codeword))
+
+    # Forney
+    coefficients = [len(codeword) - 1 - p for p in positions]
+    errata_loc = [1]
+    for c in coefficients:
+        errata_loc = gf_poly_mul(errata_loc, gf_poly_add([1], [gf_pow(2, c), 0]))
+    _, evaluator = gf_poly_div(gf_poly_mul(syndromes[::-1], errata_loc), [1] + [0] * len(errata_loc))
+    evaluator = evaluator[::-1]
+    x = [gf_pow(2, -(255 - c)) for c in coefficients]
+    for i, xi in enumerate(x):
+        xi_inverse = gf_inverse(xi)
+        loc_prime = 1
+        for j, xj in enumerate(x):
+            if j != i:
+                loc_prime = gf_mul(loc_prime, 1 ^ gf_mul(xi_inverse, xj))
+        if loc_prime == 0:
+            raise ValueError("could not correct the errors")
+        y = gf_mul(xi, gf_poly_eval(evaluator[::-1], xi_inverse))
+        codeword[positions[i]] ^= gf_div(y, loc_prime)
+
+    if any(_syndromes(codeword)):
+        raise ValueError("could not correct the errors")
+    return len(positions)
+
+def correct(message, parity):
+    """Correct message in place against its parity, message a writable buffer (bytearray, memoryview).
+    Returns the number of corrupt bytes corrected in message and parity, raises ValueError when there
+    are more than can be corrected"""
+    count = codewords(len(message))
+    if len(parity) != count * NSYM:
+        raise ValueError("parity is {} bytes, expected {}".format(len(parity), count * NSYM))
+    corrected = 0
+    for i in range(count):
+        data = list(message[i::count])
+        codeword = data + list(parity[i * NSYM:(i + 1) * NSYM])
+        errors = _correct_codeword(codeword)
+        if errors:
+            message[i::count] = bytes(codeword[:len(data)])
+            corrected += errors
+    return corrected
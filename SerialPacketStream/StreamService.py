@@ -0,0 +1,152 @@
+import time
+
+from SerialPacketStream import Service, RawDataPacket, FramePacket, Overflow
+
+import logging
+logger = logging.getLogger('default')
+
+
+class StreamDataPacket(RawDataPacket):
+    packet_id = 0
+
+
+class StreamService(Service):
+    """A channel as a buffered bidirectional byte stream with a pyserial like file API, attach one at
+    each end of the link.
+
+    stream = StreamService()
+    transport_layer.attach(2, stream)
+    stream.write(b'G28\\n')
+    stream.flush()
+    line = stream.readline()
+
+    Writes are cut into max_block_size() packets sent as DATA_NACK, the tail is kept back for the next
+    write or flush() which sends it as DATA and waits for it to be acknowledged, and so for everything
+    before it. Once a window of packets is queued write() waits the same way. Up to rx_packets received
+    packets are held for reading, past that further frames are refused with NYET so a slow reader holds
+    the sender back rather than losing data.
+    """
+    # received packets held for read() before frames are refused
+    rx_packets = 64
+
+    def __init__(self, timeout = None, rx_packets = None):
+        super().__init__()
+        self.register_packet(StreamDataPacket)
+        # seconds read() waits for the bytes asked for and write() for the link to synchronise, None waits
+        # until they arrive, 0 never waits
+        self.timeout = timeout
+        self.tx_buffer = bytearray()
+        # the received packet being read and how much of it has been
+        self.rx_data = b''
+        self.rx_offset = 0
+        self.closed = False
+        self.promise = self.start_listening(StreamDataPacket, maxlen = self.rx_packets if rx_packets is None else rx_packets, overflow = Overflow.NYET)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    # writing
+
+    def send_block(self, data, packet_type):
+        # DATA_NACK unless a window of packets is already queued, then the block is sent as DATA and
+        # waited on so the writer can't run ahead of the link
+        if packet_type == FramePacket.Type.DATA_NACK and len(self.tx_queue) >= self._transport_layer.max_window():
+            packet_type = FramePacket.Type.DATA
+        packet = self.send_packet(StreamDataPacket(data = data), packet_type = packet_type, block = True)
+        if packet_type == FramePacket.Type.DATA and packet.status() != FramePacket.Status.COMPLETE:
+            raise OSError("{} stream data was not acknowledged".format(type(self).__fullqualname__))
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to a closed stream")
+        # the block size is only known once the link is synchronised, it is 0 until then
+        if not self.wait_synchronised(self.timeout) or self.max_block_size() <= 0:
+            raise OSError("{} link not synchronised".format(type(self).__fullqualname__))
+        self.tx_buffer += data
+        block_size = self.max_block_size()
+        # the last block, full or not, stays buffered so flush() always has a DATA packet to send
+        sent = 0
+        while len(self.tx_buffer) - sent > block_size:
+            self.send_block(bytes(self.tx_buffer[sent:sent + block_size]), FramePacket.Type.DATA_NACK)
+            sent += block_size
+        del self.tx_buffer[:sent]
+        return len(data)
+
+    def flush(self):
+        """Send anything buffered and wait until the remote has acknowledged all of it"""
+        if len(self.tx_buffer):
+            data = bytes(self.tx_buffer)
+            self.tx_buffer.clear()
+            self.send_block(data, FramePacket.Type.DATA)
+
+    # reading
+
+    @property
+    def in_waiting(self):
+        # list() copies the queue in one go, the IO thread may be appending to it
+        return len(self.rx_data) - self.rx_offset + sum(len(x.data) for x in list(self.promise.packet_queue))
+
+    def next_data(self, deadline):
+        # the next received packet's data once the current one is read, None when the deadline passes first
+        while True:
+            packet = self.promise.next()
+            if packet is not None:
+                self.rx_data = packet.data
+                self.rx_offset = 0
+                return self.rx_data
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            self.idle(0.0001)
+
+    def deadline(self):
+        return None if self.timeout is None else time.perf_counter() + self.timeout
+
+    def readinto(self, buffer):
+        """Read into buffer until it is full or timeout passes, returns the number of bytes read"""
+        view = memoryview(buffer).cast('B')
+        deadline = self.deadline()
+        length = 0
+        while length < len(view):
+            if self.rx_offset == len(self.rx_data) and self.next_data(deadline) is None:
+                break
+            size = min(len(view) - length, len(self.rx_data) - self.rx_offset)
+            view[length:length + size] = self.rx_data[self.rx_offset:self.rx_offset + size]
+            self.rx_offset += size
+            length += size
+        return length
+
+    def read(self, size = 1):
+        """Read size bytes, fewer when timeout passes first"""
+        buffer = bytearray(size)
+        length = self.readinto(buffer)
+        del buffer[length:]
+        return bytes(buffer)
+
+    def readline(self, size = -1):
+        """Read up to and including the next b'\\n', or size bytes, fewer when timeout passes first"""
+        deadline = self.deadline()
+        line = bytearray()
+        while size < 0 or len(line) < size:
+            if self.rx_offset == len(self.rx_data) and self.next_data(deadline) is None:
+                break
+            end = len(self.rx_data) if size < 0 else min(len(self.rx_data), self.rx_offset + size - len(line))
+            newline = self.rx_data.find(b'\n', self.rx_offset, end)
+            end = end if newline < 0 else newline + 1
+            line += self.rx_data[self.rx_offset:end]
+            self.rx_offset = end
+            if newline >= 0:
+                break
+        return bytes(line)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.closed = True
+            self.finish_listening(StreamDataPacket, self.promise)
@@ -0,0 +1,118 @@
+import os
+import json
+import itertools
+from enum import IntEnum
+from collections import deque
+from threading import Thread, Event as ThreadEvent
+
+import SerialPacketStream.FramePacket as FramePacket
+
+import logging
+logger = logging.getLogger('default')
+
+# Lifecycle of a FramePacket.Data
+#   QUEUED     : Service.send_packet put the ServicePacket on the service tx_queue
+#   SCHEDULED  : moved to the TransportLayer tx_queue as a frame
+#   TRANSMIT   : first write to the connection
+#   RETRANSMIT : written again after a NACK or response timeout
+#   NACK       : a NACK or timeout put the frame back in the tx_queue
+#   ACK, REJECT: the remote acknowledged or rejected it (implicit acks included)
+#   FAILED     : dropped without a response, connection reset
+Event = IntEnum('Event', ['QUEUED', 'SCHEDULED', 'TRANSMIT', 'RETRANSMIT', 'NACK', 'ACK', 'REJECT', 'FAILED'], start = 0)
+
+FINAL_EVENTS = (Event.ACK, Event.REJECT, Event.FAILED)
+
+# slice ids handed out as FramePacket.Data.trace_id, unlike id() never reused by a later frame
+trace_ids = itertools.count(1)
+
+
+class Tracer(object):
+    """Base class of TransportLayer tracers.
+
+    event() is called on the TransportLayer IO thread for every lifecycle step of every frame while
+    the tracer is installed, timestamp is time.perf_counter(). Each step is also appended to
+    packet.trace as (event, timestamp) so it can be inspected after the fact.
+    """
+    def event(self, packet, event, timestamp):
+        pass
+
+    def close(self):
+        pass
+
+
+class ChromeTracer(Tracer):
+    """Streams frame lifecycles to a Chrome trace event file, viewable in chrome://tracing or Perfetto.
+
+    Each frame is an async slice from QUEUED (or SCHEDULED) to its final event on a track per channel,
+    with the steps in between as instant events. The file uses the JSON array format which the
+    viewers accept even when it was not closed cleanly.
+    """
+    def __init__(self, filename, flush_interval = 0.1):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.queue = deque()
+        self.open_slices = set()
+        self.file = open(filename, 'w')
+        self.file.write('[\n')
+
+        self.active = True
+        self.wakeup = ThreadEvent()
+        self.worker_thread = Thread(target=ChromeTracer.process, args=(self,), daemon=True)
+        self.worker_thread.start()
+
+    def event(self, packet, event, timestamp):
+        if packet.trace_id is None:
+            packet.trace_id = next(trace_ids)
+        self.queue.append((timestamp, event, packet.trace_id, packet.header.channel, packet.header.packet_id, packet.header.sync, packet.header.packet_type, len(packet.data)))
+
+    def format(self, timestamp, event, identifier, channel, packet_id, sync, packet_type, size):
+        # the first event seen for a frame opens its slice, the final one closes it
+        final = event in FINAL_EVENTS or (event == Event.TRANSMIT and packet_type == FramePacket.Type.DATA_FAF)
+        if identifier in self.open_slices:
+            phase = 'n'
+            if final:
+                self.open_slices.discard(identifier)
+                phase = 'e'
+        elif final:
+            # frame was already in flight when tracing started
+            phase = 'n'
+        else:
+            self.open_slices.add(identifier)
+            phase = 'b'
+        return json.dumps({
+            'name': 'channel {} packet {}'.format(channel, packet_id),
+            'cat': 'frame',
+            'ph': phase,
+            'id': identifier,
+            'ts': timestamp * 1e6,
+            'pid': self.pid,
+            'tid': channel,
+            'args': {'event': event.name, 'sync': sync, 'type': FramePacket.Type(packet_type).name, 'size': size},
+        })
+
+    def write_pending(self):
+        if not len(self.queue):
+            return
+        lines = []
+        while len(self.queue):
+            lines.append(self.format(*self.queue.popleft()))
+        self.file.write(',\n'.join(lines) + ',\n')
+        self.file.flush()
+
+    def process(self):
+        while self.active:
+            self.wakeup.wait(self.flush_interval)
+            try:
+                self.write_pending()
+            except OSError as e:
+                logger.error("trace {} failed: {}".format(self.filename, e))
+                self.queue.clear()
+        self.write_pending()
+        self.file.write('{}]\n')
+        self.file.close()
+
+    def close(self):
+        self.active = False
+        self.wakeup.set()
+        self.worker_thread.join()
@@ -1,6 +1,8 @@
 import time
+from enum import IntEnum
 from collections import deque
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 import struct
 
 import logging
@@ -9,11 +11,25 @@ logger = logging.getLogger('default')
 import SerialPacketStream.FramePacket as FramePacket
 import SerialPacketStream.Codec as Codec
 import SerialPacketStream.Checksum as Checksum
+import SerialPacketStream.Capture as Capture
+import SerialPacketStream.Metrics as Metrics
+import SerialPacketStream.Trace as Trace
+import SerialPacketStream.Profile as Profile
+import SerialPacketStream.BlockSize as BlockSize
+import SerialPacketStream.Aggregate as Aggregate
+import SerialPacketStream.ReedSolomon as ReedSolomon
 
 class ServicePacket(Codec.Serializable):
     __fullqualname__ = '{}.{}'.format(__module__, __qualname__)
     frame_packet = None
+    # the frame a received packet arrived in, see retain()
+    _frame_packet = None
+    _retained = False
     packet_id = None
+    # perf_counter time Service.send_packet queued it, only recorded while tracing
+    _queued_time = None
+    # crc16 of bytes(packet) when the sender already has it, the frame uses it instead of recomputing
+    payload_checksum = None
 
     def __init__(self, *args, **options):
         self.packet_id = options.get('packet_id') if 'packet_id' in options else type(self).packet_id
@@ -24,15 +40,61 @@ class ServicePacket(Codec.Serializable):
             return FramePacket.Status.PENDING
         return self.frame_packet.status
 
+    def retain(self):
+        # A received packet is decoded straight out of the receive buffer and its frame is reused for
+        # the next one once dispatch returns. Whatever keeps the packet beyond dispatch retains it,
+        # which copies the frame header, the payload is already decoded into the packet.
+        if not self._retained and self._frame_packet is not None:
+            self._frame_packet = self._frame_packet.retain(payload = False)
+            self._retained = True
+        return self
+
 
 class RawDataPacket(ServicePacket):
     data : Codec.bytearray_t
 
+    def __bytes__(self):
+        # the payload is data as it is, bytes data is passed on to the frame without a copy
+        return bytes(self.data)
+
+
+# What a bounded listener does with a packet that arrives while its queue is full
+#   DROP_OLDEST : discard the oldest queued packet to make room
+#   BLOCK       : hold up the dispatching thread until there is room, use with the dispatch executor
+#                 as inline dispatch blocks the TransportLayer IO thread
+#   NYET        : refuse the frame with a NYET response so the remote sends it again later, frames
+#                 that can not be refused (FaF, already acknowledged) fall back to DROP_OLDEST
+Overflow = IntEnum('Overflow', ['DROP_OLDEST', 'BLOCK', 'NYET'], start = 0)
+
+# Optional protocol extensions, each end advertises the ones it supports as bits of SyncPacket.features
+# and one is only used once both ends have
+#   AGGREGATE     : small service packets packed into one frame on the control channel, see Aggregate
+#   EXTENDED_SYNC : 16 bit sync numbers in frames and responses so more than 255 frames can be in flight
+#   FEC           : Reed-Solomon parity after the payload of DATA frames, see TransportLayer.fec
+Feature = IntEnum('Feature', ['AGGREGATE', 'EXTENDED_SYNC', 'FEC'], start = 0)
+
+# features this end must support to accept a frame or response starting with the token
+FRAME_FEATURES = {
+    FramePacket.Data.Header.HEADER_TOKEN: 0,
+    FramePacket.Data.ExtendedHeader.HEADER_TOKEN: 1 << Feature.EXTENDED_SYNC,
+    FramePacket.Data.FecHeader.HEADER_TOKEN: 1 << Feature.FEC,
+    FramePacket.Data.ExtendedFecHeader.HEADER_TOKEN: 1 << Feature.EXTENDED_SYNC | 1 << Feature.FEC,
+}
+RESPONSE_FEATURES = {
+    FramePacket.frame_token_t.TOKEN: 0,
+    FramePacket.extended_frame_token_t.TOKEN: 1 << Feature.EXTENDED_SYNC,
+}
+
 
 class ServicePacketListener(object):
     class PacketPromise(object):
-        def __init__(self):
+        def __init__(self, predicate = None, callback = None, maxlen = None, overflow = Overflow.DROP_OLDEST):
             self.packet_queue = deque()
+            self.predicate = predicate
+            self.callback = callback
+            self.maxlen = maxlen
+            self.overflow = overflow
+            self.dropped = 0
 
         def next(self):
             if self.waiting():
@@ -46,29 +108,63 @@ class ServicePacketListener(object):
         def ready(self):
             return (self.waiting() > 0)
 
+        def full(self):
+            return self.maxlen is not None and len(self.packet_queue) >= self.maxlen
+
+        def refusing(self, pending = 0):
+            # pending packets are on their way to the queue already
+            return self.overflow == Overflow.NYET and self.maxlen is not None and len(self.packet_queue) + pending >= self.maxlen
+
+        def matches(self, packet):
+            return self.predicate is None or self.predicate(packet)
+
         def queue(self, packet):
-            self.packet_queue.append(packet)
+            if self.callback is not None:
+                try:
+                    self.callback(packet)
+                except Exception as e:
+                    logger.error("listener callback {} failed: {}".format(self.callback, e))
+                return
+            if self.overflow == Overflow.BLOCK:
+                while self.full():
+                    time.sleep(0.0001)
+            elif self.full():
+                self.packet_queue.popleft()
+                self.dropped += 1
+            self.packet_queue.append(packet.retain())
 
 
-    def __init__(self, service, packet_cls):
+    def __init__(self, service, packet_cls, **options):
         self.service = service
         self.packet_cls = packet_cls
+        self.options = options
+        self.promise = None
 
     def __enter__(self):
-        return self.service.start_listening(self.packet_cls)
+        self.promise = self.service.start_listening(self.packet_cls, **self.options)
+        return self.promise
 
     def __exit__(self, type, value, traceback):
-        self.service.finish_listening(self.packet_cls)
+        self.service.finish_listening(self.packet_cls, self.promise)
+        self.promise = None
         return False
 
 
 class Service(object):
     __fullqualname__ = '{}.{}'.format(__module__, __qualname__)
+    # packets nobody is listening for are kept up to this many, what happens once it is full
+    # follows rx_queue_overflow (DROP_OLDEST or NYET)
+    rx_queue_size = 256
+    rx_queue_overflow = Overflow.DROP_OLDEST
+
     def __init__(self):
         type(self).__fullqualname__ = "{}.{}".format(type(self).__module__, type(self).__qualname__)
-        self.rx_queue = deque()
+        self.rx_queue = deque(maxlen = self.rx_queue_size)
+        self.rx_dropped = 0
         self.tx_queue = deque()
+        # packet class -> tuple of PacketPromise, replaced rather than modified so dispatch never needs the lock
         self.listeners = {}
+        self.listeners_lock = Lock()
         self.packets = {}
         self._transport_layer = None
 
@@ -88,47 +184,97 @@ class Service(object):
         if not isinstance(packet, ServicePacket):
             raise TypeError("Expected: {}".format(ServicePacket))
 
+        if self._transport_layer is not None and self._transport_layer.tracer is not None:
+            packet._queued_time = time.perf_counter()
         self.tx_queue.append((packet_type, packet))
         # todo timeout
-        while block and packet_type == FramePacket.Type.DATA and packet.status() != FramePacket.Status.COMPLETE:
+        while block and packet_type == FramePacket.Type.DATA and packet.status() not in (FramePacket.Status.COMPLETE, FramePacket.Status.FAILED):
             self.idle()
 
         return packet
 
+    def connection_reset(self):
+        # Called by the TransportLayer after a reconnect, packets still waiting here were
+        # meant for the previous connection so fail them rather than sending them out of context
+        while len(self.tx_queue):
+            packet_type, packet = self.tx_queue.popleft()
+            packet.frame_packet = FramePacket.Data()
+            packet.frame_packet.status = FramePacket.Status.FAILED
+
+    def accepting(self, packet_cls, pending = 0):
+        # False while a NYET listener for the class is full, or nobody listens for it and a NYET
+        # rx_queue is full, checked before the frame is decoded. pending counts the channel's packets
+        # accepted but not yet dispatched, they may all end up in the same queue.
+        listeners = self.listeners.get(packet_cls, ())
+        if not listeners:
+            return self.rx_queue_overflow != Overflow.NYET or len(self.rx_queue) + pending < self.rx_queue.maxlen
+        return not any(promise.refusing(pending) for promise in listeners)
+
     def dispatch(self, packet):
-        if type(packet) in self.listeners:
-            self.listeners[type(packet)].queue(packet) #todo: should this be a queue of listeners per type?
-        else:
-            self.rx_queue.append(packet)
+        delivered = False
+        for promise in self.listeners.get(type(packet), ()):
+            if promise.matches(packet):
+                promise.queue(packet)
+                delivered = True
+        if not delivered:
+            if len(self.rx_queue) == self.rx_queue.maxlen:
+                self.rx_dropped += 1
+            self.rx_queue.append(packet.retain())
             #logger.info("Dropped packet of type {}".format(type(packet)))
 
-    def start_listening(self, packet_cls):
-        deq = ServicePacketListener.PacketPromise()
-        self.listeners[packet_cls] = deq
-        return deq
+    def start_listening(self, packet_cls, **options):
+        promise = ServicePacketListener.PacketPromise(**options)
+        with self.listeners_lock:
+            self.listeners[packet_cls] = self.listeners.get(packet_cls, ()) + (promise,)
+        return promise
+
+    def finish_listening(self, packet_cls, promise = None):
+        # without a promise every listener of the class is removed
+        with self.listeners_lock:
+            remaining = tuple(x for x in self.listeners.get(packet_cls, ()) if promise is not None and x is not promise)
+            if remaining:
+                self.listeners[packet_cls] = remaining
+            else:
+                self.listeners.pop(packet_cls, None)
 
-    def finish_listening(self, packet_cls):
-        del self.listeners[packet_cls]
+    def listen_for(self, packet_cls, **options):
+        if not issubclass(packet_cls, ServicePacket):
+            raise TypeError("Expected subclass: {}".format(ServicePacket))
+        return ServicePacketListener(self, packet_cls, **options)
 
-    def listen_for(self, packet_cls):
+    def subscribe(self, packet_cls, callback, predicate = None):
+        """Call callback(packet) for every matching packet until unsubscribed, from the thread dispatching it,
+        a callback keeping the packet beyond the call retains it with packet.retain()"""
         if not issubclass(packet_cls, ServicePacket):
             raise TypeError("Expected subclass: {}".format(ServicePacket))
-        return ServicePacketListener(self, packet_cls)
+        return self.start_listening(packet_cls, predicate = predicate, callback = callback)
+
+    def unsubscribe(self, packet_cls, promise):
+        self.finish_listening(packet_cls, promise)
 
-    def wait_packet(self, packet_cls):
+    def wait_packet(self, packet_cls, timeout = None, predicate = None):
         if not issubclass(packet_cls, ServicePacket):
             raise TypeError("Expected subclass: {}".format(ServicePacket))
 
-        with self.listen_for(packet_cls) as packet_queue:
-            while True:  # todo: timeout
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.listen_for(packet_cls, predicate = predicate) as packet_queue:
+            while deadline is None or time.perf_counter() < deadline:
                 if packet_queue.ready():
                     return packet_queue.next()
                 self.idle(0.0001) # allow time for packets to arraive
 
-        return False
+        return None
+
+    def wait_synchronised(self, timeout = None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self._transport_layer.synchronised:
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            self.idle(0.001)
+        return True
 
     def max_block_size(self):
-        return self._transport_layer.sync_max_block_size
+        return self._transport_layer.max_block_size()
 
 
 class SyncPacket(ServicePacket):
@@ -140,64 +286,212 @@ class SyncPacket(ServicePacket):
 
     serial_buffer_size : Codec.uint16_t
     payload_buffer_size : Codec.uint16_t
+    # 1 << Feature bits, peers that predate it send the packet without
+    features : Codec.uint32_t
+
+    SIZE = 14
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        # fields missing from an older peer's packet read as 0
+        if len(buffer) < cls.SIZE:
+            buffer = bytes(buffer) + bytes(cls.SIZE - len(buffer))
+        return super().from_bytes(buffer)
 
 
 class ClosePacket(ServicePacket):
     packet_id = 7
 
 
+class BaudRatePacket(ServicePacket):
+    packet_id = 9
+
+    baudrate : Codec.uint32_t
+    # milliseconds the remote waits for a sync at the new rate before going back to the old one
+    timeout : Codec.uint16_t
+
+
+class BaudRateResponsePacket(ServicePacket):
+    packet_id = 10
+
+    baudrate : Codec.uint32_t
+    accepted : Codec.uint8_t
+
+
 class TransportLayerControl(Service):
     def __init__(self):
         super().__init__()
         self.register_packet(SyncPacket)
         self.register_packet(ClosePacket)
+        self.register_packet(BaudRatePacket)
+        self.register_packet(BaudRateResponsePacket)
+        # remote side of a baud rate change, (response, baudrate, timeout) until the response is
+        # acknowledged then (previous baudrate, deadline) until the host syncs at the new rate
+        self.baudrate_switch = None
+        self.baudrate_fallback = None
 
     def synchronise(self):
         # Packets cant be sent by Services until synchronised so work around this
         # by going directly through the transport layer
         self._transport_layer.reset_connection()
+        self._transport_layer.metrics.resyncs += 1
         logger.info("Switching Marlin to Binary Protocol...")
         self._transport_layer.stream_write(b"\nM28B1\n")
         logger.info("Atempting binary stream synchronisation...")
-        self._transport_layer.send_packet(FramePacket.Type.DATA_FAF, 0, SyncPacket.packet_id, bytes(SyncPacket(*self._transport_layer.VERSION, 512, 512)))
+        self._transport_layer.send_packet(FramePacket.Type.DATA_FAF, 0, SyncPacket.packet_id, bytes(self._transport_layer.sync_packet()))
+
+    def resynchronise(self, timeout):
+        self._transport_layer.request_sync()
+        if self.wait_synchronised(timeout):
+            return True
+        self._transport_layer.cancel_sync()
+        return False
+
+    def change_baudrate(self, baudrate, timeout = 1.0):
+        # Both ends switch once the remote's acceptance has been acknowledged and the stream is then
+        # synchronised again at the new rate. If that fails within timeout seconds both ends go
+        # back to the previous rate, the remote on its own as it can't be told.
+        # Anything queued on the other channels while switching is failed by the resync.
+        transport_layer = self._transport_layer
+        previous = transport_layer.connection.baudrate
+        if baudrate == previous:
+            return True
+
+        with self.listen_for(BaudRateResponsePacket) as responses:
+            request = self.send_packet(BaudRatePacket(baudrate = baudrate, timeout = int(timeout * 1000)), block = True)
+            if request.status() != FramePacket.Status.COMPLETE:
+                logger.warning("Remote did not accept the baud rate request, {}".format(FramePacket.Response.Type(request.frame_packet.response).name if request.frame_packet.response is not None else 'no response'))
+                return False
+            deadline = time.perf_counter() + timeout
+            while not responses.ready() and time.perf_counter() < deadline:
+                self.idle(0.0001)
+            response = responses.next()
+
+        if response is None or not response.accepted:
+            logger.warning("Remote refused {} baud".format(baudrate))
+            return False
+
+        # the remote switches when our ACK of its response arrives, it has to be written at the old rate,
+        # rx sync moves on right after the ACK is queued
+        while transport_layer.rx_stream.sync == response._frame_packet.header.sync or any(isinstance(p, FramePacket.Response) for p in list(transport_layer.tx_queue)):
+            self.idle(0.0001)
+        transport_layer.synchronised = False
+        transport_layer.connection.flush()
+        transport_layer.connection.baudrate = baudrate
+        logger.info("Switched to {} baud, synchronising".format(baudrate))
+        if self.resynchronise(timeout):
+            return True
+
+        logger.warning("No sync at {} baud, falling back to {} baud".format(baudrate, previous))
+        transport_layer.connection.baudrate = previous
+        if not self.resynchronise(timeout * 2 + 1.0):
+            raise RuntimeError("Unable to synchronise after falling back to {} baud".format(previous))
+        return False
 
     def disconnect(self):
         self.send_packet(ClosePacket(), block = True)
 
     def reset_mcu(self):
-        logger.warn("Resetting the remote device will drop all currently buffered packets")
+        logger.warning("Resetting the remote device will drop all currently buffered packets")
         self.send_packet(ServicePacket(packet_id = 8), block = False)
         time.sleep(1)
         #self._transport_layer.reconnect()
 
+    def update_baudrate(self):
+        connection = self._transport_layer.connection
+        if self.baudrate_switch is not None:
+            response, baudrate, timeout = self.baudrate_switch
+            if response.status() == FramePacket.Status.COMPLETE:
+                self.baudrate_switch = None
+                self.baudrate_fallback = (connection.baudrate, time.perf_counter() + timeout)
+                connection.baudrate = baudrate
+                self._transport_layer.rx_stream.reset_packet()
+                logger.info("Switched to {} baud, waiting for sync".format(baudrate))
+            elif response.status() == FramePacket.Status.FAILED:
+                self.baudrate_switch = None
+        elif self.baudrate_fallback is not None and time.perf_counter() > self.baudrate_fallback[1]:
+            logger.warning("No sync at {} baud, falling back to {} baud".format(connection.baudrate, self.baudrate_fallback[0]))
+            connection.baudrate = self.baudrate_fallback[0]
+            self._transport_layer.rx_stream.reset_packet()
+            self.baudrate_fallback = None
+
     def update(self):
+        if self.baudrate_switch is not None or self.baudrate_fallback is not None:
+            self.update_baudrate()
         if len(self.rx_queue):
             packet = self.rx_queue.popleft()
+            if isinstance(packet, BaudRatePacket):
+                accepted = packet.baudrate in self._transport_layer.baudrates
+                response = self.send_packet(BaudRateResponsePacket(baudrate = packet.baudrate, accepted = int(accepted)))
+                if accepted:
+                    self.baudrate_switch = (response, packet.baudrate, packet.timeout / 1000.0)
             if isinstance(packet, SyncPacket):
+                # a sync at the new rate confirms a baud rate change
+                self.baudrate_fallback = None
+                if packet._frame_packet.header.packet_type == FramePacket.Type.DATA_FAF:
+                    # the remote requested synchronisation, both stream states restart from here
+                    self._transport_layer.reset_connection()
+                    self._transport_layer.metrics.resyncs += 1
                 self._transport_layer.sync_max_block_size = min(packet.payload_buffer_size, self._transport_layer.default_max_block_size)
-                logger.info("Serial TransportLayer Synchronised (Version: {}.{}.{}, {}B serial buffer, {}B payload buffer) ".format(packet.version_major, packet.version_minor, packet.version_patch, packet.serial_buffer_size, packet.payload_buffer_size))
+                self._transport_layer.negotiate(packet.features)
+                logger.info("Serial TransportLayer Synchronised (Version: {}.{}.{}, {}B serial buffer, {}B payload buffer, features {:#x}) ".format(packet.version_major, packet.version_minor, packet.version_patch, packet.serial_buffer_size, packet.payload_buffer_size, packet.features))
                 self._transport_layer.synchronised = True
                 if packet._frame_packet.header.packet_type == FramePacket.Type.DATA_FAF:
                     logger.info("Remote Sync request accepted")
-                    self.send_packet(SyncPacket(512, *self._transport_layer.VERSION))
+                    self.send_packet(self._transport_layer.sync_packet())
 
 
 class TransportLayer(object):
     VERSION = [0,2,0]
+    # receive buffer sizes advertised to the remote during synchronisation
+    serial_buffer_size = 512
+    payload_buffer_size = 512
+    # baud rates this end agrees to switch to when the other end asks, none by default
+    baudrates = ()
+    # protocol extensions this end supports, advertised during synchronisation
+    features = 1 << Feature.AGGREGATE | 1 << Feature.EXTENDED_SYNC | 1 << Feature.FEC
     class ReceiveStreamState(object):
-        def __init__(self):
+        def __init__(self, payload_buffer_size = 512):
+            # Every frame is read straight into one preallocated buffer, header, payload then footer, it
+            # is only replaced when a payload larger than it can hold turns up. The frame and response
+            # objects handed to dispatch_packet and process_response are reused the same way.
+            self.buffer = bytearray(FramePacket.Data.ExtendedHeader.SIZE + payload_buffer_size + FramePacket.Data.Footer.SIZE)
+            self.view = memoryview(self.buffer)
+            # one of each kind, the kind of frame start found picks which one is used
+            self.frames = {}
+            for header_cls in FramePacket.Data.HEADERS.values():
+                self.frames[header_cls.HEADER_TOKEN] = FramePacket.Data()
+                self.frames[header_cls.HEADER_TOKEN].header = header_cls()
+            self.responses = {FramePacket.frame_token_t.TOKEN: FramePacket.Response(),
+                              FramePacket.extended_frame_token_t.TOKEN: FramePacket.ExtendedResponse()}
             self.reset_connection()
 
         def reset_connection(self):
             self.sync = 0
+            # 0xFFFF once Feature.EXTENDED_SYNC is negotiated
+            self.sync_mask = 0xFF
             self.retries = 0
             self.reset_packet()
 
         def reset_packet(self):
             self.state = None
-            self.data = bytearray()
+            # bytes of the current frame in buffer
+            self.length = 0
+            # frame start token, without the packet type bits
+            self.token = None
             self.packet = None
             self.checksum = 0
+            # ReedSolomon parity bytes after the footer of a Feature.FEC frame
+            self.parity_size = 0
+
+        def reserve(self, payload_size):
+            size = FramePacket.Data.ExtendedHeader.SIZE + payload_size + FramePacket.Data.Footer.SIZE + self.parity_size
+            if size > len(self.buffer):
+                # views of the old buffer handed out earlier keep it alive
+                buffer = bytearray(size)
+                buffer[:self.length] = self.view[:self.length]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
 
     class TransmitStreamState(object):
         def __init__(self):
@@ -206,22 +500,31 @@ class TransportLayer(object):
         def reset_connection(self):
             self.sync = None
             self.sync_last = None
+            # 0xFFFF once Feature.EXTENDED_SYNC is negotiated
+            self.sync_mask = 0xFF
             self.queue = deque()
+            self.queue_bytes = 0
+            self.last_activity = time.perf_counter()
+            # channel -> frames held back after the remote answered NYET, released at held_until[channel]
+            self.held = {}
+            self.held_until = {}
+            # channel -> current NYET backoff in seconds, cleared by the next ACK on the channel
+            self.backoff = {}
 
         def sync_increment(self):
             self.sync = self.sync_next()
             return self.sync
 
         def sync_next(self):
-            return 0 if self.sync == None else (self.sync + 1) & 0xFF
+            return 0 if self.sync == None else (self.sync + 1) & self.sync_mask
 
         def sync_acked(self, value):
             self.sync_last = value
 
         def sync_to_idx(self, sync):
-            return (sync - (self.sync_last + 1)) & 0xFF
+            return (sync - (self.sync_last + 1)) & self.sync_mask
 
-    def __init__(self, connection, max_block_size):
+    def __init__(self, connection, max_block_size, capture = None):
         self.synchronised = False
         self.active = True
         self.connection = connection
@@ -230,18 +533,80 @@ class TransportLayer(object):
 
         self.default_max_block_size = max_block_size
         self.sync_max_block_size = 0
+        # features advertised by the remote in its last SyncPacket
+        self.remote_features = 0
+        # optional BlockSize.BlockSizeController picking a smaller block size on noisy links,
+        # see start_adaptive_block_size()
+        self.block_size_controller = None
+        # optional Aggregate.Aggregator packing small service packets into shared frames, see start_aggregation()
+        self.aggregator = None
+
+        # incremented every time the link is re-established, lets services notice
+        # that anything in flight at the time was lost
+        self.reconnects = 0
+
+        # While a sync is requested the IO thread sends one, and sends it again with exponential backoff
+        # from sync_interval up to sync_interval_max until the remote's SyncPacket reply arrives.
+        self.sync_interval = 0.05
+        self.sync_interval_max = 1.0
+        self.sync_started = None
+        self.sync_retry_at = None
+        self.sync_backoff = None
+        # seconds from the last connect or reconnect starting to the link being synchronised
+        self.connect_time = None
+        # seconds reconnect() keeps trying to reopen the connection before giving up
+        self.reconnect_timeout = 10.0
 
         self.rx_queue = deque()
         self.tx_queue = deque()
 
         self.tx_stream = TransportLayer.TransmitStreamState()
 
-        self.in_log = open('serial_in.log', 'wb')
-        self.out_log = open('serial_out.log', 'wb')
+        # optional Capture.CaptureLog, recording is off by default as it sits on the hot path
+        self.capture = capture
+
+        self.metrics = Metrics.TransportMetrics(self)
+
+        # optional Trace.Tracer, per frame lifecycle events are only recorded while one is installed
+        self.tracer = None
+
+        # optional Profile.Profiler of the IO thread, see start_profiling()
+        self.profiler = None
+
+        # optional concurrent.futures.Executor decoding and dispatching service packets off the IO thread,
+        # see start_dispatch_executor()
+        self.dispatch_executor = None
+        self.dispatch_executor_owned = False
+        # submitted is only counted on the IO thread, completed by the executor workers under the lock,
+        # in total and by channel
+        self.dispatch_submitted = 0
+        self.dispatch_completed = 0
+        self.channel_submitted = {}
+        self.channel_completed = {}
+        self.dispatch_lock = Lock()
 
-        self.rx_stream = TransportLayer.ReceiveStreamState()
+        self.rx_stream = TransportLayer.ReceiveStreamState(self.payload_buffer_size)
         self.max_retries = 0 # infinite
 
+        # maximum number of unacknowledged frames in flight, at most 255 as with all 256 sync numbers
+        # in use a resent frame could not be told apart from a new one, or 65535 once both ends
+        # have negotiated Feature.EXTENDED_SYNC, see max_window()
+        self.window_size = 255
+
+        # send DATA frames with ReedSolomon parity so the remote can correct a few corrupt bytes in place
+        # rather than NACK, only once the remote advertises Feature.FEC. Costs parity bytes and cpu on
+        # every frame, worth it on links where a noticeable share of frames arrive corrupt.
+        self.fec = False
+
+        # seconds without any response while frames are in flight before they are all resent,
+        # the time needed to clock the unacknowledged bytes out at the current baudrate is added
+        self.response_timeout = 1.0
+
+        # a channel answered with NYET is held back for nyet_backoff seconds, doubling for every
+        # further NYET up to nyet_backoff_max, while the other channels keep sending
+        self.nyet_backoff = 0.001
+        self.nyet_backoff_max = 0.1
+
         self.control = TransportLayerControl()
         self.attach(0, self.control)
 
@@ -249,10 +614,129 @@ class TransportLayer(object):
         self.worker_thread.start()
 
 
-    #def __del__(self):
-        #self.out_log.close()
-        #self.in_log.close()
-        #logger.debug("TransportLayer object destroyed")
+    def start_capture(self, directory = '.', **options):
+        if self.capture is None:
+            self.capture = Capture.CaptureLog.for_connection(self.connection, directory, **options)
+            logger.info("Capturing serial stream to {}".format(self.capture.filename))
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+
+    def start_trace(self, tracer):
+        # tracer is a Trace.Tracer or the filename of a Chrome trace to write
+        if self.tracer is None:
+            self.tracer = Trace.ChromeTracer(tracer) if isinstance(tracer, str) else tracer
+            logger.info("Tracing frames to {}".format(getattr(self.tracer, 'filename', self.tracer)))
+        return self.tracer
+
+    def stop_trace(self):
+        tracer, self.tracer = self.tracer, None
+        if tracer is not None:
+            tracer.close()
+
+    def start_profiling(self):
+        # time spent per receive state, transmit stage, connection IO, Checksum and Codec on the IO thread,
+        # the report is logged on shutdown()
+        if self.profiler is None:
+            profiler = Profile.Profiler(self.worker_thread.ident)
+            Profile.install(profiler)
+            self.profiler = profiler
+        return self.profiler
+
+    def stop_profiling(self):
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            Profile.uninstall(profiler)
+        return profiler
+
+    def start_adaptive_block_size(self, **options):
+        # services then cut blocks of the size the controller expects the best goodput from, never
+        # more than sync_max_block_size, see BlockSize.BlockSizeController for the options
+        if self.block_size_controller is None:
+            self.block_size_controller = BlockSize.BlockSizeController(self, **options)
+        return self.block_size_controller
+
+    def stop_adaptive_block_size(self):
+        controller, self.block_size_controller = self.block_size_controller, None
+        return controller
+
+    def max_block_size(self):
+        controller = self.block_size_controller
+        return self.sync_max_block_size if controller is None else controller.max_block_size()
+
+    def start_aggregation(self, **options):
+        # Small packets from the services are then packed together into shared frames, as long as the
+        # remote supports it, see Aggregate.Aggregator for the options
+        if self.aggregator is None:
+            self.aggregator = Aggregate.Aggregator(self, **options)
+        return self.aggregator
+
+    def stop_aggregation(self):
+        # packets already held back are still sent, the IO thread flushes them before it is removed
+        aggregator = self.aggregator
+        if aggregator is not None:
+            aggregator.stopping = True
+            while aggregator.pending and self.synchronised and self.worker_thread.is_alive():
+                time.sleep(0.0001)
+            self.aggregator = None
+        return aggregator
+
+    def negotiated(self, feature):
+        return bool(self.features & self.remote_features & (1 << feature))
+
+    def negotiate(self, remote_features):
+        # called with the features from the remote's SyncPacket before anything is sent with them,
+        # the sync numbers in use are still below 256 so they carry over to the wider space
+        self.remote_features = remote_features
+        sync_mask = 0xFFFF if self.negotiated(Feature.EXTENDED_SYNC) else 0xFF
+        self.rx_stream.sync_mask = sync_mask
+        self.tx_stream.sync_mask = sync_mask
+
+    def max_window(self):
+        return min(self.window_size, self.tx_stream.sync_mask)
+
+    def sync_packet(self):
+        return SyncPacket(*self.VERSION, self.serial_buffer_size, self.payload_buffer_size, self.features)
+
+    def start_dispatch_executor(self, executor = None):
+        # The IO thread then only validates a frame and queues its response, decoding the ServicePacket and
+        # Service.dispatch run on the executor. Packets are submitted in the order received, the default
+        # single worker executor keeps that order, one with more workers doesn't.
+        # The TransportLayerControl channel is always dispatched on the IO thread.
+        if self.dispatch_executor is None:
+            self.dispatch_executor_owned = executor is None
+            self.dispatch_executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'dispatch') if executor is None else executor
+        return self.dispatch_executor
+
+    def stop_dispatch_executor(self):
+        executor, self.dispatch_executor = self.dispatch_executor, None
+        if executor is not None and self.dispatch_executor_owned:
+            executor.shutdown(wait = True)
+        self.wait_dispatched()
+
+    @property
+    def dispatch_pending(self):
+        return self.dispatch_submitted - self.dispatch_completed
+
+    def channel_pending(self, channel):
+        # packets for channel handed to the dispatch executor that haven't reached the service yet
+        return self.channel_submitted.get(channel, 0) - self.channel_completed.get(channel, 0)
+
+    def wait_dispatched(self):
+        # block until every packet handed to the dispatch executor has reached its service
+        while self.dispatch_pending:
+            time.sleep(0.0001)
+
+    def trace(self, packet, event, timestamp = None):
+        # only called while a tracer is installed
+        timestamp = time.perf_counter() if timestamp is None else timestamp
+        if packet.trace is None:
+            packet.trace = []
+        packet.trace.append((event, timestamp))
+        self.tracer.event(packet, event, timestamp)
 
     def attach(self, channel, service):
         if not isinstance(service, Service):
@@ -267,257 +751,654 @@ class TransportLayer(object):
     def reconnect(self):
         self.synchronised = False
         self.connection.close()
-        self.tx_stream.reset_connection()
-        self.rx_stream.reset_connection()
-
-        time.sleep(1)
-        logger.warn("Attempting reconection to {}".format(self.connection))
-        for _ in range(5):
+        self.reset_connection()
+        # services resume from what they were given, make sure that includes everything received
+        self.wait_dispatched()
+        self.reconnects += 1
+        for service in self.services.values():
+            service.connection_reset()
+
+        logger.warning("Attempting reconection to {}".format(self.connection))
+        start = time.perf_counter()
+        backoff = self.sync_interval
+        while True:
             try:
                 self.connection.close()
-                time.sleep(0.1)
                 self.connection.open()
-                self.control.synchronise()
-                return
+                break
             except OSError as e:
                 logger.error(e)
-                time.sleep(2)
-        raise RuntimeError("Unable to reconnect to Serial Port")
+                if time.perf_counter() + backoff - start > self.reconnect_timeout:
+                    raise RuntimeError("Unable to reconnect to Serial Port")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.sync_interval_max)
+        self.request_sync(start)
+
+    def request_sync(self, start = None):
+        # the sync itself is sent from the IO thread, see process_sync()
+        self.synchronised = False
+        self.sync_started = time.perf_counter() if start is None else start
+        self.sync_backoff = self.sync_interval
+        self.sync_retry_at = 0.0
+
+    def cancel_sync(self):
+        self.sync_retry_at = None
+
+    def process_sync(self):
+        now = time.perf_counter()
+        if self.synchronised:
+            self.sync_retry_at = None
+            self.connect_time = now - self.sync_started
+            logger.info("{} synchronised in {:.1f}ms".format(self.connection, self.connect_time * 1e3))
+        elif now >= self.sync_retry_at:
+            self.sync_retry_at = now + self.sync_backoff
+            self.sync_backoff = min(self.sync_backoff * 2, self.sync_interval_max)
+            self.control.synchronise()
 
     def process_connection(self):
         logger.debug("TransportLayer process thread started")
         while self.active:
             self.control.update()
+            self.metrics.poll()
+            if self.block_size_controller is not None:
+                self.block_size_controller.update()
             try:
+                if self.sync_retry_at is not None:
+                    self.process_sync()
                 self.process_receive()
                 self.process_transmit()
             except OSError as e:
                 logger.error('{}{}'.format(type(e), e))
                 self.reconnect()
-            if self.rx_stream.packet == None and len(self.tx_queue) == 0:
+            # also release the timeslice while the window is full, spinning would only starve other threads
+            if self.rx_stream.packet == None and (len(self.tx_queue) == 0 or len(self.tx_stream.queue) >= self.max_window()):
                 time.sleep(0.0000001) # thread timeslice release
         logger.debug("TransportLayer process thread finished")
 
     def process_transmit(self):
-        if self.synchronised:
+        profiler = self.profiler
+        start = profiler.begin() if profiler is not None else None
+
+        if self.tx_stream.held:
+            self.release_held()
+        aggregator = self.aggregator if self.negotiated(Feature.AGGREGATE) else None
+        # an aggregate frame the remote answered NYET, or packets held back for a channel that was,
+        # hold up every channel as anything sent meanwhile would overtake them
+        if self.synchronised and not (aggregator is not None and aggregator.blocked()):
             for channel in self.services:
-                if len(self.services[channel].tx_queue):
-                    packet_type, packet = self.services[channel].tx_queue.popleft()
-                    packet.frame_packet = self.send_packet(packet_type, channel, packet.packet_id, bytes(packet))
+                if len(self.services[channel].tx_queue) and channel not in self.tx_stream.held:
+                    if aggregator is None:
+                        packet_type, packet = self.services[channel].tx_queue.popleft()
+                        packet.frame_packet = self.send_packet(packet_type, channel, packet.packet_id, bytes(packet), packet._queued_time, packet.payload_checksum)
+                    else:
+                        self.poll_aggregated(aggregator, channel, self.services[channel].tx_queue)
              #       logger.debug("Queueing:\t{} for [channel: {}] {}".format(packet, channel, type(self.services[channel]).__fullqualname__))
-
-        if len(self.tx_queue) and len(self.tx_stream.queue) < 256:
+            if aggregator is not None and aggregator.due():
+                aggregator.flush()
+        if profiler is not None:
+            start = profiler.lap('tx.poll', start)
+
+        if len(self.tx_stream.queue) and self.response_timed_out():
+            logger.warning("response timeout, resending {} packets".format(len(self.tx_stream.queue)))
+            self.metrics.response_timeouts += 1
+            # DATA_NACK packets are never acknowledged, make sure the resend ends in a packet that is
+            self.tx_stream.queue[-1].header.packet_type = FramePacket.Type.DATA
+            self.requeue_transmitted()
+        if profiler is not None:
+            start = profiler.lap('tx.retry', start)
+
+        window_size = self.max_window()
+        if len(self.tx_queue) and len(self.tx_stream.queue) < window_size:
             packet = self.tx_queue.popleft()
 
             if isinstance(packet, FramePacket.Data):
+                retry = packet.status == FramePacket.Status.RETRY
+                if retry:
+                    self.metrics.retransmits += 1
                 if packet.header.packet_type == FramePacket.Type.DATA_FAF:
                     packet.status = FramePacket.Status.COMPLETE
                 else:
                     packet.status = FramePacket.Status.INTRANSIT
-                    if len(self.tx_stream.queue) == 255:
+                    if len(self.tx_stream.queue) == window_size - 1:
                         packet.header.packet_type = FramePacket.Type.DATA
                     packet.header.sync = self.tx_stream.sync_increment()
                     self.tx_stream.queue.append(packet)
-
-            self.stream_write(bytes(packet))
+                    self.tx_stream.queue_bytes += len(packet.data)
+                    if len(self.tx_stream.queue) == 1:
+                        self.tx_stream.last_activity = time.perf_counter()
+
+            data = packet.encode() if isinstance(packet, FramePacket.Data) else bytes(packet)
+            if profiler is not None:
+                start = profiler.lap('tx.encode', start)
+            self.stream_write(data)
+            if isinstance(packet, FramePacket.Data):
+                packet.transmit_time = time.perf_counter()
+                self.metrics.frame_sent(packet, len(data))
+                if self.tracer is not None:
+                    self.trace(packet, Trace.Event.RETRANSMIT if retry else Trace.Event.TRANSMIT, packet.transmit_time)
+            else:
+                self.metrics.response_sent(packet)
+            if profiler is not None:
+                profiler.end('tx.write', start)
             #logger.debug("Transmitting:\t{}".format(packet))
 
-    def process_receive(self):
-        def state_PACKET_RESET():
-            self.rx_stream.reset_packet()
-            self.rx_stream.state = state_PACKET_WAIT
-            state_PACKET_WAIT()
-
-        def state_PACKET_WAIT():
-            if self.connection.in_waiting == 0:
-                return
-            # look for the packet frame start
-            self.stream_read(self.rx_stream.data, 1)
-            if len(self.rx_stream.data) == 2:
-                token = struct.unpack('<H', self.rx_stream.data)[0]
-                if token & 0xFCFF == FramePacket.Data.Header.HEADER_TOKEN:
-                    # pull the 2 bit packet type from the tokens 2nd byte
-                    packet_type = (token >> 8) & 0x03
-                    self.rx_stream.state = state_PACKET_RESPONSE if packet_type == FramePacket.Type.RESPONSE else state_PACKET_HEADER
-                else:
-                    # noise on the bus
-                    del self.rx_stream.data[0]
-
-        def state_PACKET_RESPONSE():
-            self.stream_read(self.rx_stream.data, FramePacket.Response.SIZE - len(self.rx_stream.data))
-            if len(self.rx_stream.data) != FramePacket.Response.SIZE:
-                return
-            packet = FramePacket.Response.from_bytes(self.rx_stream.data)
-            if packet.checksum == Checksum.crc8(0, self.rx_stream.data[:-1]):
-                self.process_response(packet)
-                self.rx_stream.state = state_PACKET_RESET
-
-        def state_PACKET_HEADER():
-            self.stream_read(self.rx_stream.data, FramePacket.Data.Header.SIZE - len(self.rx_stream.data))
-            if len(self.rx_stream.data) != FramePacket.Data.Header.SIZE:
+    def poll_aggregated(self, aggregator, channel, queue):
+        # every small packet waiting is taken in one go, the first one that can't be aggregated is
+        # sent after whatever was held back so the order across channels is kept
+        while len(queue):
+            packet_type, packet = queue.popleft()
+            payload = bytes(packet)
+            if not aggregator.accepts(packet_type, channel, payload):
+                aggregator.flush()
+                packet.frame_packet = self.send_packet(packet_type, channel, packet.packet_id, payload, packet._queued_time, packet.payload_checksum)
                 return
+            aggregator.add(packet_type, channel, packet, payload)
+
+    def response_timed_out(self):
+        baudrate = getattr(self.connection, 'baudrate', None)
+        wire_time = self.tx_stream.queue_bytes * 10.0 / baudrate if baudrate else 0.0
+        return time.perf_counter() - self.tx_stream.last_activity > self.response_timeout + wire_time
+
+    def requeue_transmitted(self):
+        # go back N, everything in flight is sent again starting with the oldest sync number
+        if len(self.tx_stream.queue):
+            self.tx_stream.sync = (self.tx_stream.queue[0].header.sync - 1) & self.tx_stream.sync_mask
+        while len(self.tx_stream.queue):
+            p = self.tx_stream.queue.pop()
+            p.status = FramePacket.Status.RETRY
+            self.tx_queue.appendleft(p)
+            if self.tracer is not None:
+                self.trace(p, Trace.Event.NACK)
+        self.tx_stream.queue_bytes = 0
+
+    def hold_channel(self, channel, sync):
+        # Called after a NYET for a frame of channel with sync number sync, requeue_transmitted() has
+        # already put everything in flight back in tx_queue. The channel's frames are taken out and
+        # held, the rest are renumbered to carry on from the refused sync number.
+        held = self.tx_stream.held.setdefault(channel, deque())
+        remaining = []
+        for p in self.tx_queue:
+            if isinstance(p, FramePacket.Data) and p.header.channel == channel:
+                p.status = FramePacket.Status.BUFFERED
+                held.append(p)
+            else:
+                remaining.append(p)
+        self.tx_queue.clear()
+        self.tx_queue.extend(remaining)
+
+        last = None
+        for p in self.tx_queue:
+            if not isinstance(p, FramePacket.Data) or p.status != FramePacket.Status.RETRY:
+                break
+            p.header.sync = sync
+            sync = (sync + 1) & self.tx_stream.sync_mask
+            last = p
+        # the held frames may have been what would have acknowledged the DATA_NACK frames before them
+        if last is not None and last.header.packet_type == FramePacket.Type.DATA_NACK:
+            last.header.packet_type = FramePacket.Type.DATA
+
+        backoff = min(max(self.tx_stream.backoff.get(channel, 0) * 2, self.nyet_backoff), self.nyet_backoff_max)
+        self.tx_stream.backoff[channel] = backoff
+        self.tx_stream.held_until[channel] = time.perf_counter() + backoff
+
+    def release_held(self):
+        now = time.perf_counter()
+        for channel in [x for x, until in self.tx_stream.held_until.items() if now >= until]:
+            held = self.tx_stream.held.pop(channel)
+            del self.tx_stream.held_until[channel]
+            # behind frames waiting to be resent, those still own the sync numbers they were sent with
+            index = 0
+            for p in self.tx_queue:
+                if not isinstance(p, FramePacket.Data) or p.status != FramePacket.Status.RETRY:
+                    break
+                index += 1
+            for p in held:
+                self.tx_queue.insert(index, p)
+                index += 1
+        self.tx_stream.last_activity = time.perf_counter()
 
-            self.rx_stream.packet = FramePacket.Data.from_bytearray(self.rx_stream.data)
-            header = self.rx_stream.packet.header
+    def process_receive(self):
+        # rx_stream.state holds the bound method of the current receive state, None starts a new packet
+        state = self.rx_stream.state if self.rx_stream.state is not None else self.state_PACKET_RESET
+        if self.profiler is None:
+            state()
+        else:
+            start = self.profiler.begin()
+            state()
+            self.profiler.end('rx.' + state.__name__[len('state_'):], start)
+
+    def state_PACKET_RESET(self):
+        self.rx_stream.reset_packet()
+        self.rx_stream.state = self.state_PACKET_WAIT
+        self.state_PACKET_WAIT()
+
+    def state_PACKET_WAIT(self):
+        # look for the packet frame start, everything already buffered is scanned in one go so
+        # skipping noise or dropped frames doesn't cost a full loop iteration per byte
+        rx = self.rx_stream
+        buffer = rx.buffer
+        while self.connection.in_waiting:
+            rx.length += self.stream_readinto(rx.view[rx.length:2])
+            if rx.length == 2:
+                token = buffer[0] | buffer[1] << 8
+                rx.token = token & 0xFCFF
+                # pull the 2 bit packet type from the tokens 2nd byte
+                packet_type = (token >> 8) & 0x03
+                required = (RESPONSE_FEATURES if packet_type == FramePacket.Type.RESPONSE else FRAME_FEATURES).get(rx.token)
+                if required is not None and self.features & required == required:
+                    rx.state = self.state_PACKET_RESPONSE if packet_type == FramePacket.Type.RESPONSE else self.state_PACKET_HEADER
+                    return
+                # noise on the bus
+                buffer[0] = buffer[1]
+                rx.length = 1
+                self.metrics.noise_bytes += 1
+
+    def state_PACKET_RESPONSE(self):
+        rx = self.rx_stream
+        packet = rx.responses[rx.token]
+        rx.length += self.stream_readinto(rx.view[rx.length:packet.SIZE])
+        if rx.length != packet.SIZE:
+            return
+        _, packet.response, packet.sync_id, packet.checksum = packet.FORMAT.unpack_from(rx.buffer)
+        if packet.checksum == Checksum.crc8(0, rx.view[:packet.SIZE - 1]):
+            self.metrics.response_received(packet)
+            self.process_response(packet)
+        else:
+            self.metrics.response_crc_errors += 1
+        # a corrupt response is dropped, the sender recovers through the next response or its timeout
+        rx.state = self.state_PACKET_RESET
+
+    def state_PACKET_HEADER(self):
+        rx = self.rx_stream
+        frame = rx.frames[rx.token]
+        header = frame.header
+        rx.length += self.stream_readinto(rx.view[rx.length:header.SIZE])
+        if rx.length != header.SIZE:
+            return
 
-            if header.checksum == Checksum.crc8(0, self.rx_stream.data[:-1]):
-                if self.rx_stream.sync == header.sync or header.packet_type == FramePacket.Type.DATA_FAF:
-                    if header.payload_size:
-                        self.rx_stream.data = bytearray()
-                        self.rx_stream.state = state_PACKET_DATA
-                    else:
-                        self.dispatch_packet(self.rx_stream.packet)
-                        self.rx_stream.state = state_PACKET_RESET
-                elif self.rx_stream.retries > 0:
-                    self.rx_stream.state = state_PACKET_RESET  # drop everything during retry
-                elif header.sync == (self.rx_stream.sync - 1) & 0xFF:
-                    # appears to be resending the last pack we already acked, lost response?, resend
-                    self.send_response(FramePacket.Response.Type.ACK, (self.rx_stream.sync - 1) & 0xFF)
-                    self.rx_stream.state = state_PACKET_RESET
+        rx.packet = frame
+        token, header.sync, header.channel, header.packet_id, header.payload_size, header.checksum = header.FORMAT.unpack_from(rx.buffer)
+        header.packet_type = (token >> 8) & 0x03
+
+        if header.checksum == Checksum.crc8(0, rx.view[:header.SIZE - 1]):
+            # a frame with 8 bit sync numbers only compares the low byte
+            if rx.sync & header.SYNC_MASK == header.sync or header.packet_type == FramePacket.Type.DATA_FAF:
+                # the payload is read in place behind the header, the frame's data is a view of it
+                rx.parity_size = ReedSolomon.parity_size(header.payload_size + FramePacket.Data.Footer.SIZE) if header.FEC and header.payload_size else 0
+                rx.reserve(header.payload_size)
+                rx.packet.data = rx.view[header.SIZE:header.SIZE + header.payload_size]
+                if header.payload_size:
+                    rx.state = self.state_PACKET_DATA
                 else:
-                    self.rx_stream.state = state_PACKET_RESEND
-
-            # At this point we know the header is corrupt and not trusted
-            # but to speed up stream recovery the packet type is assumed
-            # to be correct
-
-            elif header.packet_type == FramePacket.Type.DATA_FAF:
-                self.rx_stream.state = state_PACKET_RESET # corrupt FaF packets are droped
-            elif self.rx_stream.retries > 0:
-                self.rx_stream.state = state_PACKET_RESET # drop everything during retry
+                    self.dispatch_packet(rx.packet)
+                    rx.state = self.state_PACKET_RESET
+            elif rx.retries > 0:
+                rx.state = self.state_PACKET_RESET  # drop everything during retry
+            elif header.sync == (rx.sync - 1) & header.SYNC_MASK:
+                # appears to be resending the last pack we already acked, lost response?, resend
+                self.send_response(FramePacket.Response.Type.ACK, (rx.sync - 1) & rx.sync_mask)
+                rx.state = self.state_PACKET_RESET
             else:
-                self.rx_stream.state = state_PACKET_RESEND
+                rx.state = self.state_PACKET_RESEND
 
-        def state_PACKET_DATA():
-            start_idx = len(self.rx_stream.packet.data)
-            self.stream_read(self.rx_stream.packet.data, self.rx_stream.packet.header.payload_size - len(self.rx_stream.packet.data))
-            self.rx_stream.checksum = Checksum.crc16(self.rx_stream.checksum, self.rx_stream.packet.data[start_idx:])
-            if len(self.rx_stream.packet.data) != self.rx_stream.packet.header.payload_size:
-                return
-            self.rx_stream.state = state_PACKET_FOOTER
+        # At this point we know the header is corrupt and not trusted
+        # but to speed up stream recovery the packet type is assumed
+        # to be correct
 
-        def state_PACKET_FOOTER():
-            self.stream_read(self.rx_stream.data, FramePacket.Data.Footer.SIZE - len(self.rx_stream.data))
-            if len(self.rx_stream.data) != FramePacket.Data.Footer.SIZE:
-                return
-            self.rx_stream.packet.footer = FramePacket.Data.Footer.from_bytes(self.rx_stream.data)
-            if self.rx_stream.checksum == self.rx_stream.packet.footer.checksum:
-                self.dispatch_packet(self.rx_stream.packet)
-                self.rx_stream.state = state_PACKET_RESET
+        else:
+            self.metrics.header_crc_errors += 1
+            if header.packet_type == FramePacket.Type.DATA_FAF:
+                rx.state = self.state_PACKET_RESET # corrupt FaF packets are droped
+            elif rx.retries > 0:
+                rx.state = self.state_PACKET_RESET # drop everything during retry
             else:
-                self.rx_stream.state = state_PACKET_RESEND
-
-        def state_PACKET_RESEND():
-            if self.rx_stream.retries < self.max_retries or self.max_retries == 0:
-                self.max_retries += 1
-                self.send_response(FramePacket.Response.Type.NACK, self.rx_stream.sync)
-                self.rx_stream.state = state_PACKET_RESET
-            self.rx_stream.state = state_PACKET_ERROR
-
-        def state_PACKET_ERROR():
-            logger.error("data stream error")
-            self.rx_stream.reset_connection()
+                rx.state = self.state_PACKET_RESEND
+
+    def state_PACKET_DATA(self):
+        # the crc is kept up to date over just the bytes each read added
+        rx = self.rx_stream
+        start = rx.length
+        end = rx.packet.header.SIZE + rx.packet.header.payload_size
+        rx.length += self.stream_readinto(rx.view[start:end])
+        rx.checksum = Checksum.crc16(rx.checksum, rx.view[start:rx.length])
+        if rx.length != end:
+            return
+        rx.state = self.state_PACKET_FOOTER
+
+    def state_PACKET_FOOTER(self):
+        # the footer and a Feature.FEC frame's parity after it
+        rx = self.rx_stream
+        start = rx.packet.header.SIZE + rx.packet.header.payload_size
+        end = start + FramePacket.Data.Footer.SIZE + rx.parity_size
+        rx.length += self.stream_readinto(rx.view[rx.length:end])
+        if rx.length != end:
+            return
+        if rx.checksum == FramePacket.Data.Footer.FORMAT.unpack_from(rx.buffer, start)[0] or (rx.parity_size and self.correct_packet(start)):
+            self.dispatch_packet(rx.packet)
+            rx.state = self.state_PACKET_RESET
+        else:
+            self.metrics.payload_crc_errors += 1
+            rx.state = self.state_PACKET_RESEND
+
+    def correct_packet(self, start):
+        # The parity is only looked at once the crc16 has failed, payload and footer are corrected in
+        # place and the corrected payload still has to match the corrected crc16
+        rx = self.rx_stream
+        footer_end = start + FramePacket.Data.Footer.SIZE
+        try:
+            corrected = ReedSolomon.correct(rx.view[rx.packet.header.SIZE:footer_end], rx.view[footer_end:footer_end + rx.parity_size])
+        except ValueError:
+            self.metrics.fec_uncorrectable += 1
+            return False
+        if Checksum.crc16(0, rx.packet.data) != FramePacket.Data.Footer.FORMAT.unpack_from(rx.buffer, start)[0]:
+            self.metrics.fec_uncorrectable += 1
+            return False
+        self.metrics.fec_corrected += 1
+        self.metrics.fec_corrected_bytes += corrected
+        return True
+
+    def state_PACKET_RESEND(self):
+        rx = self.rx_stream
+        if rx.retries < self.max_retries or self.max_retries == 0:
+            rx.retries += 1
+            self.send_response(FramePacket.Response.Type.NACK, rx.sync)
+            rx.state = self.state_PACKET_RESET
+        else:
+            rx.state = self.state_PACKET_ERROR
 
-        def state_PACKET_TIMEOUT():
-            logger.warn("packet timeout")
-            self.rx_stream.state = state_PACKET_RESEND
+    def state_PACKET_ERROR(self):
+        logger.error("data stream error")
+        self.rx_stream.reset_connection()
 
-        if self.rx_stream.state != None:
-            self.rx_stream.state()
-        else: state_PACKET_RESET()
+    def state_PACKET_TIMEOUT(self):
+        logger.warning("packet timeout")
+        self.rx_stream.state = self.state_PACKET_RESEND
 
     def process_response(self, packet):
-        def valid_response():
-            for x in self.tx_stream.queue:
-                if x.header.sync == packet.sync_id:
-                    return True
-            return False
-
-        if valid_response() == False:
+        self.tx_stream.last_activity = time.perf_counter()
+
+        # Frames waiting at the head of tx_queue to be resent after a NACK or timeout keep the sync
+        # numbers they were first sent with, so the remote may still be responding to them
+        in_flight = list(self.tx_stream.queue)
+        for p in self.tx_queue:
+            if not isinstance(p, FramePacket.Data) or p.status != FramePacket.Status.RETRY:
+                break
+            in_flight.append(p)
+
+        sync_mask = self.tx_stream.sync_mask
+        sync_id = packet.sync_id
+        if packet.SYNC_MASK != sync_mask and len(in_flight):
+            # an 8 bit response, sent by the remote before it switched to extended sync numbers,
+            # is taken to be about the frames in flight
+            sync_id = (in_flight[0].header.sync + ((sync_id - in_flight[0].header.sync) & packet.SYNC_MASK)) & sync_mask
+        index = (sync_id - in_flight[0].header.sync) & sync_mask if len(in_flight) else 0
+        # a NACK for the frame after everything in flight means all of it arrived and only the
+        # acknowledgement was lost
+        if index > len(in_flight) or (index == len(in_flight) and packet.response != FramePacket.Response.Type.NACK):
             # fatal stream desync exception ?
             logger.error("received invalid response")
+            self.metrics.invalid_responses += 1
             return
 
-        # if we got a valid response then every packet that was transmitted before this one
-        # can be acknoledged
-
         # logger.debug("Response:\t{}".format(packet))
 
-        while len(self.tx_stream.queue) > 0 and self.tx_stream.queue[0].header.sync != packet.sync_id:
-            p = self.tx_stream.queue.popleft()
+        # if we got a valid response then every packet that was transmitted before this one
+        # can be acknoledged
+        completed = index
+        for p in in_flight[:index]:
             p.status = FramePacket.Status.COMPLETE
             p.response = FramePacket.Response.Type.ACK
 
         if packet.response == FramePacket.Response.Type.ACK:
-            p = self.tx_stream.queue.popleft()
+            p = in_flight[index]
             p.status = FramePacket.Status.COMPLETE
             p.response = packet.response
-            self.tx_stream.sync_last = packet.sync_id
+            completed += 1
         elif packet.response == FramePacket.Response.Type.REJECT:
             # A rejected packet will never be excepted by remote
             # just drop it
-            p = self.tx_stream.queue.popleft()
+            p = in_flight[index]
             p.status = FramePacket.Status.FAILED
             p.response = packet.response
-            self.tx_stream.sync_last = packet.sync_id
-        #elif packet.response == FramePacket.Response.Type.NYET:
-        # todo: NYET packets should requeue all currently queued packets for that channel at the back of the queue
-        #    channel_packets = [x for x in self.tx_stream.queue if x.header.channel == packet.header.channel]
-        else:
-            while len(self.tx_stream.queue):
-                p = self.tx_stream.queue.pop()
-                p.status = FramePacket.Status.RETRY
+            completed += 1
+
+        for p in in_flight[:completed]:
+            if self.tracer is not None:
+                self.trace(p, Trace.Event.ACK if p.status == FramePacket.Status.COMPLETE else Trace.Event.REJECT, self.tx_stream.last_activity)
+            if p.status == FramePacket.Status.COMPLETE and p.transmit_time is not None:
+                # measured from the last time the frame was written, a retransmit restarts the clock
+                self.metrics.ack_latency.record(self.tx_stream.last_activity - p.transmit_time)
+            if self.tx_stream.backoff and p.header.channel in self.tx_stream.backoff and p.status == FramePacket.Status.COMPLETE:
+                del self.tx_stream.backoff[p.header.channel]
+            if len(self.tx_stream.queue):
+                self.tx_stream.queue.popleft()
+                self.tx_stream.queue_bytes -= len(p.data)
+            else:
+                self.tx_queue.popleft()
+            # nothing resends it any more, the service packet may keep the frame around for a while
+            p.wire = None
+
+        if completed:
+            self.tx_stream.sync_last = (in_flight[0].header.sync + completed - 1) & sync_mask
+
+        if packet.response not in (FramePacket.Response.Type.ACK, FramePacket.Response.Type.REJECT):
+            for p in in_flight[completed:]:
                 p.response = packet.response
-                self.tx_queue.appendleft(p)
+            self.requeue_transmitted()
+            self.tx_stream.sync = (sync_id - 1) & sync_mask
+            if packet.response == FramePacket.Response.Type.NYET and index < len(in_flight):
+                # only the refused frame's channel backs off
+                self.hold_channel(in_flight[index].header.channel, sync_id)
+        elif not len(self.tx_stream.queue) and completed:
+            # the next frame sent continues after the last one acknowledged
+            self.tx_stream.sync = self.tx_stream.sync_last
 
     def dispatch_packet(self, packet):
-        if packet.header.channel in self.services and packet.header.packet_id in self.services[packet.header.channel].packets:
-            packet_class = self.services[packet.header.channel].packets[packet.header.packet_id]
-            service_packet = packet_class.from_bytes(packet.data)
-            service_packet._frame_packet = packet
-            self.services[packet.header.channel].dispatch(service_packet)
-            self.send_response(FramePacket.Response.Type.ACK, self.rx_stream.sync)
+        self.metrics.frame_received(packet, packet.header.SIZE + (len(packet.data) + FramePacket.Data.Footer.SIZE if len(packet.data) else 0) + self.rx_stream.parity_size)
+        if packet.header.channel == 0 and packet.header.packet_id == Aggregate.PACKET_ID and self.features & (1 << Feature.AGGREGATE):
+            if not self.dispatch_aggregate(packet):
+                return
+        elif packet.header.channel in self.services and packet.header.packet_id in self.services[packet.header.channel].packets:
+            service = self.services[packet.header.channel]
+            packet_class = service.packets[packet.header.packet_id]
+            if packet.header.packet_type != FramePacket.Type.DATA_FAF and not service.accepting(packet_class, self.channel_pending(packet.header.channel)):
+                # a listener is full, leave rx sync where it is so the remote resends this frame, the
+                # frames already in flight behind it are dropped as during a retry without counting one
+                self.send_response(FramePacket.Response.Type.NYET, self.rx_stream.sync)
+                self.rx_stream.retries = max(self.rx_stream.retries, 1)
+                return
+            self.submit_packet(service, packet_class, packet)
+            # DATA_NACK packets are only answered when something goes wrong, FaF packets never
+            if packet.header.packet_type == FramePacket.Type.DATA:
+                self.send_response(FramePacket.Response.Type.ACK, self.rx_stream.sync)
             #service_class = type(self.services[packet.header.channel])
             #logger.debug("Dispatching:\t{0} to [channel: {2}] {1}".format(service_packet, service_class.__fullqualname__, packet.header.channel))
         else:
             logger.debug("Rejected:\t{}".format(packet))
-            self.send_response(FramePacket.Response.Type.REJECT, self.rx_stream.sync)
+            # a FaF packet carries no sync number of its own to reject, it is just dropped
+            if packet.header.packet_type != FramePacket.Type.DATA_FAF:
+                self.send_response(FramePacket.Response.Type.REJECT, self.rx_stream.sync)
 
         if packet.header.packet_type != FramePacket.Type.DATA_FAF:
-            self.rx_stream.sync = (self.rx_stream.sync + 1) & 0xFF
+            self.rx_stream.sync = (self.rx_stream.sync + 1) & self.rx_stream.sync_mask
+            self.rx_stream.retries = 0
+
+    def dispatch_aggregate(self, packet):
+        # Every packet in the frame is delivered as if it had a frame of its own sharing the aggregate's
+        # sync number. Packets for unknown channels or ids are dropped as the frame as a whole is
+        # acknowledged, the frame is refused with a NYET when any service can't take its packet yet.
+        try:
+            entries = Aggregate.unpack(packet.data)
+        except ValueError as e:
+            logger.error("Rejected malformed aggregate frame: {}".format(e))
+            if packet.header.packet_type != FramePacket.Type.DATA_FAF:
+                self.send_response(FramePacket.Response.Type.REJECT, self.rx_stream.sync)
+            return True
+
+        routes = []
+        for channel, packet_id, payload in entries:
+            service = self.services.get(channel)
+            if service is None or packet_id not in service.packets:
+                logger.debug("Dropped packet id {} for channel {} from aggregate frame".format(packet_id, channel))
+                continue
+            routes.append((service, service.packets[packet_id], channel, packet_id, payload))
+
+        if packet.header.packet_type != FramePacket.Type.DATA_FAF:
+            # each packet also counts the ones before it in this frame for the same channel
+            pending = {}
+            for service, packet_class, channel, _, _ in routes:
+                if not service.accepting(packet_class, self.channel_pending(channel) + pending.get(channel, 0)):
+                    self.send_response(FramePacket.Response.Type.NYET, self.rx_stream.sync)
+                    self.rx_stream.retries = max(self.rx_stream.retries, 1)
+                    return False
+                pending[channel] = pending.get(channel, 0) + 1
+
+        for service, packet_class, channel, packet_id, payload in routes:
+            frame = FramePacket.Data.create(packet.header.packet_type, channel, packet_id, payload)
+            frame.header.sync = packet.header.sync
+            self.submit_packet(service, packet_class, frame)
+        self.metrics.aggregated_rx += len(routes)
+        if packet.header.packet_type == FramePacket.Type.DATA:
+            self.send_response(FramePacket.Response.Type.ACK, self.rx_stream.sync)
+        return True
 
-    def stream_read(self, buffer, size):
-        recv = self.connection.read(size)
-        self.in_log.write(recv)
-        self.in_log.flush()
-        buffer.extend(recv)
+    def submit_packet(self, service, packet_class, packet):
+        # packet is a view of the receive buffer, inline delivery decodes it before the buffer is
+        # reused, the dispatch executor gets a copy to decode later
+        if self.dispatch_executor is None or packet.header.channel == 0:
+            self.deliver_packet(service, packet_class, packet)
+        else:
+            packet = packet.retain()
+            self.dispatch_submitted += 1
+            channel = packet.header.channel
+            self.channel_submitted[channel] = self.channel_submitted.get(channel, 0) + 1
+            self.dispatch_executor.submit(self.deliver_deferred, service, packet_class, packet)
+
+    def deliver_packet(self, service, packet_class, packet):
+        service_packet = packet_class.from_bytes(packet.data)
+        service_packet._frame_packet = packet
+        service.dispatch(service_packet)
+
+    def deliver_deferred(self, service, packet_class, packet):
+        # runs on the dispatch executor, the frame was already acknowledged so a failure can only be logged
+        try:
+            self.deliver_packet(service, packet_class, packet)
+        except Exception as e:
+            logger.error("dispatch of {} to {} failed: {}".format(packet_class.__name__, type(service).__fullqualname__, e))
+        finally:
+            with self.dispatch_lock:
+                self.dispatch_completed += 1
+                channel = packet.header.channel
+                self.channel_completed[channel] = self.channel_completed.get(channel, 0) + 1
+
+    def stream_readinto(self, view):
+        # reads into the receive buffer, connections without readinto() are read and copied
+        if self.profiler is not None:
+            start = self.profiler.begin()
+            nbytes = self.connection_readinto(view)
+            self.profiler.end('io.read', start)
+        else:
+            nbytes = self.connection_readinto(view)
+        if self.capture is not None and nbytes:
+            self.capture.record(Capture.Direction.IN, bytes(view[:nbytes]))
+        return nbytes
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        # the read method is picked once here rather than looked up on every read
+        self._connection = connection
+        self.connection_readinto = getattr(connection, 'readinto', self.connection_read_copy)
+
+    def connection_read_copy(self, view):
+        recv = self.connection.read(len(view))
+        view[:len(recv)] = recv
         return len(recv)
 
     def stream_write(self, buffer):
-        nbytes = self.connection.write(buffer)
-        self.out_log.write(buffer)
-        self.out_log.flush()
+        if self.profiler is not None:
+            start = self.profiler.begin()
+            nbytes = self.connection.write(buffer)
+            self.profiler.end('io.write', start)
+        else:
+            nbytes = self.connection.write(buffer)
+        if self.capture is not None:
+            self.capture.record(Capture.Direction.OUT, buffer)
         return nbytes
 
-    def send_packet(self, packet_type, channel, packet_id, payload):
-        packet = FramePacket.Data.create(packet_type, channel, packet_id, payload)
+    def send_packet(self, packet_type, channel, packet_id, payload, queued_time = None, checksum = None):
+        packet = FramePacket.Data.create(packet_type, channel, packet_id, payload, extended = self.tx_stream.sync_mask != 0xFF, checksum = checksum,
+                                         fec = self.fec and self.negotiated(Feature.FEC))
+        if self.tracer is not None:
+            if queued_time is not None:
+                self.trace(packet, Trace.Event.QUEUED, queued_time)
+            self.trace(packet, Trace.Event.SCHEDULED)
         self.tx_queue.append(packet)
         return packet
 
+    def frame_size(self, payload_size):
+        # wire bytes of a DATA frame with payload_size bytes of payload as send_packet() frames it with
+        # the features negotiated now, header, payload, footer and FEC parity
+        header = FramePacket.Data.ExtendedHeader if self.tx_stream.sync_mask != 0xFF else FramePacket.Data.Header
+        if not payload_size:
+            return header.SIZE
+        parity = ReedSolomon.parity_size(payload_size + FramePacket.Data.Footer.SIZE) if self.fec and self.negotiated(Feature.FEC) else 0
+        return header.SIZE + payload_size + FramePacket.Data.Footer.SIZE + parity
+
     def send_response(self, response_id, packet_sync):
-        self.tx_queue.append(FramePacket.Response(response=response_id, sync_id=packet_sync))
+        response_cls = FramePacket.ExtendedResponse if self.rx_stream.sync_mask != 0xFF else FramePacket.Response
+        self.tx_queue.append(response_cls(response=response_id, sync_id=packet_sync))
 
     def reset_connection(self):
+        # frames queued or in flight belong to the old stream state and will never be acknowledged
+        held = [p for frames in self.tx_stream.held.values() for p in frames]
+        for packet in list(self.tx_stream.queue) + list(self.tx_queue) + held:
+            if isinstance(packet, FramePacket.Data):
+                packet.status = FramePacket.Status.FAILED
+                if self.tracer is not None:
+                    self.trace(packet, Trace.Event.FAILED)
+        self.tx_queue.clear()
+        if self.aggregator is not None:
+            self.aggregator.reset()
         self.rx_stream.reset_connection()
         self.tx_stream.reset_connection()
 
-    def connect(self):
-        self.control.synchronise()
-        time.sleep(0.1)
-        while not self.synchronised:
-            self.control.synchronise()
-            time.sleep(1.0)
-        return self.synchronised
+    def connect(self, timeout = None):
+        # returns as soon as the remote's sync reply arrives, False if it didn't within timeout seconds
+        self.request_sync()
+        if self.control.wait_synchronised(timeout):
+            return True
+        self.cancel_sync()
+        logger.error("{} did not synchronise within {}s".format(self.connection, timeout))
+        return False
+
+    @staticmethod
+    def connect_all(transport_layers, timeout = None):
+        # bring up many links at once, their syncs are all in flight together rather than one after
+        # the other, returns {transport_layer: seconds to synchronise or None if it timed out}
+        for transport_layer in transport_layers:
+            transport_layer.request_sync()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        results = {}
+        for transport_layer in transport_layers:
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0.0)
+            if transport_layer.control.wait_synchronised(remaining):
+                # connect_time is set by the IO thread right after synchronised
+                while transport_layer.sync_retry_at is not None:
+                    time.sleep(0.0001)
+                results[transport_layer] = transport_layer.connect_time
+            else:
+                transport_layer.cancel_sync()
+                results[transport_layer] = None
+        return results
+
+    def change_baudrate(self, baudrate, timeout = 1.0):
+        # returns True once synchronised at the new rate, False if the remote refused it or the link
+        # failed at the new rate and both ends fell back to the previous one
+        return self.control.change_baudrate(baudrate, timeout)
 
     def disconnect(self):
         self.control.disconnect()
@@ -525,4 +1406,10 @@ class TransportLayer(object):
 
     def shutdown(self):
         self.active = False
-        self.worker_thread.join()
\ No newline at end of file
+        self.worker_thread.join()
+        self.stop_dispatch_executor()
+        self.stop_capture()
+        self.stop_trace()
+        profiler = self.stop_profiling()
+        if profiler is not None:
+            logger.info(profiler.report())
\ No newline at end of file
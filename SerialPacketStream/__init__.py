@@ -1,2 +1,3 @@
-from .TransportLayer import TransportLayer, Service, ServicePacketListener, ServicePacket, RawDataPacket
+from .TransportLayer import TransportLayer, Service, ServicePacketListener, ServicePacket, RawDataPacket, Overflow, Feature
 from .FileService import FileService
+from .StreamService import StreamService
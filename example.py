@@ -15,12 +15,22 @@ import filecmp
 
 import SerialPacketStream
 import SerialPacketStream.FileService
+import SerialPacketStream.Emulator
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Send files over a serial port to Marlin')
     parser.add_argument("-p", "--port", default="/dev/ttyACM0", help="serial port to use")
     parser.add_argument("-b", "--baud", default="115200", help="baud rate of serial connection")
     parser.add_argument("-d", "--blocksize", default="512", help="defaults to autodetect")
+    parser.add_argument("-w", "--window", type=int, default=None, help="frames in flight before waiting for an ACK, above 255 needs a remote with extended sync numbers")
+    parser.add_argument("--capture", metavar="DIR", default=None, help="record the raw serial stream to a rotating capture file in DIR")
+    parser.add_argument("--trace", metavar="FILE", default=None, help="write a Chrome trace of every frame's lifecycle to FILE")
+    parser.add_argument("--profile", action="store_true", help="log time spent per receive state and transmit stage on exit")
+    parser.add_argument("--adaptive-blocksize", action="store_true", help="shrink the block size below --blocksize while the link is noisy")
+    parser.add_argument("--fec", action="store_true", help="add Reed-Solomon parity to frames so the remote corrects small errors instead of asking for a resend")
+    parser.add_argument("--aggregate", action="store_true", help="pack small packets into shared frames when the remote supports it")
+    parser.add_argument("--upgrade-baud", type=int, default=None, help="negotiate this baud rate with the remote once connected, staying at --baud if that fails")
+    parser.add_argument("--emulate", action="store_true", help="talk to an in process emulated Marlin instead of a serial port")
     parser.add_argument("--log-level", default='DEBUG', choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'], help="Log Level")
     args = parser.parse_args()
 
@@ -41,17 +51,38 @@ if __name__ == "__main__":
 
     logger.debug("Logger Started")
 
-    logger.info("pySerial Version: {}".format(serial.VERSION))
-    logger.info("Available ports:")
-    for x in serial.tools.list_ports.comports():
-        logger.info("\t{}".format(x))
-    logger.info("Connecting to: {}".format(args.port))
+    emulator = None
+    if args.emulate:
+        emulator = SerialPacketStream.Emulator.Emulator(baudrate = int(args.baud), aggregate = args.aggregate, fec = args.fec)
+        logger.info("Connecting to emulated Marlin at {} baud, files in {}".format(args.baud, emulator.root))
+        serial_connection = emulator.connection
+    else:
+        logger.info("pySerial Version: {}".format(serial.VERSION))
+        logger.info("Available ports:")
+        for x in serial.tools.list_ports.comports():
+            logger.info("\t{}".format(x))
+        logger.info("Connecting to: {}".format(args.port))
 
-    serial_connection = serial.serial_for_url(args.port, baudrate = args.baud, write_timeout = 0, timeout = 0)
+        serial_connection = serial.serial_for_url(args.port, baudrate = args.baud, write_timeout = 0, timeout = 0)
 
     transport_layer = SerialPacketStream.TransportLayer(serial_connection, int(args.blocksize))
+    if args.window is not None:
+        transport_layer.window_size = args.window
+    transport_layer.fec = args.fec
+    if args.capture is not None:
+        transport_layer.start_capture(args.capture)
+    if args.trace is not None:
+        transport_layer.start_trace(args.trace)
+    if args.profile:
+        transport_layer.start_profiling()
+    if args.adaptive_blocksize:
+        transport_layer.start_adaptive_block_size()
+    if args.aggregate:
+        transport_layer.start_aggregation()
     file_service = SerialPacketStream.FileService()
     transport_layer.connect()
+    if args.upgrade_baud is not None:
+        transport_layer.change_baudrate(args.upgrade_baud)
 
     transport_layer.attach(1, file_service)
     file_service.query_remote()
@@ -114,5 +145,7 @@ if __name__ == "__main__":
 
     transport_layer.disconnect()
     transport_layer.shutdown()
+    if emulator is not None:
+        emulator.shutdown()
 
     logger.debug("Main Exit")
@@ -0,0 +1,161 @@
+import time
+import unittest
+from collections import deque
+
+from SerialPacketStream import TransportLayer, FramePacket, Service, RawDataPacket
+import SerialPacketStream.Aggregate as Aggregate
+
+from test_protocol import RawRemote
+
+
+class PackTest(unittest.TestCase):
+    def test_round_trip(self):
+        entries = [(1, 2, b'abc'), (3, 4, b''), (5, 6, bytes(range(255)))]
+        data = Aggregate.pack(entries)
+        self.assertEqual(len(data), sum(Aggregate.SUBHEADER.size + len(x[2]) for x in entries))
+        self.assertEqual([(c, p, bytes(x)) for c, p, x in Aggregate.unpack(data)], entries)
+        self.assertEqual(Aggregate.unpack(b''), [])
+
+    def test_malformed(self):
+        data = Aggregate.pack([(1, 2, b'abc'), (3, 4, b'defg')])
+        # a subheader cut short, and a length running past the end of the frame
+        for malformed in (data + b'\x01\x02', data[:-1]):
+            with self.assertRaises(ValueError):
+                Aggregate.unpack(malformed)
+
+
+class Transport(object):
+    """Stands in for the TransportLayer, frames are recorded rather than sent"""
+    def __init__(self, block_size = 512):
+        self.block_size = block_size
+        self.frames = []
+        self.tx_stream = TxStream()
+        self.metrics = Metrics()
+
+    def max_block_size(self):
+        return self.block_size
+
+    def send_packet(self, packet_type, channel, packet_id, payload, queued_time = None, checksum = None):
+        frame = FramePacket.Data.create(packet_type, channel, packet_id, bytearray(payload))
+        self.frames.append(frame)
+        return frame
+
+
+class TxStream(object):
+    def __init__(self):
+        # a frame in flight, so nothing is due just because the link is idle
+        self.queue = deque([None])
+        self.held = {}
+
+
+class Metrics(object):
+    aggregated_tx = 0
+
+
+class AggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = Transport(block_size = 64)
+        self.aggregator = Aggregate.Aggregator(self.transport, threshold = 32, delay = 0.05)
+
+    def add(self, size, packet_type = FramePacket.Type.DATA_NACK, channel = 1):
+        packet = RawDataPacket(packet_id = 1, data = bytes(size))
+        self.aggregator.add(packet_type, channel, packet, bytes(packet))
+        return packet
+
+    def test_accepts(self):
+        self.assertTrue(self.aggregator.accepts(FramePacket.Type.DATA, 1, bytes(32)))
+        self.assertFalse(self.aggregator.accepts(FramePacket.Type.DATA, 1, bytes(33)))
+        self.assertFalse(self.aggregator.accepts(FramePacket.Type.DATA, 0, bytes(8)))
+        self.assertFalse(self.aggregator.accepts(FramePacket.Type.DATA_FAF, 1, bytes(8)))
+        self.aggregator.stopping = True
+        self.assertFalse(self.aggregator.accepts(FramePacket.Type.DATA, 1, bytes(8)))
+        with self.assertRaises(ValueError):
+            Aggregate.Aggregator(self.transport, threshold = Aggregate.MAX_PAYLOAD + 1)
+
+    def test_size(self):
+        # a packet that doesn't fit the frame any more sends what is held first
+        packets = [self.add(20) for _ in range(3)]
+        self.assertEqual(len(self.transport.frames), 1)
+        frame = self.transport.frames[0]
+        self.assertEqual((frame.header.channel, frame.header.packet_id), (0, Aggregate.PACKET_ID))
+        self.assertEqual(len(Aggregate.unpack(frame.data)), 2)
+        self.assertIs(packets[0].frame_packet, frame)
+        self.assertIs(packets[1].frame_packet, frame)
+        self.assertIsNone(packets[2].frame_packet)
+        self.assertEqual(self.transport.metrics.aggregated_tx, 2)
+
+    def test_full(self):
+        # once what is held fills the frame it is due
+        self.add(28)
+        self.assertFalse(self.aggregator.due())
+        self.add(28)
+        self.assertTrue(self.aggregator.due())
+
+    def test_delay(self):
+        self.add(8)
+        self.assertFalse(self.aggregator.due())
+        time.sleep(0.06)
+        self.assertTrue(self.aggregator.due())
+
+    def test_idle(self):
+        # nothing in flight, what is held goes straight away
+        self.add(8)
+        self.transport.tx_stream.queue.clear()
+        self.assertTrue(self.aggregator.due())
+
+    def test_lone_packet(self):
+        # a single held packet is sent in a normal frame of its own
+        packet = self.add(8, FramePacket.Type.DATA, channel = 3)
+        self.aggregator.flush()
+        frame = self.transport.frames[0]
+        self.assertEqual((frame.header.packet_type, frame.header.channel, frame.header.packet_id), (FramePacket.Type.DATA, 3, 1))
+        self.assertIs(packet.frame_packet, frame)
+        self.assertEqual(self.transport.metrics.aggregated_tx, 0)
+
+    def test_packet_type(self):
+        # the aggregate is only DATA when one of its packets asked for an answer
+        self.add(8)
+        self.add(8)
+        self.aggregator.flush()
+        self.add(8)
+        self.add(8, FramePacket.Type.DATA)
+        self.aggregator.flush()
+        self.assertEqual([x.header.packet_type for x in self.transport.frames], [FramePacket.Type.DATA_NACK, FramePacket.Type.DATA])
+
+    def test_reset(self):
+        packets = [self.add(8), self.add(8)]
+        self.aggregator.reset()
+        self.assertEqual([x.status() for x in packets], [FramePacket.Status.FAILED] * 2)
+        self.assertFalse(self.aggregator.due())
+        self.aggregator.flush()
+        self.assertEqual(self.transport.frames, [])
+
+
+class DispatchAggregateTest(unittest.TestCase):
+    """Aggregate frames arriving from the remote"""
+    def setUp(self):
+        self.remote = RawRemote()
+        self.transport_layer = TransportLayer(self.remote.host, 512)
+        self.addCleanup(self.transport_layer.shutdown)
+        self.service = Service()
+        self.service.register_packet(RawDataPacket, 1)
+        self.transport_layer.attach(1, self.service)
+        self.assertIsNotNone(self.remote.synchronise())
+
+    def test_aggregate(self):
+        payload = Aggregate.pack([(1, 1, b'first'), (1, 1, b'second'), (9, 1, b'dropped')])
+        self.remote.write_frame(FramePacket.Type.DATA, 0, 0, Aggregate.PACKET_ID, payload)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.ACK, 0))
+        self.assertEqual([bytes(x.data) for x in self.service.rx_queue], [b'first', b'second'])
+
+    def test_aggregate_malformed(self):
+        # a truncated or overrunning aggregate is rejected as a whole, none of its packets are delivered
+        payload = Aggregate.pack([(1, 1, b'first'), (1, 1, b'second')])
+        for sync, malformed in ((0, payload + b'\x01'), (1, payload[:-1])):
+            self.remote.write_frame(FramePacket.Type.DATA, sync, 0, Aggregate.PACKET_ID, malformed)
+            self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.REJECT, sync))
+        self.assertEqual(len(self.service.rx_queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService
+from SerialPacketStream.Emulator import Emulator
+
+
+class BaudRateTest(unittest.TestCase):
+    """change_baudrate against the emulated remote, both ends end up at the same rate whatever happens"""
+    def connect(self, **options):
+        self.emulator = Emulator(baudrate = 115200, seed = 1, **options)
+        self.transport_layer = TransportLayer(self.emulator.connection, 512)
+        self.file_service = FileService()
+        self.transport_layer.connect()
+        self.transport_layer.attach(1, self.file_service)
+        self.addCleanup(self.emulator.shutdown)
+        self.addCleanup(self.transport_layer.shutdown)
+
+    def baudrates(self):
+        return (self.emulator.connection.baudrate, self.emulator.remote_connection.baudrate)
+
+    def check_link(self):
+        # a put after the change goes through at whatever rate both ends settled on
+        data = os.urandom(4096)
+        with tempfile.TemporaryDirectory() as directory:
+            src = os.path.join(directory, 'src.bin')
+            with open(src, 'wb') as f:
+                f.write(data)
+            self.file_service.put(src, 'dst.bin')
+        with open(os.path.join(self.emulator.root, 'dst.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_accepted(self):
+        self.connect()
+        self.assertTrue(self.transport_layer.change_baudrate(1000000))
+        self.assertEqual(self.baudrates(), (1000000, 1000000))
+        self.assertTrue(self.transport_layer.synchronised)
+        self.check_link()
+
+    def test_same_rate(self):
+        self.connect()
+        self.assertTrue(self.transport_layer.change_baudrate(115200))
+        self.assertEqual(self.baudrates(), (115200, 115200))
+
+    def test_refused(self):
+        # the remote only agrees to rates it lists, neither end switches
+        self.connect(baudrates = (115200, 250000))
+        self.assertFalse(self.transport_layer.change_baudrate(1000000))
+        self.assertEqual(self.baudrates(), (115200, 115200))
+        self.check_link()
+
+    def test_fallback(self):
+        # the remote agrees but nothing gets through at the new rate, both ends go back to the old one
+        self.connect(max_baudrate = 500000)
+        self.assertFalse(self.transport_layer.change_baudrate(1000000, timeout = 0.5))
+        self.assertEqual(self.baudrates(), (115200, 115200))
+        self.assertTrue(self.transport_layer.synchronised)
+        self.check_link()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from SerialPacketStream import TransportLayer, FramePacket, Feature
+from SerialPacketStream.BlockSize import BlockSizeController
+from SerialPacketStream.Emulator import EmulatedLink, EmulatedConnection
+
+
+class OverheadTest(unittest.TestCase):
+    def setUp(self):
+        self.transport_layer = TransportLayer(EmulatedConnection(EmulatedLink(), EmulatedLink()), 512)
+        self.addCleanup(self.transport_layer.shutdown)
+        self.controller = BlockSizeController(self.transport_layer)
+
+    def check(self, extended, fec):
+        # the overhead is what a frame of the size sent with the negotiated features really costs
+        for size in (64, 247, 512, 1024):
+            frame = FramePacket.Data.create(FramePacket.Type.DATA, 1, 1, bytearray(size), extended = extended, fec = fec)
+            self.assertEqual(self.transport_layer.frame_size(size), len(frame.encode()))
+            self.assertEqual(self.controller.overhead(size), len(frame.encode()) - size)
+
+    def test_legacy(self):
+        self.transport_layer.negotiate(0)
+        self.check(False, False)
+        self.assertEqual(self.controller.overhead(512), FramePacket.Data.Header.SIZE + FramePacket.Data.Footer.SIZE)
+
+    def test_extended_sync(self):
+        self.transport_layer.negotiate(1 << Feature.EXTENDED_SYNC)
+        self.check(True, False)
+
+    def test_fec(self):
+        # parity is only sent once FEC is both negotiated and turned on
+        self.transport_layer.negotiate(1 << Feature.EXTENDED_SYNC | 1 << Feature.FEC)
+        self.check(True, False)
+        self.transport_layer.fec = True
+        self.check(True, True)
+        self.transport_layer.negotiate(1 << Feature.FEC)
+        self.check(False, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
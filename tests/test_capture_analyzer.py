@@ -0,0 +1,136 @@
+import io
+import os
+import time
+import tempfile
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService, FramePacket
+import SerialPacketStream.Capture as Capture
+import SerialPacketStream.CaptureAnalyzer as CaptureAnalyzer
+from SerialPacketStream.Emulator import Emulator
+
+
+def frame(packet_type, sync, payload, channel = 1, packet_id = 1, extended = False, fec = False):
+    packet = FramePacket.Data.create(packet_type, channel, packet_id, bytearray(payload), extended = extended, fec = fec)
+    packet.header.sync = sync
+    return bytes(packet)
+
+
+def response(response, sync):
+    packet = FramePacket.Response()
+    packet.response = response
+    packet.sync_id = sync
+    return bytes(packet)
+
+
+def write_capture(filename, records):
+    # [(direction, data)] as a CaptureLog file, a microsecond apart
+    with open(filename, 'wb') as f:
+        f.write(Capture.HEADER.pack(Capture.MAGIC, Capture.VERSION, 0.0))
+        for index, (direction, data) in enumerate(records):
+            f.write(Capture.RECORD.pack(index * 1e-6, direction, len(data)))
+            f.write(data)
+
+
+class CaptureAnalyzerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_frames(self):
+        payload = os.urandom(64)
+        corrupt = bytearray(frame(FramePacket.Type.DATA, 2, payload))
+        corrupt[FramePacket.Data.Header.SIZE + 5] ^= 0xFF
+        stream = (frame(FramePacket.Type.DATA_NACK, 0, payload) + b'noise' + frame(FramePacket.Type.DATA, 1, payload)
+                  + bytes(corrupt) + frame(FramePacket.Type.DATA, 1, payload) + response(FramePacket.Response.Type.NACK, 2)
+                  + frame(FramePacket.Type.DATA, 3, b'', extended = True))
+        frames = list(CaptureAnalyzer.decode_frames(stream))
+        self.assertEqual([(x.packet_type, x.sync, x.payload_valid) for x in frames],
+                         [(FramePacket.Type.DATA_NACK, 0, True), (FramePacket.Type.DATA, 1, True), (FramePacket.Type.DATA, 2, False),
+                          (FramePacket.Type.DATA, 1, True), (FramePacket.Type.RESPONSE, 2, True), (FramePacket.Type.DATA, 3, True)])
+        self.assertTrue(frames[-1].extended)
+
+        statistics = CaptureAnalyzer.StreamStatistics('IN').scan(stream).as_dict()
+        self.assertEqual(statistics['frames'], {'DATA_NACK': 1, 'DATA': 3, 'RESPONSE': 1})
+        self.assertEqual(statistics['responses'], {'NACK': 1})
+        self.assertEqual(statistics['payload_crc_failures'], 1)
+        self.assertEqual(statistics['retransmits'], 1)
+        self.assertEqual(statistics['payload_bytes'], 64 * 3)
+        self.assertEqual(sum(statistics['packets'].values()), 4)
+        self.assertGreaterEqual(statistics['noise_bytes'], len(b'noise'))
+
+    def test_fec(self):
+        # a payload the receiver would repair from its parity is counted as corrected, the capture
+        # itself is left as recorded
+        wire = bytearray(frame(FramePacket.Type.DATA, 0, os.urandom(128), fec = True))
+        wire[FramePacket.Data.FecHeader.SIZE + 10] ^= 0x55
+        frames = list(CaptureAnalyzer.decode_frames(bytes(wire)))
+        self.assertEqual(len(frames), 1)
+        self.assertTrue(frames[0].fec)
+        self.assertTrue(frames[0].payload_valid)
+        self.assertEqual(frames[0].corrected, 1)
+
+    def test_demultiplex(self):
+        records = [(Capture.Direction.OUT, b'abc'), (Capture.Direction.IN, b'01'), (Capture.Direction.OUT, b'de'), (Capture.Direction.IN, b'2345')]
+        write_capture(self.path('capture.spcap'), records)
+        streams = CaptureAnalyzer.demultiplex(self.path('capture.spcap'))
+        stream, offsets, times = streams[Capture.Direction.OUT]
+        self.assertEqual(bytes(stream), b'abcde')
+        self.assertEqual(list(offsets), [0, 3])
+        self.assertEqual(list(times), [0.0, 2e-6])
+        stream, offsets, times = streams[Capture.Direction.IN]
+        self.assertEqual(bytes(stream), b'012345')
+        self.assertEqual(list(offsets), [0, 2])
+
+    def test_session(self):
+        # a capture recorded by the TransportLayer during a put decodes without a single crc failure
+        emulator = Emulator(baudrate = 1000000, seed = 1)
+        capture = Capture.CaptureLog(self.path('session.spcap'))
+        transport_layer = TransportLayer(emulator.connection, 512, capture = capture)
+        service = FileService()
+        try:
+            transport_layer.connect()
+            transport_layer.attach(1, service)
+            with open(self.path('src.bin'), 'wb') as f:
+                f.write(os.urandom(32 * 1024))
+            service.put(self.path('src.bin'), 'dst.bin')
+        finally:
+            transport_layer.shutdown()
+            emulator.shutdown()
+            capture.close()
+
+        statistics = {x.direction: x.as_dict() for x in CaptureAnalyzer.analyze(self.path('session.spcap'))}
+        out, received = statistics['OUT'], statistics['IN']
+        self.assertGreaterEqual(out['payload_bytes'], 32 * 1024)
+        self.assertGreaterEqual(out['packets']['FileService.FileDataPacket'], 64)
+        self.assertIn('ACK', received['responses'])
+        for d in (out, received):
+            self.assertEqual(d['header_crc_failures'], 0)
+            self.assertEqual(d['payload_crc_failures'], 0)
+            self.assertIsNotNone(d['duration'])
+
+        lines = io.StringIO()
+        CaptureAnalyzer.dump_frames(self.path('session.spcap'), lines)
+        self.assertGreater(len(lines.getvalue().splitlines()), 64)
+
+    def test_throughput(self):
+        # the analyzer is meant for gigabyte captures, a 16MB one has to go through at 10MB/s or more
+        payload = os.urandom(512)
+        stream = b''.join(frame(FramePacket.Type.DATA_NACK, x & 0xFF, payload) for x in range(16 * 1024 * 1024 // 519))
+        records = []
+        for offset in range(0, len(stream), 4096):
+            records.append((Capture.Direction.OUT, stream[offset:offset + 4096]))
+            records.append((Capture.Direction.IN, response(FramePacket.Response.Type.ACK, 0)))
+        write_capture(self.path('large.spcap'), records)
+        start = time.perf_counter()
+        statistics = CaptureAnalyzer.analyze(self.path('large.spcap'))
+        elapsed = time.perf_counter() - start
+        self.assertEqual(statistics[1].as_dict()['payload_crc_failures'], 0)
+        self.assertLess(elapsed, len(stream) / (10 * 1024 * 1024))
+
+
+if __name__ == '__main__':
+    unittest.main()
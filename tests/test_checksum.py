@@ -0,0 +1,51 @@
+import random
+import unittest
+
+import SerialPacketStream.Checksum as Checksum
+
+
+def table16():
+    # the table the firmware, and this package before crc_hqx, computes the payload crc with
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+def crc16_table(crc, buffer, table = table16()):
+    for byte in buffer:
+        crc = ((crc << 8) & 0xFFFF) ^ table[((crc >> 8) ^ byte) & 0x00FF]
+    return crc
+
+
+class Crc16Test(unittest.TestCase):
+    def test_table(self):
+        table = table16()
+        self.assertEqual(table[:4], [0x0000, 0x1021, 0x2042, 0x3063])
+        self.assertEqual(table[-1], 0x1EF0)
+
+    def test_check_value(self):
+        # CRC-CCITT (XModem) check value
+        self.assertEqual(Checksum.crc16(0, b'123456789'), 0x31C3)
+
+    def test_matches_table(self):
+        rng = random.Random(1)
+        for size in (0, 1, 2, 7, 255, 256, 512, 4096):
+            data = bytes(rng.randrange(256) for _ in range(size))
+            for crc in (0, 0x1D0F, 0xFFFF):
+                self.assertEqual(Checksum.crc16(crc, data), crc16_table(crc, data))
+
+    def test_incremental(self):
+        # the receiver updates the crc over each read as it arrives
+        data = bytes(range(256)) * 3
+        crc = 0
+        for start in range(0, len(data), 100):
+            crc = Checksum.crc16(crc, memoryview(data)[start:start + 100])
+        self.assertEqual(crc, crc16_table(0, data))
+
+
+if __name__ == '__main__':
+    unittest.main()
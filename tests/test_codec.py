@@ -0,0 +1,189 @@
+import gc
+import struct
+import unittest
+from array import array
+
+import SerialPacketStream.Codec as Codec
+
+
+class Fixed(Codec.Serializable):
+    index : Codec.uint8_t
+    values : Codec.basic_array(Codec.int16_t, 4)
+    scale : Codec.float_t
+
+
+class Counted(Codec.Serializable):
+    count : Codec.uint16_t
+    values : Codec.basic_array(Codec.uint32_t, 'count')
+    tail : Codec.uint8_t
+
+
+class Samples(Codec.Serializable):
+    count : Codec.uint8_t
+    samples : Codec.basic_array(Codec.double_t, 'count', numpy = True)
+
+
+class Nested(Codec.Serializable):
+    first : Fixed
+    points : Codec.basic_array(Fixed, 2)
+
+
+class Wrapped(Codec.Serializable):
+    fixed : Fixed
+    checksum : Codec.crc16_t
+
+
+class Base(Codec.Serializable):
+    a : Codec.uint8_t
+    b : Codec.uint16_t
+
+
+class Inherited(Base):
+    pass
+
+
+class Extended(Base):
+    c : Codec.uint32_t
+
+
+def element_encoding(token, values):
+    # how basic_array fields were encoded before the bulk path, one struct.pack per element
+    return b''.join(struct.pack('<' + token, x) for x in values)
+
+
+class BasicArrayTest(unittest.TestCase):
+    def test_encode(self):
+        for datatype, values in ((Codec.uint8_t, [0, 1, 255]), (Codec.int16_t, [-32768, -1, 0, 32767]), (Codec.uint32_t, [0, 2 ** 32 - 1]),
+                                 (Codec.int64_t, [-2 ** 63, 2 ** 63 - 1]), (Codec.float_t, [0.5, -1.25]), (Codec.double_t, [1e300, -2.5])):
+            field = Codec.basic_array(datatype, len(values))
+            expected = element_encoding(datatype.token, values)
+            self.assertEqual(field.encode(values), expected)
+            self.assertEqual(field.encode(tuple(values)), expected)
+            self.assertEqual(field.encode(array(datatype.token, values)), expected)
+            decoded = field.decode(Codec.OffsetBuffer(expected), len(values))
+            self.assertEqual(decoded, array(datatype.token, values))
+
+    def test_truncated(self):
+        field = Codec.basic_array(Codec.uint32_t, 4)
+        with self.assertRaises(struct.error):
+            field.decode(Codec.OffsetBuffer(bytes(15)), 4)
+
+    def test_fixed(self):
+        packet = Fixed(7, [1, -2, 3, -4], 0.5)
+        data = bytes(packet)
+        self.assertEqual(data, struct.pack('<B', 7) + element_encoding('h', [1, -2, 3, -4]) + struct.pack('<f', 0.5))
+        decoded = Fixed.from_bytes(data)
+        self.assertEqual((decoded.index, list(decoded.values), decoded.scale), (7, [1, -2, 3, -4], 0.5))
+        self.assertIsInstance(decoded.values, array)
+
+    def test_length_field(self):
+        # the length field is filled in from the array when encoding and read back first when decoding
+        packet = Counted(values = [1, 2, 3, 2 ** 32 - 1], tail = 9)
+        data = bytes(packet)
+        self.assertEqual(packet.count, 4)
+        self.assertEqual(data, struct.pack('<H', 4) + element_encoding('I', [1, 2, 3, 2 ** 32 - 1]) + struct.pack('<B', 9))
+        decoded = Counted.from_bytes(data)
+        self.assertEqual((decoded.count, list(decoded.values), decoded.tail), (4, [1, 2, 3, 2 ** 32 - 1], 9))
+        empty = Counted.from_bytes(bytes(Counted(values = [], tail = 1)))
+        self.assertEqual((empty.count, list(empty.values), empty.tail), (0, [], 1))
+
+    def test_nested(self):
+        # arrays of Serializables are still encoded element by element
+        points = [Fixed(1, [1, 2, 3, 4], 1.0), Fixed(2, [5, 6, 7, 8], 2.0)]
+        data = bytes(Nested(Fixed(0, [0, 0, 0, 0], 0.0), points))
+        self.assertEqual(data, bytes(Fixed(0, [0, 0, 0, 0], 0.0)) + b''.join(bytes(x) for x in points))
+        decoded = Nested.from_bytes(data)
+        self.assertEqual([(x.index, list(x.values)) for x in decoded.points], [(1, [1, 2, 3, 4]), (2, [5, 6, 7, 8])])
+
+
+@unittest.skipIf(Codec.numpy is None, "numpy not installed")
+class NumpyTest(unittest.TestCase):
+    def test_array(self):
+        numpy = Codec.numpy
+        values = numpy.array([0.5, -1.5, 1e-9])
+        data = bytes(Samples(samples = values))
+        self.assertEqual(data, struct.pack('<B', 3) + element_encoding('d', values.tolist()))
+        buffer = bytearray(data)
+        decoded = Samples.from_bytes(buffer)
+        self.assertIsInstance(decoded.samples, numpy.ndarray)
+        self.assertEqual(decoded.samples.tolist(), values.tolist())
+        # a copy, the buffer it was received in can be reused
+        buffer[1:] = bytes(len(buffer) - 1)
+        self.assertEqual(decoded.samples.tolist(), values.tolist())
+
+    def test_encode_ndarray(self):
+        # any dtype is converted to the field's
+        numpy = Codec.numpy
+        field = Codec.basic_array(Codec.int16_t, 3)
+        self.assertEqual(field.encode(numpy.array([1, -2, 3], dtype = numpy.int64)), element_encoding('h', [1, -2, 3]))
+
+    def test_numpy_dtype(self):
+        dtype = Fixed.numpy_dtype()
+        self.assertEqual(dtype.itemsize, len(bytes(Fixed())))
+        self.assertEqual(dtype.names, ('index', 'values', 'scale'))
+        self.assertEqual(Wrapped.numpy_dtype().itemsize, len(bytes(Wrapped())))
+        # variable length arrays and arrays of Serializables have no fixed layout
+        for cls in (Counted, Nested):
+            with self.assertRaises(TypeError):
+                cls.numpy_dtype()
+
+    def test_decode_batch(self):
+        packets = [Fixed(x, [x, -x, 2 * x, -2 * x], x / 2) for x in range(10)]
+        records = Fixed.decode_batch([bytes(x) for x in packets])
+        self.assertEqual(len(records), 10)
+        for record, packet in zip(records, packets):
+            decoded = Fixed.from_bytes(bytes(packet))
+            self.assertEqual(int(record['index']), decoded.index)
+            self.assertEqual(record['values'].tolist(), list(decoded.values))
+            self.assertEqual(float(record['scale']), decoded.scale)
+        with self.assertRaises(ValueError):
+            Fixed.decode_batch([bytes(packets[0]), bytes(packets[1])[:-1]])
+
+
+class SerializableTest(unittest.TestCase):
+    def test_inherited_annotations(self):
+        # a subclass without annotations of its own keeps its parent's, one adding some goes after them
+        self.assertEqual(list(Codec.inherited_annotations(Inherited)), ['a', 'b'])
+        self.assertEqual(list(Codec.inherited_annotations(Extended)), ['a', 'b', 'c'])
+        self.assertEqual(bytes(Inherited(1, 2)), bytes(Base(1, 2)))
+        decoded = Inherited.from_bytes(bytes(Base(1, 2)))
+        self.assertEqual((decoded.a, decoded.b), (1, 2))
+
+    def test_fmt_list_cache(self):
+        # each class builds its format list once, a subclass never decodes with its parent's
+        data = bytes(Extended(1, 2, 3))
+        base = Base.from_bytes(data)
+        self.assertIsNotNone(Base.__dict__.get('fmt_list'))
+        cached = Base.fmt_list
+        Base.from_bytes(data)
+        self.assertIs(Base.fmt_list, cached)
+        extended = Extended.from_bytes(data)
+        self.assertIsNot(Extended.fmt_list, Base.fmt_list)
+        self.assertEqual((base.a, base.b), (1, 2))
+        self.assertEqual((extended.a, extended.b, extended.c), (1, 2, 3))
+
+    def test_from_offsetbuffer(self):
+        # packets decoded one after another out of one buffer, each picking up where the last stopped
+        buffer = Codec.OffsetBuffer(bytes(Fixed(1, [1, 2, 3, 4], 1.0)) + bytes(Counted(values = [5, 6], tail = 7)))
+        fixed = Fixed.from_offsetbuffer(buffer)
+        counted = Counted.from_offsetbuffer(buffer)
+        self.assertEqual(buffer.offset, len(buffer.memory))
+        self.assertEqual(list(fixed.values), [1, 2, 3, 4])
+        self.assertEqual((list(counted.values), counted.tail), ([5, 6], 7))
+
+    def test_no_garbage(self):
+        # decoding leaves no reference cycles behind for the garbage collector
+        data = bytes(Nested())
+        Nested.from_bytes(data)
+        gc.collect()
+        gc.disable()
+        try:
+            for _ in range(100):
+                Nested.from_bytes(data)
+            self.assertEqual(gc.collect(), 0)
+        finally:
+            gc.enable()
+
+
+if __name__ == '__main__':
+    unittest.main()
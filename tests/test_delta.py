@@ -0,0 +1,117 @@
+import os
+import random
+import tempfile
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService
+from SerialPacketStream.FileService import PacketCode, ActionResponsePacket
+from SerialPacketStream.Emulator import Emulator
+import SerialPacketStream.Delta as Delta
+
+
+def apply(old, data, ops):
+    # rebuilds data from old the way the remote does, copies from old and literal data from data
+    return b''.join(old[basis:basis + length] if basis is not None else data[offset:offset + length] for offset, length, basis in ops)
+
+
+class DeltaTest(unittest.TestCase):
+    block_size = 64
+
+    def delta(self, old, new):
+        weaks, strongs = Delta.signature(old, self.block_size)
+        return Delta.delta(new, weaks, strongs, self.block_size)
+
+    def test_rebuild(self):
+        rng = random.Random(1)
+        old = bytes(rng.getrandbits(8) for _ in range(64 * 100 + 17))
+        # an edit, an insertion and a deletion
+        new = old[:1000] + b'edit' + old[1004:3000] + b'inserted' + old[3000:5000] + old[5100:]
+        ops = self.delta(old, new)
+        self.assertEqual(apply(old, new, ops), new)
+        literal = sum(length for _, length, basis in ops if basis is None)
+        self.assertLess(literal, 6 * self.block_size)
+
+    def test_unchanged(self):
+        # whole blocks are copied in one run, only the short last block is sent
+        old = os.urandom(64 * 10 + 5)
+        ops = self.delta(old, old)
+        self.assertEqual(ops, [(0, 640, 0), (640, 5, None)])
+
+    def test_no_match(self):
+        new = os.urandom(300)
+        self.assertEqual(self.delta(os.urandom(300), new), [(0, 300, None)])
+        self.assertEqual(apply(b'', new, self.delta(b'', new)), new)
+
+
+class EmulatedDeltaTest(unittest.TestCase):
+    """put_delta against the emulated remote, the remote rebuilds the file from its old copy"""
+    size = 256 * 1024
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.emulator = Emulator(baudrate = 1000000, seed = 1)
+        self.transport_layer = TransportLayer(self.emulator.connection, 512)
+        self.file_service = FileService()
+        self.transport_layer.connect()
+        self.transport_layer.attach(1, self.file_service)
+        self.file_service.query_remote()
+        self.old = os.urandom(self.size)
+        self.new = self.old[:self.size // 3] + os.urandom(100) + self.old[self.size // 3 + 100:]
+
+    def tearDown(self):
+        self.transport_layer.shutdown()
+        self.emulator.shutdown()
+        self.directory.cleanup()
+
+    def write_local(self, data):
+        path = os.path.join(self.directory.name, 'src.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def remote(self):
+        with open(os.path.join(self.emulator.root, 'dst.bin'), 'rb') as f:
+            return f.read()
+
+    def bytes_sent(self, send):
+        self.transport_layer.metrics.reset()
+        send()
+        return sum(self.transport_layer.metrics.bytes_tx.values())
+
+    def test_put_delta(self):
+        src = self.write_local(self.old)
+        put = self.bytes_sent(lambda: self.file_service.put(src, 'dst.bin'))
+        self.assertEqual(self.remote(), self.old)
+
+        src = self.write_local(self.new)
+        delta = self.bytes_sent(lambda: self.assertTrue(self.file_service.put_delta(src, 'dst.bin')))
+        self.assertEqual(self.remote(), self.new)
+        # the unchanged blocks are copied on the remote, well under a tenth of the file goes over the link
+        self.assertLess(delta, put / 10)
+
+    def test_put_delta_no_remote_file(self):
+        # without a copy on the remote the whole file is sent
+        src = self.write_local(self.new)
+        self.assertFalse(self.file_service.put_delta(src, 'dst.bin'))
+        self.assertEqual(self.remote(), self.new)
+
+    def test_write_delta(self):
+        with open(os.path.join(self.emulator.root, 'dst.bin'), 'wb') as f:
+            f.write(self.old)
+        remote = self.file_service.signature('dst.bin', 512)
+        self.assertEqual(remote, (len(self.old),) + Delta.signature(self.old, 512))
+        ops = Delta.delta(self.new, remote[1], remote[2], 512)
+        self.assertTrue(self.file_service.write_delta('dst.bin', self.new, ops))
+        self.assertEqual(self.remote(), self.new)
+
+    def test_signature_timeout(self):
+        # a remote that accepts the request and never sends the signature doesn't hang the host
+        remote = self.emulator.remote.file_service
+        remote.handlers[PacketCode.SIGNATURE] = lambda packet: remote.respond(ActionResponsePacket.Code.SUCCESS)
+        with open(os.path.join(self.emulator.root, 'dst.bin'), 'wb') as f:
+            f.write(self.old)
+        self.assertIsNone(self.file_service.signature('dst.bin', timeout = 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
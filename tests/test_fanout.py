@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService
+from SerialPacketStream.Emulator import Emulator
+import SerialPacketStream.FanOut as FanOut
+import SerialPacketStream.Checksum as Checksum
+
+
+class SharedUploadTest(unittest.TestCase):
+    def test_shared_blocks(self):
+        upload = FanOut.SharedUpload(os.urandom(4096))
+        a = upload.reader()
+        b = upload.reader()
+        data, checksum = a.block(512, 512)
+        self.assertIs(b.block(512, 512)[0], data)
+        self.assertEqual(checksum, Checksum.crc16(0, upload.data[512:1024]))
+
+    def test_evict(self):
+        # a block is kept until every reader has released past it
+        upload = FanOut.SharedUpload(os.urandom(4096))
+        a = upload.reader()
+        b = upload.reader()
+        for offset in range(0, 2048, 512):
+            a.block(offset, 512)
+        a.release(2048)
+        self.assertEqual(len(upload.blocks), 4)
+        b.block(0, 512)
+        b.release(512)
+        self.assertEqual(sorted(upload.blocks), [(512, 512), (1024, 512), (1536, 512)])
+        # a reader that is done, or failed, holds nothing back
+        b.close()
+        self.assertEqual(len(upload.blocks), 0)
+
+
+class FanOutTest(unittest.TestCase):
+    def test_put(self):
+        emulators = [Emulator(baudrate = 1000000, seed = x) for x in range(2)]
+        transport_layers = [TransportLayer(x.connection, 512) for x in emulators]
+        services = [FileService() for _ in emulators]
+        for transport_layer, service in zip(transport_layers, services):
+            transport_layer.connect()
+            transport_layer.attach(1, service)
+        data = os.urandom(64 * 1024)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                src = os.path.join(directory, 'src.bin')
+                with open(src, 'wb') as f:
+                    f.write(data)
+                results = FanOut.put(services, src, 'dst.bin')
+            self.assertTrue(all(x.ok for x in results))
+            for emulator in emulators:
+                with open(os.path.join(emulator.root, 'dst.bin'), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+        finally:
+            for transport_layer, emulator in zip(transport_layers, emulators):
+                transport_layer.shutdown()
+                emulator.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService, FramePacket
+from SerialPacketStream.FileService import PacketCode
+from SerialPacketStream.Emulator import Emulator
+
+
+class FileServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = Emulator(baudrate = 1000000, seed = 1)
+        self.transport_layer = TransportLayer(self.emulator.connection, 512)
+        self.transport_layer.connect()
+
+    def attach(self, service):
+        self.transport_layer.attach(1, service)
+        return service
+
+    def tearDown(self):
+        self.transport_layer.shutdown()
+        self.emulator.shutdown()
+
+    def read_remote(self, filename):
+        with open(os.path.join(self.emulator.root, filename), 'rb') as f:
+            return f.read()
+
+    def test_write_block_multiple(self):
+        # the last block of a buffer that is an exact multiple of the block size is still a full
+        # block, it has to go out as DATA for write() to see it acknowledged
+        service = self.attach(FileService())
+        data = os.urandom(8 * service.max_block_size())
+        self.assertTrue(service.open('dst.bin'))
+        self.assertEqual(service.write(data), len(data))
+        self.assertTrue(service.close())
+        self.assertEqual(self.read_remote('dst.bin'), data)
+
+    def test_batch_write_last_block(self):
+        # a batched write reports success only once its last block, sent as DATA, is acknowledged
+        class Service(FileService):
+            def send_packet(self, packet, packet_type = FramePacket.Type.DATA, block = False):
+                packet = super().send_packet(packet, packet_type = packet_type, block = block)
+                if packet.packet_id == PacketCode.WRITE:
+                    self.writes.append((packet_type, packet.status()))
+                return packet
+
+        service = self.attach(Service())
+        service.writes = []
+        data = os.urandom(8 * service.max_block_size() + 10)
+        self.assertEqual(service.batch().open('dst.bin').write(data).close().run(timeout = 5.0), [True, len(data), True])
+        self.assertEqual(len(service.writes), 9)
+        self.assertEqual(service.writes[-1], (FramePacket.Type.DATA, FramePacket.Status.COMPLETE))
+        self.assertEqual(self.read_remote('dst.bin'), data)
+
+    def test_batch_write_link_lost(self):
+        # a batched write cut short by a reconnect fails and leaves no file open to resume
+        emulator = self.emulator
+        class Service(FileService):
+            writes = 0
+            def send_packet(self, packet, packet_type = FramePacket.Type.DATA, block = False):
+                if packet.packet_id == PacketCode.WRITE:
+                    self.writes += 1
+                    if self.writes == 3:
+                        emulator.connection.drop()
+                        while self._transport_layer.reconnects == 0:
+                            self.idle(0.001)
+                return super().send_packet(packet, packet_type = packet_type, block = block)
+
+        service = self.attach(Service())
+        data = os.urandom(64 * service.max_block_size())
+        self.assertEqual(service.batch().open('dst.bin').run(timeout = 5.0), [True])
+        self.assertIsNotNone(service.open_file)
+        self.assertEqual(service.batch().write(data).run(timeout = 5.0), [None])
+        self.assertIsNone(service.open_file)
+        self.assertEqual(self.transport_layer.reconnects, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
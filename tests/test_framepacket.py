@@ -0,0 +1,28 @@
+import unittest
+
+from SerialPacketStream import FramePacket
+import SerialPacketStream.Checksum as Checksum
+
+
+class DataTest(unittest.TestCase):
+    def test_empty_payload(self):
+        # a frame without a payload is its header alone, receivers only read a footer after a payload
+        frame = FramePacket.Data.create(FramePacket.Type.DATA, 0, 7, bytearray())
+        wire = bytes(frame)
+        self.assertEqual(len(wire), FramePacket.Data.Header.SIZE)
+        packet = FramePacket.Data.from_bytearray(bytearray(wire))
+        self.assertEqual(packet.header.payload_size, 0)
+        self.assertEqual(len(packet.data), 0)
+
+    def test_payload(self):
+        payload = bytearray(range(64))
+        frame = FramePacket.Data.create(FramePacket.Type.DATA, 1, 2, payload)
+        wire = bytes(frame)
+        self.assertEqual(len(wire), FramePacket.Data.Header.SIZE + len(payload) + FramePacket.Data.Footer.SIZE)
+        packet = FramePacket.Data.from_bytearray(bytearray(wire))
+        self.assertEqual(packet.data, payload)
+        self.assertEqual(packet.footer.checksum, Checksum.crc16(0, payload))
+
+
+if __name__ == '__main__':
+    unittest.main()
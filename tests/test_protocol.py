@@ -0,0 +1,234 @@
+import time
+import unittest
+
+from SerialPacketStream import TransportLayer, FramePacket, StreamService
+from SerialPacketStream.TransportLayer import SyncPacket, ClosePacket
+from SerialPacketStream.Emulator import EmulatedLink, EmulatedConnection
+
+
+class RawRemote(object):
+    """The remote end of a link driven by hand, frames and responses are written and read as bytes
+    so the host TransportLayer's answers can be checked on the wire"""
+    def __init__(self, timeout = 1.0):
+        to_remote = EmulatedLink()
+        to_host = EmulatedLink()
+        self.host = EmulatedConnection(to_host, to_remote, 'host')
+        self.connection = EmulatedConnection(to_remote, to_host, 'remote')
+        self.timeout = timeout
+        self.buffer = bytearray()
+
+    def read(self, size, timeout):
+        # None when size bytes don't arrive within timeout seconds
+        deadline = time.perf_counter() + timeout
+        while len(self.buffer) < size:
+            if time.perf_counter() >= deadline:
+                return None
+            self.buffer += self.connection.read(size - len(self.buffer))
+            time.sleep(0.0001)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def next(self, timeout = None):
+        # the next frame or response the host sent, anything that isn't one is skipped
+        # (packet type, sync, channel, packet id, payload) for frames, (RESPONSE, response, sync id) for responses
+        timeout = self.timeout if timeout is None else timeout
+        start = self.read(1, timeout)
+        while start is not None:
+            second = self.read(1, timeout)
+            if second is None:
+                return None
+            if start[0] == FramePacket.Data.Header.HEADER_TOKEN & 0xFF and second[0] & 0xFC == FramePacket.Data.Header.HEADER_TOKEN >> 8:
+                break
+            start = second
+        if start is None:
+            return None
+        packet_type = second[0] & 0x03
+        token = start + second
+        if packet_type == FramePacket.Type.RESPONSE:
+            response = FramePacket.Response.from_bytes(token + self.read(FramePacket.Response.SIZE - 2, timeout))
+            return (packet_type, response.response, response.sync_id)
+        header = FramePacket.Data.Header.from_bytes(token + self.read(FramePacket.Data.Header.SIZE - 2, timeout))
+        payload = self.read(header.payload_size + FramePacket.Data.Footer.SIZE, timeout)[:header.payload_size] if header.payload_size else b''
+        return (packet_type, header.sync, header.channel, header.packet_id, payload)
+
+    def write_frame(self, packet_type, sync, channel, packet_id, payload = b'', corrupt = False):
+        packet = FramePacket.Data.create(packet_type, channel, packet_id, bytearray(payload))
+        packet.header.sync = sync
+        wire = bytearray(bytes(packet))
+        if corrupt:
+            wire[FramePacket.Data.Header.SIZE - 1] ^= 0xFF
+        self.connection.write(bytes(wire))
+
+    def write_response(self, response, sync_id, corrupt = False):
+        wire = bytearray(bytes(FramePacket.Response(response = response, sync_id = sync_id)))
+        if corrupt:
+            wire[-1] ^= 0xFF
+        self.connection.write(bytes(wire))
+
+    def synchronise(self):
+        # a remote requested sync, returns the host's SyncPacket reply once it is acknowledged
+        self.write_frame(FramePacket.Type.DATA_FAF, 0, 0, SyncPacket.packet_id, bytes(SyncPacket(*TransportLayer.VERSION, 512, 512)))
+        while True:
+            packet = self.next()
+            if packet is None:
+                return None
+            if packet[0] == FramePacket.Type.DATA and packet[2] == 0 and packet[3] == SyncPacket.packet_id:
+                self.write_response(FramePacket.Response.Type.ACK, packet[1])
+                return SyncPacket.from_bytes(packet[4])
+
+
+class ProtocolTest(unittest.TestCase):
+    """The host's side of the transport protocol as seen on the wire"""
+    def setUp(self):
+        self.remote = RawRemote()
+        self.transport_layer = TransportLayer(self.remote.host, 512)
+        self.addCleanup(self.transport_layer.shutdown)
+
+    def wait_status(self, packet, status = FramePacket.Status.COMPLETE, timeout = 1.0):
+        deadline = time.perf_counter() + timeout
+        while packet.status() != status:
+            if time.perf_counter() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def test_sync_reply(self):
+        # the reply to a remote's sync request carries the version first then this end's buffer sizes
+        self.transport_layer.serial_buffer_size = 1024
+        self.transport_layer.payload_buffer_size = 256
+        packet = self.remote.synchronise()
+        self.assertIsNotNone(packet)
+        self.assertEqual([packet.version_major, packet.version_minor, packet.version_patch], TransportLayer.VERSION)
+        self.assertEqual(packet.serial_buffer_size, 1024)
+        self.assertEqual(packet.payload_buffer_size, 256)
+        self.assertTrue(self.transport_layer.synchronised)
+
+    def test_resend(self):
+        # a corrupt frame is NACKed once, frames behind it are dropped until it is resent and the
+        # receive stream carries on from the same sync number
+        self.assertIsNotNone(self.remote.synchronise())
+        self.remote.write_frame(FramePacket.Type.DATA, 0, 9, 1)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.REJECT, 0))
+        self.remote.write_frame(FramePacket.Type.DATA, 1, 9, 1, corrupt = True)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.NACK, 1))
+        self.remote.write_frame(FramePacket.Type.DATA, 2, 9, 1)
+        self.assertIsNone(self.remote.next(0.05))
+        self.remote.write_frame(FramePacket.Type.DATA, 1, 9, 1)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.REJECT, 1))
+        self.assertEqual(self.transport_layer.rx_stream.retries, 0)
+        self.assertEqual(self.transport_layer.max_retries, 0)
+
+    def test_corrupt_response(self):
+        # a response failing its checksum is dropped, the next one is read as usual
+        self.assertIsNotNone(self.remote.synchronise())
+        packet = self.transport_layer.control.send_packet(ClosePacket())
+        frame = self.remote.next()
+        self.assertEqual(frame[:4], (FramePacket.Type.DATA, 1, 0, ClosePacket.packet_id))
+        self.remote.write_response(FramePacket.Response.Type.ACK, 1, corrupt = True)
+        self.remote.write_response(FramePacket.Response.Type.ACK, 1)
+        self.assertTrue(self.wait_status(packet))
+
+    def test_nack_resend(self):
+        # a NACK acknowledges everything before it, the NACKed frame and those after it are resent
+        # with the sync numbers they were first sent with
+        self.assertIsNotNone(self.remote.synchronise())
+        packets = [self.transport_layer.control.send_packet(ClosePacket(), packet_type = x)
+            for x in (FramePacket.Type.DATA_NACK, FramePacket.Type.DATA_NACK, FramePacket.Type.DATA)]
+        self.assertEqual([self.remote.next()[1] for _ in packets], [1, 2, 3])
+        self.remote.write_response(FramePacket.Response.Type.NACK, 2)
+        self.assertEqual([self.remote.next()[1] for _ in packets[1:]], [2, 3])
+        self.assertTrue(self.wait_status(packets[0]))
+        self.remote.write_response(FramePacket.Response.Type.ACK, 3)
+        self.assertTrue(all(self.wait_status(x) for x in packets))
+
+    def test_response_timeout(self):
+        # frames in flight with no response at all are resent once response_timeout passes
+        self.transport_layer.response_timeout = 0.05
+        self.assertIsNotNone(self.remote.synchronise())
+        packet = self.transport_layer.control.send_packet(ClosePacket())
+        self.assertEqual(self.remote.next()[:2], (FramePacket.Type.DATA, 1))
+        self.assertEqual(self.remote.next()[:2], (FramePacket.Type.DATA, 1))
+        self.remote.write_response(FramePacket.Response.Type.ACK, 1)
+        self.assertTrue(self.wait_status(packet))
+
+    def test_window(self):
+        # at most 255 frames are in flight with 8 bit sync numbers, the last one asks for an ACK
+        self.transport_layer.response_timeout = 10.0
+        self.assertIsNotNone(self.remote.synchronise())
+        for _ in range(300):
+            self.transport_layer.control.send_packet(ClosePacket(), packet_type = FramePacket.Type.DATA_NACK)
+        frames = []
+        frame = self.remote.next()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.remote.next(0.05)
+        self.assertEqual(len(frames), 255)
+        self.assertEqual([x[1] for x in frames], [(x + 1) & 0xFF for x in range(255)])
+        self.assertTrue(all(x[0] == FramePacket.Type.DATA_NACK for x in frames[:-1]))
+        self.assertEqual(frames[-1][0], FramePacket.Type.DATA)
+        self.remote.write_response(FramePacket.Response.Type.ACK, frames[-1][1])
+        self.assertEqual(len([x for x in iter(lambda: self.remote.next(0.05), None)]), 45)
+
+    def test_acknowledge_data(self):
+        # only DATA frames are ACKed, DATA_NACK frames are only answered when something goes wrong
+        # and DATA_FAF frames never
+        self.assertIsNotNone(self.remote.synchronise())
+        self.remote.write_frame(FramePacket.Type.DATA_NACK, 0, 0, ClosePacket.packet_id)
+        self.remote.write_frame(FramePacket.Type.DATA_FAF, 0, 0, ClosePacket.packet_id)
+        self.assertIsNone(self.remote.next(0.05))
+        self.remote.write_frame(FramePacket.Type.DATA, 1, 0, ClosePacket.packet_id)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.ACK, 1))
+
+    def test_reject(self):
+        # frames for a channel or packet id nobody handles are REJECTed unless they are DATA_FAF
+        self.assertIsNotNone(self.remote.synchronise())
+        self.remote.write_frame(FramePacket.Type.DATA_FAF, 0, 9, 1)
+        self.assertIsNone(self.remote.next(0.05))
+        self.remote.write_frame(FramePacket.Type.DATA, 0, 9, 1)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.REJECT, 0))
+
+    def test_scan_noise(self):
+        # everything buffered is searched for a frame start in one pass of the receive state machine
+        self.transport_layer.shutdown()
+        self.remote.connection.write(bytes(1000))
+        self.remote.write_response(FramePacket.Response.Type.ACK, 0)
+        self.transport_layer.process_receive()
+        self.assertEqual(self.transport_layer.rx_stream.state.__name__, 'state_PACKET_RESPONSE')
+        self.assertEqual(self.remote.host.in_waiting, FramePacket.Response.SIZE - 2)
+
+    def test_nyet_dispatch_pending(self):
+        # packets handed to the dispatch executor but not yet delivered count against a NYET listener
+        class Executor(object):
+            def __init__(self):
+                self.held = []
+            def submit(self, fn, *args):
+                self.held.append((fn, args))
+            def run(self):
+                while len(self.held):
+                    fn, args = self.held.pop(0)
+                    fn(*args)
+
+        executor = Executor()
+        stream = StreamService(rx_packets = 2)
+        self.transport_layer.attach(2, stream)
+        self.transport_layer.start_dispatch_executor(executor)
+        # before shutdown(), it waits for everything submitted to be dispatched
+        self.addCleanup(executor.run)
+        self.assertIsNotNone(self.remote.synchronise())
+        for sync in range(3):
+            self.remote.write_frame(FramePacket.Type.DATA, sync, 2, 0, b'x')
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.ACK, 0))
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.ACK, 1))
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.NYET, 2))
+        executor.run()
+        self.assertEqual(stream.read(2), b'xx')
+        self.remote.write_frame(FramePacket.Type.DATA, 2, 2, 0, b'x')
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.ACK, 2))
+        executor.run()
+        self.assertEqual(stream.read(1), b'x')
+        self.assertEqual(stream.promise.dropped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
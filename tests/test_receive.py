@@ -0,0 +1,83 @@
+import unittest
+
+from SerialPacketStream import TransportLayer, FramePacket, Service, RawDataPacket
+
+
+class ReadConnection(object):
+    """A connection with read() only, the receive path copies what it reads into its buffer"""
+    baudrate = None
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.data) - self.offset
+
+    def read(self, size = 1):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+    def write(self, data):
+        return len(data)
+
+
+class ReadIntoConnection(ReadConnection):
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def frames(payloads):
+    stream = bytearray()
+    for sync, payload in enumerate(payloads):
+        packet = FramePacket.Data.create(FramePacket.Type.DATA_NACK, 1, 1, bytearray(payload))
+        packet.header.sync = sync
+        stream += bytes(packet)
+    return bytes(stream)
+
+
+class ReceiveTest(unittest.TestCase):
+    payloads = [bytes([x]) * 64 for x in range(4)]
+
+    def receive(self, connection, callback = None):
+        # process_receive is driven from the test, the IO thread is stopped before anything arrives
+        transport_layer = TransportLayer(connection, 512)
+        transport_layer.shutdown()
+        service = Service()
+        service.register_packet(RawDataPacket, 1)
+        transport_layer.attach(1, service)
+        if callback is not None:
+            service.subscribe(RawDataPacket, callback)
+        while connection.in_waiting or transport_layer.rx_stream.packet is not None:
+            transport_layer.process_receive()
+        return service
+
+    def test_retained(self):
+        # packets queued by the service keep their own frame header and payload after the receive
+        # buffer has moved on to the next frame
+        service = self.receive(ReadIntoConnection(frames(self.payloads)))
+        packets = list(service.rx_queue)
+        self.assertEqual([bytes(x.data) for x in packets], self.payloads)
+        self.assertEqual([x._frame_packet.header.sync for x in packets], list(range(len(self.payloads))))
+        self.assertEqual(len(set(id(x._frame_packet) for x in packets)), len(packets))
+
+    def test_not_retained(self):
+        # a callback that doesn't keep the packet sees the shared frame, nothing is copied for it
+        seen = []
+        self.receive(ReadIntoConnection(frames(self.payloads)), lambda packet: seen.append((bytes(packet.data), packet._retained, packet._frame_packet.data)))
+        self.assertEqual([x[0] for x in seen], self.payloads)
+        self.assertFalse(any(x[1] for x in seen))
+        self.assertTrue(all(isinstance(x[2], memoryview) for x in seen))
+
+    def test_read_copy(self):
+        connection = ReadConnection(frames(self.payloads))
+        service = self.receive(connection)
+        self.assertEqual([bytes(x.data) for x in service.rx_queue], self.payloads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import random
+import unittest
+
+from SerialPacketStream import TransportLayer, FramePacket, Service, RawDataPacket
+import SerialPacketStream.ReedSolomon as ReedSolomon
+
+from test_protocol import RawRemote
+
+
+def corrupt(message, parity, errors, rng):
+    # errors bytes of every codeword flipped, message and parity interleaved the way encode() lays them out
+    count = ReedSolomon.codewords(len(message))
+    for i in range(count):
+        # positions in codeword i, its message bytes first then its parity
+        positions = list(range(i, len(message), count)) + [len(message) + i * ReedSolomon.NSYM + x for x in range(ReedSolomon.NSYM)]
+        for position in rng.sample(positions, errors):
+            if position < len(message):
+                message[position] ^= rng.randrange(1, 256)
+            else:
+                parity[position - len(message)] ^= rng.randrange(1, 256)
+
+
+class ReedSolomonTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def message(self, length):
+        return bytearray(self.rng.getrandbits(8) for _ in range(length))
+
+    def test_parity_size(self):
+        for length, codewords in ((1, 1), (ReedSolomon.CODEWORD_DATA, 1), (ReedSolomon.CODEWORD_DATA + 1, 2), (514, 3)):
+            self.assertEqual(ReedSolomon.codewords(length), codewords)
+            self.assertEqual(len(ReedSolomon.encode(bytes(length))), ReedSolomon.parity_size(length))
+            self.assertEqual(ReedSolomon.parity_size(length), codewords * ReedSolomon.NSYM)
+
+    def test_clean(self):
+        message = self.message(300)
+        parity = bytearray(ReedSolomon.encode(message))
+        self.assertEqual(ReedSolomon.correct(message, parity), 0)
+
+    def test_correct(self):
+        # up to NSYM / 2 corrupt bytes in every codeword, message or parity, are put right
+        for length in (1, 64, ReedSolomon.CODEWORD_DATA, 514, 1024):
+            for errors in range(1, ReedSolomon.NSYM // 2 + 1):
+                original = self.message(length)
+                message = bytearray(original)
+                parity = bytearray(ReedSolomon.encode(message))
+                corrupt(message, parity, errors, self.rng)
+                self.assertEqual(ReedSolomon.correct(message, parity), errors * ReedSolomon.codewords(length))
+                self.assertEqual(message, original)
+
+    def test_memoryview(self):
+        # the receiver corrects a slice of its receive buffer in place
+        original = self.message(100)
+        buffer = bytearray(original + ReedSolomon.encode(original))
+        buffer[5] ^= 0xFF
+        view = memoryview(buffer)
+        self.assertEqual(ReedSolomon.correct(view[:100], view[100:]), 1)
+        self.assertEqual(buffer[:100], original)
+
+    def test_uncorrectable(self):
+        original = self.message(200)
+        message = bytearray(original)
+        parity = bytearray(ReedSolomon.encode(message))
+        corrupt(message, parity, ReedSolomon.NSYM // 2 + 1, self.rng)
+        with self.assertRaises(ValueError):
+            ReedSolomon.correct(message, parity)
+        with self.assertRaises(ValueError):
+            ReedSolomon.correct(bytearray(original), parity[:-1])
+
+
+class CorrectPacketTest(unittest.TestCase):
+    """FEC frames from the remote repaired by TransportLayer.correct_packet"""
+    def setUp(self):
+        self.remote = RawRemote()
+        self.transport_layer = TransportLayer(self.remote.host, 512)
+        self.addCleanup(self.transport_layer.shutdown)
+        self.service = Service()
+        self.service.register_packet(RawDataPacket, 1)
+        self.transport_layer.attach(1, self.service)
+        self.assertIsNotNone(self.remote.synchronise())
+        self.rng = random.Random(2)
+
+    def write_frame(self, sync, payload, errors, extended = False):
+        # a DATA frame with parity, errors bytes corrupted in every codeword of payload and footer
+        frame = FramePacket.Data.create(FramePacket.Type.DATA, 1, 1, bytearray(payload), extended = extended, fec = True)
+        frame.header.sync = sync
+        wire = bytearray(bytes(frame))
+        self.assertEqual(wire[0], frame.header.HEADER_TOKEN & 0xFF)
+        start = frame.header.SIZE
+        end = start + len(payload) + FramePacket.Data.Footer.SIZE
+        message, parity = wire[start:end], wire[end:]
+        corrupt(message, parity, errors, self.rng)
+        wire[start:end], wire[end:] = message, parity
+        self.remote.connection.write(bytes(wire))
+
+    def test_corrected(self):
+        for sync, extended in ((0, False), (1, True)):
+            payload = bytes(self.rng.getrandbits(8) for _ in range(300))
+            self.write_frame(sync, payload, ReedSolomon.NSYM // 2, extended)
+            self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.ACK, sync))
+            self.assertEqual(bytes(self.service.rx_queue.pop().data), payload)
+        metrics = self.transport_layer.metrics
+        self.assertEqual(metrics.fec_corrected, 2)
+        self.assertEqual(metrics.fec_corrected_bytes, 2 * ReedSolomon.NSYM // 2 * ReedSolomon.codewords(300 + FramePacket.Data.Footer.SIZE))
+        self.assertEqual(metrics.fec_uncorrectable, 0)
+
+    def test_uncorrectable(self):
+        # too many errors to repair, the frame is NACKed as if it had no parity
+        self.write_frame(0, bytes(64), ReedSolomon.NSYM // 2 + 1)
+        self.assertEqual(self.remote.next(), (FramePacket.Type.RESPONSE, FramePacket.Response.Type.NACK, 0))
+        self.assertEqual(len(self.service.rx_queue), 0)
+        self.assertEqual(self.transport_layer.metrics.fec_uncorrectable, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
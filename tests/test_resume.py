@@ -0,0 +1,160 @@
+import os
+import tempfile
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService, FramePacket
+from SerialPacketStream.FileService import PacketCode, ActionResponsePacket
+from SerialPacketStream.Emulator import Emulator
+
+
+class LossyTransport(object):
+    """Stands in for the TransportLayer, the link drops as the WRITE packet with index drop_at is sent"""
+    synchronised = True
+    sync_max_block_size = 64
+
+    def __init__(self, drop_at):
+        self.reconnects = 0
+        self.drop_at = drop_at
+
+    def max_block_size(self):
+        return self.sync_max_block_size
+
+    def max_window(self):
+        return 255
+
+
+class LossyFileService(FileService):
+    """A FileService whose packets reach an in memory remote file, DATA_NACK blocks are buffered by
+    the remote until the next DATA block is acknowledged and are lost with the link"""
+    def __init__(self, drop_at):
+        super().__init__()
+        self._transport_layer = LossyTransport(drop_at)
+        self.remote = bytearray()
+        self.unacknowledged = []
+        self.writes = 0
+        self.resumed = []
+
+    def send_packet(self, packet, packet_type = FramePacket.Type.DATA, block = False):
+        packet.frame_packet = FramePacket.Data()
+        packet.frame_packet.status = FramePacket.Status.COMPLETE
+        transport = self._transport_layer
+        if packet.packet_id == PacketCode.WRITE:
+            if self.writes == transport.drop_at:
+                transport.reconnects += 1
+                self.unacknowledged = []
+                packet.frame_packet.status = FramePacket.Status.FAILED
+            else:
+                self.unacknowledged.append(bytes(packet.data))
+                if packet_type == FramePacket.Type.DATA:
+                    self.remote += b''.join(self.unacknowledged)
+                    self.unacknowledged = []
+            self.writes += 1
+        elif packet.packet_id == PacketCode.RESUME:
+            self.resumed.append(packet.offset)
+            del self.remote[packet.offset:]
+        return packet
+
+    def wait_packet(self, packet_cls, timeout = None):
+        return ActionResponsePacket(code = ActionResponsePacket.Code.SUCCESS)
+
+
+class ResumeTest(unittest.TestCase):
+    def test_write(self):
+        # blocks after the last acknowledged DATA block are resent once the link is back
+        service = LossyFileService(drop_at = 10)
+        data = os.urandom(64 * 32 + 10)
+        service.open_file = ('dst.bin', False, False)
+        self.assertEqual(service.write(data), len(data))
+        self.assertEqual(service._transport_layer.reconnects, 1)
+        self.assertEqual(len(service.resumed), 1)
+        self.assertEqual(bytes(service.remote), data)
+
+    def test_write_no_open_file(self):
+        # without a file to reopen the write stops at the checkpoint
+        service = LossyFileService(drop_at = 4)
+        self.assertEqual(service.write(os.urandom(64 * 8)), 0)
+        self.assertEqual(service.resumed, [])
+
+
+def drop_at(connection, offset):
+    # progress generator dropping the link once the transfer passes offset bytes
+    done = yield
+    dropped = False
+    while True:
+        if not dropped and done >= offset:
+            connection.drop()
+            dropped = True
+        done = yield
+
+
+class EmulatedResumeTest(unittest.TestCase):
+    """put and get survive the link being dropped part way through a transfer"""
+    size = 1024 * 1024
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.emulator = Emulator(baudrate = 1000000, seed = 1)
+        self.transport_layer = TransportLayer(self.emulator.connection, 512)
+        self.file_service = FileService()
+        self.transport_layer.connect()
+        self.transport_layer.attach(1, self.file_service)
+        self.file_service.query_remote()
+        self.data = os.urandom(self.size)
+
+    def tearDown(self):
+        self.transport_layer.disconnect()
+        self.transport_layer.shutdown()
+        self.emulator.shutdown()
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_put(self):
+        with open(self.path('src.bin'), 'wb') as f:
+            f.write(self.data)
+        self.file_service.put(self.path('src.bin'), 'dst.bin', progress = drop_at(self.emulator.connection, self.size // 4))
+        self.assertEqual(self.transport_layer.reconnects, 1)
+        with open(os.path.join(self.emulator.root, 'dst.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_put_dummy(self):
+        # a dummy upload goes nowhere on the remote, it resumes all the same
+        self.assertTrue(self.file_service.open('dst.bin', dummy = True))
+        self.assertEqual(self.file_service.write(self.data, progress = drop_at(self.emulator.connection, self.size // 4)), self.size)
+        self.assertEqual(self.transport_layer.reconnects, 1)
+        self.assertTrue(self.file_service.close())
+        self.assertFalse(os.path.exists(os.path.join(self.emulator.root, 'dst.bin')))
+
+    def test_get(self):
+        with open(os.path.join(self.emulator.root, 'src.bin'), 'wb') as f:
+            f.write(self.data)
+        self.assertTrue(self.file_service.get('src.bin', self.path('dst.bin'), progress = drop_at(self.emulator.connection, self.size // 4)))
+        self.assertEqual(self.transport_layer.reconnects, 1)
+        with open(self.path('dst.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+class UnsentPacketTest(unittest.TestCase):
+    def test_write_reconnect_before_frame(self):
+        # TransportLayer.reconnect() counts the reconnect before connection_reset() gives the packets
+        # still queued their failed frame, write() has to cope with a packet that has no frame yet
+        class Transport(object):
+            reconnects = 0
+            def max_window(self):
+                return 255
+            def max_block_size(self):
+                return 512
+
+        class Service(FileService):
+            def send_packet(self, packet, packet_type = None, block = False):
+                self._transport_layer.reconnects += 1
+                return packet
+
+        service = Service()
+        service._transport_layer = Transport()
+        self.assertEqual(service.write(b'x' * 100), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
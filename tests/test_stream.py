@@ -0,0 +1,26 @@
+import unittest
+
+from SerialPacketStream import StreamService
+
+
+class StreamServiceTest(unittest.TestCase):
+    def test_write_before_synchronised(self):
+        # max_block_size() is 0 until the link synchronises, write() mustn't cut 0 byte blocks forever
+        class Transport(object):
+            synchronised = False
+            reconnects = 0
+            def max_block_size(self):
+                return 0
+            def max_window(self):
+                return 255
+
+        stream = StreamService(timeout = 0.01)
+        stream._transport_layer = Transport()
+        with self.assertRaises(OSError):
+            stream.write(b'G28\n' * 200)
+        self.assertEqual(len(stream.tx_queue), 0)
+        self.assertEqual(len(stream.tx_buffer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import json
+import tempfile
+import unittest
+
+from SerialPacketStream import TransportLayer, FileService, FramePacket
+import SerialPacketStream.Trace as Trace
+from SerialPacketStream.Emulator import Emulator
+
+
+class ChromeTracerTest(unittest.TestCase):
+    def test_slices(self):
+        # every frame gets a slice of its own, opened once and closed once, however many frames
+        # come and go during the trace
+        emulator = Emulator(baudrate = 1000000, seed = 1)
+        transport_layer = TransportLayer(emulator.connection, 512)
+        service = FileService()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'trace.json')
+            try:
+                transport_layer.connect()
+                transport_layer.attach(1, service)
+                transport_layer.start_trace(filename)
+                with open(os.path.join(directory, 'src.bin'), 'wb') as f:
+                    f.write(os.urandom(64 * 1024))
+                service.put(os.path.join(directory, 'src.bin'), 'dst.bin')
+            finally:
+                transport_layer.shutdown()
+                emulator.shutdown()
+            with open(filename) as f:
+                events = [x for x in json.load(f) if x]
+
+        slices = {}
+        for event in events:
+            slices.setdefault(event['id'], []).append(event['ph'])
+        self.assertGreater(len(slices), 128)
+        for phases in slices.values():
+            self.assertEqual(phases[0], 'b')
+            self.assertEqual(phases.count('b'), 1)
+            self.assertEqual(phases.count('e'), 1)
+            self.assertEqual(phases[-1], 'e')
+
+    def test_unfinished_slice(self):
+        # a frame dropped without a final event, its memory reused by the next frame, leaves the
+        # next frame's slice alone
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'trace.json')
+            tracer = Trace.ChromeTracer(filename)
+            for _ in range(2):
+                frame = FramePacket.Data.create(FramePacket.Type.DATA, 1, 1, bytearray(b'x'))
+                tracer.event(frame, Trace.Event.QUEUED, 1.0)
+                del frame
+            tracer.close()
+            with open(filename) as f:
+                events = [x for x in json.load(f) if x]
+        self.assertEqual([x['ph'] for x in events], ['b', 'b'])
+        self.assertNotEqual(events[0]['id'], events[1]['id'])
+
+
+if __name__ == '__main__':
+    unittest.main()